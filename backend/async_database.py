@@ -0,0 +1,106 @@
+"""Asyncio counterparts of the ``database`` functions for FastAPI handlers.
+
+Same names and return values as ``database``, built on the shared Motor
+client from ``mongo`` so a slow query never blocks the event loop. The
+synchronous ``database`` module stays in use by Celery workers and code
+that runs in the threadpool.
+"""
+from typing import Any, Dict, Optional
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+import logging
+
+from mongo import get_async_db
+from password_hashing import hash_password, verify_password
+from pagination import keyset_page_async
+from tracing import traced
+from database import (
+    new_user_record, new_document_record, serialize_document, user_document_query,
+    document_projection, DOCUMENT_LIST_PROJECTION
+)
+
+logger = logging.getLogger(__name__)
+
+def _collection(name: str):
+    return get_async_db()[name]
+
+async def get_user_by_username(username: str):
+    return await _collection("users").find_one({"username": username})
+
+async def create_user(username: str, email: str, password: str):
+    if await get_user_by_username(username):
+        return False, "Username already exists"
+
+    hashed_password = await hash_password(password)
+    try:
+        await _collection("users").insert_one(new_user_record(username, email, hashed_password))
+    except DuplicateKeyError:
+        return False, "Username already exists"  # A concurrent signup took it after the check
+    return True, "User created successfully"
+
+async def verify_user(username: str, password: str):
+    user = await get_user_by_username(username)
+    if not user:
+        logger.debug(f"User not found: {username}")
+        return False, "User not found"
+
+    if not await verify_password(password, user["hashed_password"]):
+        logger.debug(f"Password verification failed for user: {username}")
+        return False, "Incorrect password"
+
+    return True, user
+
+@traced("save_document")
+async def save_document(user_id: str, filename: str, summary: str, clauses: Optional[list], chunks: list, embeddings: list,
+                        storage: Dict[str, Any], embedding_norms: Optional[list] = None,
+                        document_id: Optional[ObjectId] = None):
+    try:
+        # The PDF itself is written by the storage uploader
+        document = new_document_record(
+            user_id, filename, summary, clauses, chunks, embeddings, storage, embedding_norms, document_id
+        )
+        await _collection("documents").insert_one(document)
+        return True, "Document saved successfully"
+    except Exception as e:
+        logger.error(f"Error saving document: {str(e)}", exc_info=True)
+        return False, f"Error saving document: {str(e)}"
+
+async def get_user_documents(user_id: str, limit: int = 100, cursor: Optional[str] = None):
+    """Get one page of the user's documents, newest first, and the next page cursor."""
+    documents, next_cursor = await keyset_page_async(
+        _collection("documents"),
+        {"user_id": user_id},
+        "created_at",
+        limit,
+        cursor,
+        DOCUMENT_LIST_PROJECTION
+    )
+    return [serialize_document(doc) for doc in documents], next_cursor
+
+async def get_user_document_by_filename(filename: str, user_id, fields: str = "meta"):
+    """Fetch the document named ``filename`` owned by ``user_id`` with only the named field set."""
+    document = await _collection("documents").find_one(
+        {"user_id": user_id, "filename": filename}, document_projection(fields)
+    )
+    if not document:
+        return None
+    return serialize_document(document)
+
+async def get_user_document(document_id: str, user_id, fields: str = "meta"):
+    """Fetch a document owned by ``user_id`` with only the named field set."""
+    query = user_document_query(document_id, user_id)
+    if query is None:
+        return None
+
+    document = await _collection("documents").find_one(query, document_projection(fields))
+    if not document:
+        return None
+    return serialize_document(document)
+
+async def delete_pdf_file(documentId):
+    try:
+        result = await _collection("documents").delete_one({"_id": ObjectId(documentId)})
+        return result.deleted_count == 1
+    except Exception as e:
+        logger.error(f"Delete failed: {e}")
+        return False
@@ -16,7 +16,10 @@ worker_max_memory_per_child = 150000  # 150MB
 
 # Task routing
 task_routes = {
-    'tasks.cleanup_old_documents': {'queue': 'cleanup'}
+    'tasks.cleanup_old_documents': {'queue': 'cleanup'},
+    'tasks.evaluate_pending_responses': {'queue': 'evaluation'},
+    # Low priority: only warms clauses that /clauses would otherwise extract on demand
+    'tasks.extract_document_clauses': {'queue': 'clauses'}
 }
 
 # Task time limits
@@ -0,0 +1,110 @@
+from datetime import datetime, timedelta
+from typing import Any, Optional, Tuple
+from pymongo import ReturnDocument
+from bson import ObjectId
+from prometheus_client import Counter
+import os
+import logging
+
+from database import api_usage_collection, documents_collection, usage_filter, usage_retry_after, usage_verdict
+from document_processor import extract_clauses
+from single_flight import SingleFlight, make_key
+
+logger = logging.getLogger(__name__)
+
+# Also extract clauses on the low-priority "clauses" queue right after upload
+CLAUSE_BACKGROUND_EXTRACTION = os.getenv("CLAUSE_BACKGROUND_EXTRACTION", "false").lower() == "true"
+# A running extraction older than this is assumed dead and may be claimed again
+CLAUSE_EXTRACTION_STALE_SECONDS = int(os.getenv("CLAUSE_EXTRACTION_STALE_SECONDS", "600"))
+
+CLAUSE_EXTRACTIONS = Counter('clause_extractions_total', 'On-demand clause extractions', ['trigger', 'status'])
+
+# Concurrent first requests for one document in this process share one extraction
+clause_flight = SingleFlight("clause_extraction")
+
+def _claim(document_id: ObjectId) -> Optional[dict]:
+    """Mark the document's extraction as running, unless it is done or running elsewhere."""
+    now = datetime.utcnow()
+    return documents_collection.find_one_and_update(
+        {
+            "_id": document_id,
+            "clauses": None,
+            "$or": [
+                {"clauses_status": {"$in": ["pending", "failed"]}},
+                {"clauses_status": {"$exists": False}},
+                {"clauses_status": "running",
+                 "clauses_started_at": {"$lt": now - timedelta(seconds=CLAUSE_EXTRACTION_STALE_SECONDS)}},
+            ]
+        },
+        {"$set": {"clauses_status": "running", "clauses_started_at": now}},
+        projection={"chunks": 1, "user_id": 1},
+        return_document=ReturnDocument.AFTER
+    )
+
+def _extract_and_store(document_id: ObjectId, trigger: str) -> Tuple[str, Any]:
+    document = _claim(document_id)
+    if document is None:
+        current = documents_collection.find_one(
+            {"_id": document_id}, {"clauses": 1, "clauses_status": 1, "clauses_error": 1}
+        )
+        if current is None:
+            return "missing", None
+        if current.get("clauses") is not None:
+            return "done", current["clauses"]
+        return current.get("clauses_status", "running"), current.get("clauses_error")
+
+    user_id = str(document["user_id"])
+    usage = api_usage_collection.find_one(usage_filter(user_id))
+    allowed, message = usage_verdict(usage)
+    if not allowed:
+        # Not a failure: hand the claim back so the next request past the limit extracts
+        documents_collection.update_one(
+            {"_id": document_id, "clauses_status": "running"},
+            {"$set": {"clauses_status": "pending", "clauses_error": None}}
+        )
+        CLAUSE_EXTRACTIONS.labels(trigger=trigger, status="rate_limited").inc()
+        return "rate_limited", {"message": message, "retry_after": usage_retry_after(usage)}
+
+    # Chunks are whole sentences of the extracted text, so joining them restores it
+    text = " ".join(document.get("chunks") or [])
+    try:
+        success, result = extract_clauses(text, user_id)
+    except Exception as e:
+        logger.error(f"Clause extraction failed for {document_id}: {e}", exc_info=True)
+        success, result = False, str(e)
+
+    if success:
+        documents_collection.update_one(
+            {"_id": document_id},
+            {"$set": {"clauses": result, "clauses_status": "done", "clauses_error": None}}
+        )
+        CLAUSE_EXTRACTIONS.labels(trigger=trigger, status="done").inc()
+        return "done", result
+
+    documents_collection.update_one(
+        {"_id": document_id},
+        {"$set": {"clauses_status": "failed", "clauses_error": result}}
+    )
+    CLAUSE_EXTRACTIONS.labels(trigger=trigger, status="failed").inc()
+    return "failed", result
+
+def ensure_clauses(document_id: str, trigger: str = "request") -> Tuple[str, Any]:
+    """Return the document's clauses, extracting and saving them on first use.
+
+    Returns ``(status, payload)``: ``("done", clauses)``, ``("running", None)``
+    while another process extracts them, ``("rate_limited", {"message",
+    "retry_after"})`` when the owner is over their Gemini quota,
+    ``("failed", message)`` or ``("missing", None)``. A failed or
+    rate-limited extraction is retried by the next call.
+    """
+    return clause_flight.do(make_key("clauses", document_id), _extract_and_store, ObjectId(document_id), trigger)
+
+def schedule_clause_extraction(document_id: str):
+    """Queue background extraction if enabled; otherwise the first /clauses request does it."""
+    if not CLAUSE_BACKGROUND_EXTRACTION:
+        return
+    from tasks import extract_document_clauses  # tasks imports this module
+    try:
+        extract_document_clauses.apply_async(args=[document_id], priority=0)
+    except Exception as e:
+        logger.warning(f"Could not queue clause extraction for {document_id}: {e}")
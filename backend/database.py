@@ -1,13 +1,17 @@
-from pymongo import MongoClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
 from gridfs import GridFS
 from passlib.context import CryptContext
 from datetime import datetime, timedelta, date
 from jose import JWTError, jwt
-from typing import Optional
+from typing import Any, Dict, List, Optional
 import os
 from dotenv import load_dotenv
 from bson import ObjectId
+from pagination import keyset_page
+from mongo import db
 import json
+import math
 import logging
 
 logger = logging.getLogger(__name__)
@@ -22,10 +26,6 @@ class JSONEncoder(json.JSONEncoder):
 
 load_dotenv()
 
-MONGO_URI = os.getenv("MONGO_URI")
-client = MongoClient(MONGO_URI)
-db = client.legal_doc_db
-
 # Collections
 users_collection = db.users
 documents_collection = db.documents
@@ -43,24 +43,195 @@ ACCESS_TOKEN_EXPIRE_MINUTES = os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES")
 MAX_REQUESTS_PER_DAY = int(os.getenv("MAX_REQUESTS_PER_DAY", "10"))
 REQUEST_COOLDOWN = float(os.getenv("REQUEST_COOLDOWN", "1.0"))
 
-def check_api_usage(user_id: str) -> tuple[bool, str]:
-    """Check if user has exceeded daily API limit or needs to wait for cooldown."""
+# Retention for TTL indexes; 0 disables expiry
+API_USAGE_TTL_DAYS = int(os.getenv("API_USAGE_TTL_DAYS", "7"))
+GEMINI_METRICS_TTL_DAYS = int(os.getenv("GEMINI_METRICS_TTL_DAYS", "90"))
+MINUTE_ROLLUP_TTL_DAYS = int(os.getenv("MINUTE_ROLLUP_TTL_DAYS", "2"))
+INGEST_BATCH_TTL_DAYS = int(os.getenv("INGEST_BATCH_TTL_DAYS", "7"))
+
+# TTL indexes switched off by their setting; ensure_indexes drops them so expiry stops
+DISABLED_TTL_INDEXES: Dict[str, List[str]] = {}
+
+def _ttl_index(collection: str, field: str, days: int, name: str, **kwargs) -> List[IndexModel]:
+    if days <= 0:
+        DISABLED_TTL_INDEXES.setdefault(collection, []).append(name)
+        return []
+    return [IndexModel([(field, ASCENDING)], name=name, expireAfterSeconds=days * 86400, **kwargs)]
+
+# Index registry: every index the application relies on, by collection
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+    ],
+    "documents": [
+        # Covers paginated listings (get_user_documents)
+        IndexModel(
+            [("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING), ("filename", ASCENDING)],
+            name="user_documents_listing"
+        ),
+        IndexModel([("filename", ASCENDING)], name="filename"),
+        IndexModel([("created_at", ASCENDING)], name="created_at"),
+        IndexModel([("storage.key", ASCENDING)], name="storage_key"),
+        IndexModel([("storage.status", ASCENDING)], name="storage_status"),
+    ],
+    "api_usage": [
+        IndexModel([("user_id", ASCENDING), ("date", ASCENDING)], name="user_date_unique", unique=True),
+        *_ttl_index("api_usage", "created_at", API_USAGE_TTL_DAYS, "created_at_ttl"),
+    ],
+    "upload_sessions": [
+        # Abandoned resumable uploads expire at their expires_at
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "ingest_batches": [
+        *_ttl_index("ingest_batches", "created_at", INGEST_BATCH_TTL_DAYS, "created_at_ttl"),
+    ],
+    "gemini_metrics": [
+        IndexModel([("timestamp", DESCENDING), ("_id", DESCENDING)], name="recent_metrics"),
+        IndexModel(
+            [("evaluation_status", ASCENDING), ("timestamp", ASCENDING)],
+            name="pending_evaluations",
+            partialFilterExpression={"evaluation_status": "pending"}
+        ),
+        IndexModel(
+            [("evaluation_claimed_at", ASCENDING)],
+            name="claimed_evaluations",
+            partialFilterExpression={"evaluation_status": "in_progress"}
+        ),
+        *_ttl_index("gemini_metrics", "timestamp", GEMINI_METRICS_TTL_DAYS, "timestamp_ttl"),
+    ],
+    "gemini_metrics_rollups": [
+        IndexModel([("granularity", ASCENDING), ("bucket", ASCENDING)], name="granularity_bucket"),
+        *_ttl_index(
+            "gemini_metrics_rollups", "bucket", MINUTE_ROLLUP_TTL_DAYS, "minute_bucket_ttl",
+            partialFilterExpression={"granularity": "minute"}
+        ),
+    ],
+}
+
+# Hot queries with representative shapes, checked against the indexes above
+HOT_QUERIES: List[Dict[str, Any]] = [
+    {"name": "get_current_user", "collection": "users", "filter": {"username": ""}},
+    {"name": "get_user_documents", "collection": "documents", "filter": {"user_id": ObjectId()},
+     "sort": [("created_at", DESCENDING), ("_id", DESCENDING)]},
+    {"name": "get_user_document_by_filename", "collection": "documents", "filter": {"user_id": ObjectId(), "filename": ""}},
+    {"name": "cleanup_old_documents", "collection": "documents", "filter": {"created_at": {"$lt": datetime(1970, 1, 1)}}},
+    {"name": "storage_upload_status", "collection": "documents", "filter": {"storage.key": ""}},
+    {"name": "check_api_usage", "collection": "api_usage", "filter": {"user_id": "", "date": ""}},
+    {"name": "get_recent_metrics", "collection": "gemini_metrics", "filter": {},
+     "sort": [("timestamp", DESCENDING), ("_id", DESCENDING)]},
+    {"name": "claim_pending_evaluations", "collection": "gemini_metrics", "filter": {"evaluation_status": "pending"},
+     "sort": [("timestamp", ASCENDING)]},
+    {"name": "requeue_stale_evaluations", "collection": "gemini_metrics",
+     "filter": {"evaluation_status": "in_progress", "evaluation_claimed_at": {"$lt": datetime(1970, 1, 1)}}},
+    {"name": "get_rollups", "collection": "gemini_metrics_rollups",
+     "filter": {"granularity": "hour", "bucket": {"$gte": datetime(1970, 1, 1)}}, "sort": [("bucket", ASCENDING)]},
+]
+
+def ensure_indexes() -> Dict[str, List[str]]:
+    """Create missing registry indexes and bring TTLs in line with the settings.
+
+    Returns the names of the indexes created, updated, dropped and failed,
+    and of existing indexes that are not in the registry.
+    """
+    report = {"created": [], "updated": [], "dropped": [], "failed": [], "unregistered": []}
+    for collection_name, models in INDEXES.items():
+        collection = db[collection_name]
+        existing = collection.index_information()
+        wanted = {model.document["name"] for model in models}
+
+        for model in models:
+            name = model.document["name"]
+            ttl = model.document.get("expireAfterSeconds")
+            try:
+                if name not in existing:
+                    collection.create_indexes([model])
+                    report["created"].append(f"{collection_name}.{name}")
+                elif existing[name].get("expireAfterSeconds") != ttl:
+                    db.command("collMod", collection_name, index={"name": name, "expireAfterSeconds": ttl})
+                    report["updated"].append(f"{collection_name}.{name}")
+            except OperationFailure as e:
+                # e.g. duplicates blocking a unique index; keep checking the rest
+                logger.error(f"Could not create index {collection_name}.{name}: {e}")
+                report["failed"].append(f"{collection_name}.{name}")
+
+        disabled = set(DISABLED_TTL_INDEXES.get(collection_name, []))
+        for name in disabled & set(existing):
+            try:
+                collection.drop_index(name)
+                report["dropped"].append(f"{collection_name}.{name}")
+            except OperationFailure as e:
+                logger.error(f"Could not drop disabled TTL index {collection_name}.{name}: {e}")
+                report["failed"].append(f"{collection_name}.{name}")
+
+        for name in existing:
+            if name != "_id_" and name not in wanted and name not in disabled:
+                report["unregistered"].append(f"{collection_name}.{name}")
+
+    logger.info(f"Index check: {report}")
+    return report
+
+def _plan_stages(plan: Dict[str, Any]) -> List[str]:
+    stages = [plan.get("stage", "")]
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child:
+            stages.extend(_plan_stages(child))
+    return stages
+
+def verify_query_coverage() -> List[str]:
+    """Explain each hot query and return the names of those not served by an index.
+
+    A query counts as uncovered if its winning plan scans the collection or
+    sorts in memory.
+    """
+    uncovered = []
+    for query in HOT_QUERIES:
+        try:
+            cursor = db[query["collection"]].find(query["filter"])
+            if query.get("sort"):
+                cursor = cursor.sort(query["sort"])
+            plan = cursor.explain()["queryPlanner"]["winningPlan"]
+            stages = _plan_stages(plan.get("queryPlan", plan))
+        except OperationFailure as e:
+            logger.error(f"Could not explain {query['name']}: {e}")
+            continue
+        if "COLLSCAN" in stages or "SORT" in stages:
+            uncovered.append(query["name"])
+            logger.warning(f"Query {query['name']} on {query['collection']} is not index-backed: {stages}")
+    return uncovered
+
+# Query and record builders shared by the sync functions below and async_database
+
+def usage_filter(user_id: str) -> Dict[str, Any]:
     today = datetime.now().date()
-    
-    usage = api_usage_collection.find_one({
+    return {
         "user_id": user_id,
         "date": today.isoformat()  # Convert date to ISO format string
-    })
-    
+    }
+
+def new_usage_record(user_id: str) -> Dict[str, Any]:
+    return {
+        **usage_filter(user_id),
+        "request_count": 0,
+        "last_request_time": None,
+        "created_at": datetime.utcnow()  # Drives the TTL index
+    }
+
+def usage_upsert(user_id: str) -> Dict[str, Any]:
+    """Create today's usage record if missing; the filter fields are copied in by the upsert."""
+    record = new_usage_record(user_id)
+    return {"$setOnInsert": {key: value for key, value in record.items() if key not in ("user_id", "date")}}
+
+def usage_increment() -> Dict[str, Any]:
+    return {
+        "$inc": {"request_count": 1},
+        "$set": {"last_request_time": datetime.utcnow()}
+    }
+
+def usage_verdict(usage: Optional[Dict[str, Any]]) -> tuple[bool, str]:
+    """Decide from today's usage record whether another request is allowed."""
     if not usage:
-        api_usage_collection.insert_one({
-            "user_id": user_id,
-            "date": today.isoformat(),  # Convert date to ISO format string
-            "request_count": 0,
-            "last_request_time": None
-        })
         return True, ""
-    
+
     if usage["request_count"] >= MAX_REQUESTS_PER_DAY:
         return False, "Daily API limit reached. Please try again tomorrow."
     
@@ -72,33 +243,85 @@ def check_api_usage(user_id: str) -> tuple[bool, str]:
     
     return True, ""
 
+def usage_retry_after(usage: Optional[Dict[str, Any]]) -> int:
+    """Seconds until ``usage_verdict`` allows another request."""
+    if not usage:
+        return 0
+    if usage["request_count"] >= MAX_REQUESTS_PER_DAY:
+        # Usage records are per local calendar day
+        now = datetime.now()
+        midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        return math.ceil((midnight - now).total_seconds())
+    if usage["last_request_time"]:
+        wait_time = REQUEST_COOLDOWN - (datetime.utcnow() - usage["last_request_time"]).total_seconds()
+        return max(0, math.ceil(wait_time))
+    return 0
+
+def new_user_record(username: str, email: str, hashed_password: str) -> Dict[str, Any]:
+    return {
+        "username": username,
+        "email": email,
+        "hashed_password": hashed_password,
+        "created_at": datetime.now()
+    }
+
+def new_document_record(user_id, filename: str, summary: str, clauses: Optional[list], chunks: list, embeddings: list,
+                        storage: Dict[str, Any], embedding_norms: Optional[list] = None,
+                        document_id: Optional[ObjectId] = None) -> Dict[str, Any]:
+    record = {
+        "user_id": user_id,
+        "filename": filename,
+        "summary": summary,
+        # None until extracted on first use (see clause_extraction)
+        "clauses": clauses,
+        "clauses_status": "pending" if clauses is None else "done",
+        "chunks": chunks,
+        "embeddings": embeddings,
+        "embedding_norms": embedding_norms,
+        "storage": storage,  # Where the PDF lives and whether it has been stored yet
+        "created_at": datetime.now()
+    }
+    if document_id is not None:
+        record["_id"] = document_id
+    return record
+
+def serialize_document(document: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert ObjectId to string and datetime to ISO format."""
+    document['_id'] = str(document['_id'])
+    if 'user_id' in document:
+        document['user_id'] = str(document['user_id'])
+    if 'created_at' in document:
+        document['created_at'] = document['created_at'].isoformat() if isinstance(document['created_at'], (datetime, date)) else document['created_at']
+    return document
+
+def user_document_query(document_id: str, user_id) -> Optional[Dict[str, Any]]:
+    """Filter matching ``document_id`` owned by ``user_id``, or None for an invalid id."""
+    try:
+        return {"_id": ObjectId(document_id), "user_id": user_id}
+    except Exception as e:
+        logger.debug(f"Invalid ObjectId format: {e}")
+        return None
+
+def check_api_usage(user_id: str) -> tuple[bool, str]:
+    """Check if user has exceeded daily API limit or needs to wait for cooldown."""
+    # One upsert, so concurrent first calls of the day don't race on user_date_unique
+    usage = api_usage_collection.find_one_and_update(
+        usage_filter(user_id), usage_upsert(user_id), upsert=True, return_document=ReturnDocument.AFTER
+    )
+    return usage_verdict(usage)
+
 def update_api_usage(user_id: str):
     """Update API usage count and last request time."""
-    today = datetime.now().date()
-    
-    api_usage_collection.update_one(
-        {
-            "user_id": user_id,
-            "date": today.isoformat()  # Convert date to ISO format string
-        },
-        {
-            "$inc": {"request_count": 1},
-            "$set": {"last_request_time": datetime.utcnow()}
-        }
-    )
+    api_usage_collection.update_one(usage_filter(user_id), usage_increment())
 
 def create_user(username: str, email: str, password: str):
     if users_collection.find_one({"username": username}):
         return False, "Username already exists"
     
-    hashed_password = pwd_context.hash(password)
-    user = {
-        "username": username,
-        "email": email,
-        "hashed_password": hashed_password,
-        "created_at": datetime.now()
-    }
-    users_collection.insert_one(user)
+    try:
+        users_collection.insert_one(new_user_record(username, email, pwd_context.hash(password)))
+    except DuplicateKeyError:
+        return False, "Username already exists"  # A concurrent signup took it after the check
     return True, "User created successfully"
 
 def verify_user(username: str, password: str):
@@ -127,21 +350,13 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def save_document(user_id: str, filename: str, summary: str, clauses: list, chunks: list, embeddings: list, pdf_file):
+def save_document(user_id: str, filename: str, summary: str, clauses: Optional[list], chunks: list, embeddings: list,
+                  storage: Dict[str, Any], embedding_norms: Optional[list] = None, document_id: Optional[ObjectId] = None):
     try:
-        # Save PDF to GridFS
-        pdf_id = fs.put(pdf_file, filename=filename)
-        
-        document = {
-            "user_id": user_id,
-            "filename": filename,
-            "summary": summary,
-            "clauses": clauses,
-            "chunks": chunks,
-            "embeddings": embeddings,
-            "pdf_id": str(pdf_id),  # Convert ObjectId to string
-            "created_at": datetime.now()
-        }
+        # The PDF itself is written by the storage uploader
+        document = new_document_record(
+            user_id, filename, summary, clauses, chunks, embeddings, storage, embedding_norms, document_id
+        )
         
         result = documents_collection.insert_one(document)
         return True, "Document saved successfully"
@@ -149,57 +364,48 @@ def save_document(user_id: str, filename: str, summary: str, clauses: list, chun
         logger.error(f"Error saving document: {str(e)}", exc_info=True)
         return False, f"Error saving document: {str(e)}"
 
-def get_user_documents(user_id: str):
-    documents = documents_collection.find({"user_id": user_id})
-    return [
-        {
-            "_id": str(doc["_id"]),  # Convert ObjectId to string
-            "filename": doc["filename"],
-            "created_at": doc["created_at"].isoformat() if isinstance(doc["created_at"], (datetime, date)) else doc["created_at"],
-            "user_id": str(doc["user_id"])  # Convert ObjectId to string
-        }
-        for doc in documents
-    ]
-
-def get_document_by_filename(filename: str):
-    print(f"Looking for document with filename: {filename}")
-    document = documents_collection.find_one({"filename": filename})
+# Fields shown in document lists; served entirely from the listing index
+DOCUMENT_LIST_PROJECTION = {"_id": 1, "filename": 1, "created_at": 1, "user_id": 1}
 
-    if not document:
-        print("No document found")
-        return None
-    
-    print(f"Found document!!!!")
-    # Convert ObjectId to string and datetime to ISO format
-    # print("hehe:", document["clauses"])
-    document['_id'] = str(document['_id'])
-    document['user_id'] = str(document['user_id'])
-    if 'created_at' in document:
-        document['created_at'] = document['created_at'].isoformat() if isinstance(document['created_at'], (datetime, date)) else document['created_at']
-    return document
+def get_user_documents(user_id: str, limit: int = 100, cursor: Optional[str] = None):
+    """Get one page of the user's documents, newest first, and the next page cursor."""
+    documents, next_cursor = keyset_page(
+        documents_collection,
+        {"user_id": user_id},
+        "created_at",
+        limit,
+        cursor,
+        DOCUMENT_LIST_PROJECTION
+    )
+    return [serialize_document(doc) for doc in documents], next_cursor
 
-def get_document_by_id(id):
-    print(f"Looking for document with id: {id}")
-    object_id = None
-    try:
-        object_id = ObjectId(id)
-    except Exception as e:
-        print(f"Invalid ObjectId format: {e}")
+# Named field sets for projected document reads; list only what a caller needs
+DOCUMENT_META_FIELDS = ["filename", "user_id", "created_at", "storage"]
+DOCUMENT_FIELD_SETS = {
+    "meta": DOCUMENT_META_FIELDS,
+    "summary": DOCUMENT_META_FIELDS + ["summary"],
+    "clauses": DOCUMENT_META_FIELDS + ["clauses"],
+    "retrieval": DOCUMENT_META_FIELDS + ["chunks", "embeddings", "embedding_norms"],
+}
+
+def document_projection(fields: str) -> Dict[str, int]:
+    return {field: 1 for field in DOCUMENT_FIELD_SETS[fields]}
+
+def get_user_document(document_id: str, user_id, fields: str = "meta"):
+    """Fetch a document owned by ``user_id`` with only the named field set.
+
+    Ownership is part of the query filter, so documents belonging to other
+    users are indistinguishable from missing ones. Returns ``None`` for
+    invalid ids, missing documents and documents owned by someone else.
+    """
+    query = user_document_query(document_id, user_id)
+    if query is None:
         return None
-    document = documents_collection.find_one({"_id": object_id})
 
+    document = documents_collection.find_one(query, document_projection(fields))
     if not document:
-        print("No document found")
         return None
-    
-    print(f"Found document!!!!")
-    # Convert ObjectId to string and datetime to ISO format
-    # print("hehe:", document["clauses"])
-    document['_id'] = str(document['_id'])
-    document['user_id'] = str(document['user_id'])
-    if 'created_at' in document:
-        document['created_at'] = document['created_at'].isoformat() if isinstance(document['created_at'], (datetime, date)) else document['created_at']
-    return document
+    return serialize_document(document)
 
 def get_pdf_file(pdf_id):
     """Retrieve PDF file from GridFS"""
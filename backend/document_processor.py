@@ -1,24 +1,24 @@
 import fitz  # PyMuPDF
 import nltk
 from nltk.tokenize import sent_tokenize
-from transformers import AutoTokenizer, AutoModel
-import torch
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 import google.generativeai as genai
-from typing import List, Tuple
+from typing import Iterator, List, Optional, Tuple, Union
+from collections import OrderedDict
+import threading
 import os
 from dotenv import load_dotenv
 import time
 from database import check_api_usage, update_api_usage
-from paddleocr import PaddleOCR
-import cv2
 import numpy as np
 import logging
 import re
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 import httpx
 from prometheus_client import Counter, Gauge, Histogram
+from single_flight import SingleFlight, make_key, normalize_prompt
+from inference_client import embed_texts, ocr_image
+from tracing import span, span_iter, traced
 
 logger = logging.getLogger(__name__)
 
@@ -34,11 +34,54 @@ GEMINI_API_KEY_2 = os.getenv("GEMINI_API_KEY_2")
 genai.configure(api_key=GEMINI_API_KEY_2)
 model_2 = genai.GenerativeModel('gemini-1.5-flash')
 
-tokenizer = AutoTokenizer.from_pretrained('sentence-transformers/all-MiniLM-L6-v2')
-embedding_model = AutoModel.from_pretrained('sentence-transformers/all-MiniLM-L6-v2')
+# Embedding and OCR models live in the inference server (see inference_client)
 
-# Initialize PaddleOCR
-ocr = PaddleOCR(use_angle_cls=True, lang='en', use_gpu=False)  # Set use_gpu=True if you have GPU
+# Coalesce identical query embeddings computed concurrently
+query_embedding_flight = SingleFlight("query_embedding")
+
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "2048"))
+QUERY_EMBEDDING_CACHE_LOOKUPS = Counter('query_embedding_cache_lookups_total', 'Query embedding cache lookups', ['result'])
+
+class QueryEmbeddingCache:
+    """Size-bounded LRU of query embeddings keyed by normalized query text."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is None:
+                QUERY_EMBEDDING_CACHE_LOOKUPS.labels(result="miss").inc()
+                return None
+            self._entries.move_to_end(key)
+            QUERY_EMBEDDING_CACHE_LOOKUPS.labels(result="hit").inc()
+            return embedding
+
+    def set(self, key: str, embedding: np.ndarray):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+query_embedding_cache = QueryEmbeddingCache(QUERY_EMBEDDING_CACHE_SIZE)
+
+def gemini_generate(model, prompt: str, **kwargs):
+    """Call ``model.generate_content`` inside a tracing span named after the model.
+
+    A streamed call returns an iterator whose span covers reading the whole
+    stream, not just opening it.
+    """
+    name = f"gemini.{model.model_name.split('/')[-1]}"
+    if kwargs.get("stream"):
+        return span_iter(name, lambda: model.generate_content(prompt, **kwargs), stream=True)
+    with span(name, stream=False):
+        return model.generate_content(prompt, **kwargs)
 
 # Define retry decorator
 def gemini_retry():
@@ -49,6 +92,7 @@ def gemini_retry():
         reraise=True  # cuối cùng raise lỗi nếu thất bại
     )
 
+@traced("extract_text_from_pdf")
 def extract_text_from_pdf(pdf_path: str) -> str:
     """Extract text from PDF file including text from images."""
     doc = fitz.open(pdf_path)
@@ -67,16 +111,10 @@ def extract_text_from_pdf(pdf_path: str) -> str:
             base_image = doc.extract_image(xref)
             image_bytes = base_image["image"]
             
-            # Convert image bytes to numpy array
-            nparr = np.frombuffer(image_bytes, np.uint8)
-            img_np = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            
             # Perform OCR on the image
             try:
-                result = ocr.ocr(img_np, cls=True)
-                if result and len(result) > 0:
-                    for line in result[0]:
-                        text += line[1][0] + "\n"  
+                for line in ocr_image(image_bytes):
+                    text += line + "\n"
             except Exception as e:
                 logger.error(f"Error processing image on page {page_num + 1}: {str(e)}")
                 continue
@@ -84,6 +122,7 @@ def extract_text_from_pdf(pdf_path: str) -> str:
     doc.close()
     return text
 
+@traced("chunk_text")
 def chunk_text(text: str, chunk_size: int = 500) -> List[str]:
     """Split text into chunks based on sentences."""
     sentences = sent_tokenize(text)
@@ -106,26 +145,46 @@ def chunk_text(text: str, chunk_size: int = 500) -> List[str]:
     
     return chunks
 
+@traced("generate_embeddings")
 def generate_embeddings(texts: List[str]) -> List[List[float]]:
     """Generate embeddings for text chunks using MiniLM model."""
-    embeddings = []
-    with torch.no_grad():
-        for text in texts:
-            inputs = tokenizer(text, return_tensors="pt", padding=True, truncation=True, max_length=512)
-            outputs = embedding_model(**inputs)
-            # Use mean pooling
-            attention_mask = inputs["attention_mask"]
-            token_embeddings = outputs.last_hidden_state
-            input_mask_expanded = attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
-            embedding = torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(input_mask_expanded.sum(1), min=1e-9)
-            embeddings.append(embedding[0].numpy().tolist())
-    return embeddings
-
-def get_similar_chunks(query: str, document_chunks: List[str], document_embeddings: List[List[float]], top_k: int = 5) -> List[str]:
-    """Find most similar chunks to the query using cosine similarity."""
-    query_embedding = generate_embeddings([query])[0]
-    similarities = cosine_similarity([query_embedding], document_embeddings)[0]
-    top_indices = np.argsort(similarities)[-top_k:][::-1]
+    return embed_texts(texts)
+
+def embedding_norms(embeddings: List[List[float]]) -> List[float]:
+    """L2 norm of each chunk embedding, stored with the document at ingest."""
+    if not embeddings:
+        return []
+    return np.linalg.norm(np.asarray(embeddings, dtype=np.float32), axis=1).tolist()
+
+def get_query_embedding(query: str) -> np.ndarray:
+    key = make_key(normalize_prompt(query))
+    embedding = query_embedding_cache.get(key)
+    if embedding is None:
+        embedding = query_embedding_flight.do(
+            key, lambda: np.asarray(generate_embeddings([query])[0], dtype=np.float32)
+        )
+        query_embedding_cache.set(key, embedding)
+    return embedding
+
+@traced("get_similar_chunks")
+def get_similar_chunks(query: str, document_chunks: List[str], document_embeddings: List[List[float]], top_k: int = 5,
+                       document_norms: Optional[List[float]] = None) -> List[str]:
+    """Find most similar chunks to the query using cosine similarity.
+
+    ``document_norms`` are the chunk norms saved at ingest; they are
+    recomputed only for documents saved without them.
+    """
+    if not document_chunks:
+        return []
+    query_embedding = get_query_embedding(query)
+    matrix = np.asarray(document_embeddings, dtype=np.float32)
+    norms = np.asarray(document_norms, dtype=np.float32) if document_norms else np.linalg.norm(matrix, axis=1)
+    denominator = np.maximum(norms * np.linalg.norm(query_embedding), 1e-9)
+    similarities = (matrix @ query_embedding) / denominator
+
+    k = min(top_k, len(similarities))
+    top_indices = np.argpartition(-similarities, k - 1)[:k]
+    top_indices = top_indices[np.argsort(-similarities[top_indices])]
     return [document_chunks[i] for i in top_indices]
 
 @gemini_retry()
@@ -147,7 +206,7 @@ def generate_summary(text: str, user_id: str) -> Tuple[bool, str]:
         Văn bản pháp lý/pháp luật:
         {text}
         """
-        response = model_2.generate_content(prompt)
+        response = gemini_generate(model_2, prompt)
         
         # Update metrics
         latency = time.time() - start_time
@@ -193,7 +252,7 @@ def extract_clauses(text:str, user_id: str) -> Tuple[bool, List[str]]:
     Văn bản pháp lý:
     {text}
     """
-    response = model_1.generate_content(prompt)
+    response = gemini_generate(model_1, prompt)
     pattern = r'</\w+>'
     tags = re.findall(pattern, response.text)
     tags.append("```xml")
@@ -233,7 +292,7 @@ def extract_clauses(text:str, user_id: str) -> Tuple[bool, List[str]]:
     Danh sách các từ không có dấu cần được thêm dấu:
     {clause_type}
     """
-    response_2 = model_2.generate_content(prompt_2)
+    response_2 = gemini_generate(model_2, prompt_2)
    
     pattern = r'</\w+>'
     tags = re.findall(pattern, response_2.text)
@@ -253,6 +312,33 @@ def extract_clauses(text:str, user_id: str) -> Tuple[bool, List[str]]:
     update_api_usage(user_id)
     return True, clause_list
 
+def build_chat_prompt(query: str, context_chunks: List[str]) -> str:
+    """Build the grounded chat prompt from the retrieved context chunks."""
+    context = "\n".join(context_chunks)
+    prompt = f"""
+    Bạn là một trợ lý AI chuyên về pháp luật Việt Nam. Chỉ sử dụng **ngữ cảnh được cung cấp** bên dưới để trả lời câu hỏi của người dùng một cách chính xác nhất có thể.
+
+    --- NGỮ CẢNH (trích từ văn bản pháp luật) ---
+    {context}
+    ---------------------------------------------
+
+    Trả lời câu hỏi bên dưới **dựa hoàn toàn vào ngữ cảnh trên**. Nếu câu hỏi không được đề cập rõ ràng trong ngữ cảnh, hãy nêu rõ rằng nội dung đó không có trong tài liệu.
+
+    Nếu câu hỏi đề cập đến quy định pháp luật liên quan nhưng không có trong ngữ cảnh, bạn có thể gợi ý người dùng tra cứu trên cổng thông tin pháp luật chính thức: https://thuvienphapluat.vn/
+
+    --- CÂU HỎI ---
+    {query}
+
+    --- HƯỚNG DẪN ---
+    - **Tuyệt đối không bịa đặt** quy định hoặc thông tin pháp luật.
+    - Nếu câu trả lời có thể được tìm thấy trong ngữ cảnh, hãy trích dẫn hoặc diễn giải lại một cách chính xác.
+    - Nếu nội dung nằm ngoài phạm vi của ngữ cảnh, hãy nêu rõ điều đó.
+    - Chỉ đề cập đến https://thuvienphapluat.vn nếu cần gợi ý tra cứu thêm.
+
+    **Chỉ trả lời bằng tiếng Việt**. Ghi câu trả lời bên dưới:
+    """
+    return prompt
+
 def generate_chat_response(query: str, context_chunks: List[str], user_id: str) -> Tuple[bool, str]:
     """Generate chat response using Gemini with context and rate limiting."""
     start_time = time.time()
@@ -264,31 +350,8 @@ def generate_chat_response(query: str, context_chunks: List[str], user_id: str)
             api_errors_total.inc()
             return False, message
         
-        context = "\n".join(context_chunks)
-        prompt = f"""
-        Bạn là một trợ lý AI chuyên về pháp luật Việt Nam. Chỉ sử dụng **ngữ cảnh được cung cấp** bên dưới để trả lời câu hỏi của người dùng một cách chính xác nhất có thể.
-
-        --- NGỮ CẢNH (trích từ văn bản pháp luật) ---
-        {context}
-        ---------------------------------------------
-
-        Trả lời câu hỏi bên dưới **dựa hoàn toàn vào ngữ cảnh trên**. Nếu câu hỏi không được đề cập rõ ràng trong ngữ cảnh, hãy nêu rõ rằng nội dung đó không có trong tài liệu.
-
-        Nếu câu hỏi đề cập đến quy định pháp luật liên quan nhưng không có trong ngữ cảnh, bạn có thể gợi ý người dùng tra cứu trên cổng thông tin pháp luật chính thức: https://thuvienphapluat.vn/
-
-        --- CÂU HỎI ---
-        {query}
-
-        --- HƯỚNG DẪN ---
-        - **Tuyệt đối không bịa đặt** quy định hoặc thông tin pháp luật.
-        - Nếu câu trả lời có thể được tìm thấy trong ngữ cảnh, hãy trích dẫn hoặc diễn giải lại một cách chính xác.
-        - Nếu nội dung nằm ngoài phạm vi của ngữ cảnh, hãy nêu rõ điều đó.
-        - Chỉ đề cập đến https://thuvienphapluat.vn nếu cần gợi ý tra cứu thêm.
-
-        **Chỉ trả lời bằng tiếng Việt**. Ghi câu trả lời bên dưới:
-        """
-
-        response = model_2.generate_content(prompt)
+        prompt = build_chat_prompt(query, context_chunks)
+        response = gemini_generate(model_2, prompt)
         
         # Update metrics
         latency = time.time() - start_time
@@ -300,6 +363,41 @@ def generate_chat_response(query: str, context_chunks: List[str], user_id: str)
         api_errors_total.inc()
         raise e
 
+def stream_chat_response(query: str, context_chunks: List[str], user_id: str) -> Tuple[bool, Union[str, Iterator[str]]]:
+    """Stream a chat response from Gemini chunk by chunk, with rate limiting.
+
+    Returns ``(False, message)`` when the user is rate limited, otherwise
+    ``(True, chunks)`` where ``chunks`` yields text as the model produces it.
+    Latency and API usage are recorded once the stream is fully consumed.
+    """
+    can_proceed, message = check_api_usage(user_id)
+    if not can_proceed:
+        api_calls_total.inc()
+        api_errors_total.inc()
+        return False, message
+    return True, _stream_chat_chunks(build_chat_prompt(query, context_chunks), user_id)
+
+def _stream_chat_chunks(prompt: str, user_id: str) -> Iterator[str]:
+    start_time = time.time()
+    api_calls_total.inc()
+    failed = False
+
+    try:
+        response = gemini_generate(model_2, prompt, stream=True)
+        for chunk in response:
+            if chunk.text:
+                yield chunk.text
+    except Exception as e:
+        failed = True
+        api_errors_total.inc()
+        raise e
+    finally:
+        # Runs on completion and when the client disconnects (generator closed)
+        if not failed:
+            latency = time.time() - start_time
+            api_latency_seconds.observe(latency)
+            update_api_usage(user_id)
+
 api_calls_total = Counter('api_calls_total', 'Total number of API calls')
 api_errors_total = Counter('api_errors_total', 'Total number of API errors')
 api_latency_seconds = Histogram('api_latency_seconds', 'API latency in seconds') 
\ No newline at end of file
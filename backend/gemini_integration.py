@@ -1,10 +1,13 @@
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, AsyncIterator
 from gemini_monitoring import (
     api_calls_total,
     api_latency_seconds, api_errors_total, token_usage_total, GeminiMonitor
 )
 from gemini_metrics import GeminiMetrics
+from single_flight import SingleFlight, make_key, normalize_prompt
 from dotenv import load_dotenv
+from starlette.concurrency import iterate_in_threadpool
+import asyncio
 import os
 import time
 import logging
@@ -19,15 +22,61 @@ class GeminiService:
         if not api_key:
             raise ValueError("GEMINI_API_KEY environment variable is not set")
         self.monitor = GeminiMonitor(api_key=api_key)
-    
+        self.flight = SingleFlight("gemini_service")
+
+    async def _generate(self, prompt: str) -> Dict[str, Any]:
+        """Run the blocking Gemini call off the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.monitor.generate_with_metrics, prompt)
+
+    async def _stream(self, prompt: str) -> AsyncIterator[Dict[str, Any]]:
+        """Relay streamed Gemini events and record metrics when the stream ends."""
+        start_time = time.time()
+        events = self.monitor.stream_with_metrics(prompt)
+        final = None
+
+        try:
+            async for event in iterate_in_threadpool(events):
+                if event["type"] != "token":
+                    final = event
+                yield event
+        finally:
+            try:
+                events.close()
+            except ValueError:
+                # Still running in the worker thread; it is dropped once that finishes
+                pass
+
+            # stream_with_metrics already observed api_latency_seconds for a finished stream
+            if final is None:
+                final = {"text": None, "status": "cancelled", "error": "Client disconnected"}
+            if final.get("token_usage"):
+                token_usage_total.inc(final["token_usage"])
+
+            # Only queues the record for the buffered writer, so it is cheap on the event loop
+            GeminiMetrics.save_api_call(
+                prompt=prompt,
+                response=final["text"],
+                metrics={},
+                latency=final.get("latency", time.time() - start_time),
+                status=final["status"],
+                error=final.get("error"),
+                token_usage=final.get("token_usage")
+            )
+
     async def generate_summary(self, text: str, reference: Optional[str] = None) -> Dict[str, Any]:
+        """Generate a summary, sharing the result with identical in-flight requests."""
+        key = make_key("summary", normalize_prompt(text), normalize_prompt(reference))
+        return await self.flight.do_async(key, self._generate_summary, text, reference)
+
+    async def _generate_summary(self, text: str, reference: Optional[str] = None) -> Dict[str, Any]:
         """Generate a summary using Gemini with monitoring."""
         start_time = time.time()
         api_calls_total.inc()
         
         try:
             prompt = f"Please provide a concise summary of the following text:\n\n{text}"
-            result = self.monitor.generate_with_metrics(prompt)
+            result = await self._generate(prompt)
 
             # Update metrics
             latency = time.time() - start_time
@@ -60,12 +109,17 @@ class GeminiService:
             raise e
     
     async def chat(self, message: str) -> Dict[str, Any]:
+        """Process a chat message, sharing the result with identical in-flight requests."""
+        key = make_key("chat", normalize_prompt(message))
+        return await self.flight.do_async(key, self._chat, message)
+
+    async def _chat(self, message: str) -> Dict[str, Any]:
         """Process a chat message using Gemini with monitoring."""
         start_time = time.time()
         api_calls_total.inc()
         
         try:
-            result = self.monitor.generate_with_metrics(prompt=message)
+            result = await self._generate(message)
             
             # Update metrics
             latency = time.time() - start_time
@@ -98,4 +152,13 @@ class GeminiService:
             logger.error(f"Error in chat: {e}")
             raise e
 
+    def stream_summary(self, text: str, reference: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Stream a summary as it is generated."""
+        prompt = f"Please provide a concise summary of the following text:\n\n{text}"
+        return self._stream(prompt)
+
+    def stream_chat(self, message: str) -> AsyncIterator[Dict[str, Any]]:
+        """Stream a chat reply as it is generated."""
+        return self._stream(message)
+
 gemini_service = GeminiService() 
\ No newline at end of file
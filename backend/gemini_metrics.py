@@ -1,17 +1,259 @@
-from pymongo import MongoClient
 import os
-from datetime import datetime
-from typing import Dict, Any, Optional
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, Optional, List
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pagination import keyset_page
+from mongo import db
+from prometheus_client import Counter, Gauge
+from collections import deque
+import atexit
+import hashlib
+import random
+import threading
 import time
 import logging
 
 logger = logging.getLogger(__name__)
 
-# MongoDB connection
-MONGO_URI = os.getenv("MONGO_URI")
-client = MongoClient(MONGO_URI)
-db = client.legal_doc_db
+# MongoDB collections on the shared process-wide client
 gemini_metrics = db.gemini_metrics
+gemini_metrics_rollups = db.gemini_metrics_rollups
+
+# Fraction of successful calls queued for background quality evaluation
+EVAL_SAMPLE_RATE = float(os.getenv("GEMINI_EVAL_SAMPLE_RATE", "0.1"))
+# A claimed evaluation older than this is assumed lost with its worker and queued again
+EVAL_CLAIM_STALE_SECONDS = int(os.getenv("GEMINI_EVAL_CLAIM_STALE_SECONDS", "1800"))
+
+SCORE_NAMES = ['relevance', 'accuracy', 'completeness', 'toxicity', 'factuality', 'grammar']
+
+# Light fields returned by list views of recent calls
+RECENT_METRICS_PROJECTION = {
+    "timestamp": 1, "latency": 1, "status": 1, "token_usage": 1, "error": 1,
+    "evaluation_status": 1, "prompt_chars": 1, "response_chars": 1,
+    **{f"{name}_score": 1 for name in SCORE_NAMES}
+}
+
+# Buffered writer settings
+METRICS_BATCH_SIZE = int(os.getenv("GEMINI_METRICS_BATCH_SIZE", "100"))
+METRICS_FLUSH_INTERVAL = float(os.getenv("GEMINI_METRICS_FLUSH_INTERVAL", "5.0"))
+METRICS_MAX_QUEUE = int(os.getenv("GEMINI_METRICS_MAX_QUEUE", "10000"))
+
+# How prompt/response bodies are stored: full | truncate | hash
+METRICS_BODY_MODE = os.getenv("GEMINI_METRICS_BODY_MODE", "full")
+METRICS_MAX_BODY_CHARS = int(os.getenv("GEMINI_METRICS_MAX_BODY_CHARS", "4000"))
+
+METRICS_DROPPED = Counter(
+    'gemini_metrics_dropped_total',
+    'Gemini metric records dropped before reaching MongoDB',
+    ['reason']
+)
+METRICS_QUEUE_SIZE = Gauge(
+    'gemini_metrics_queue_size',
+    'Gemini metric records waiting to be written to MongoDB',
+    multiprocess_mode='livesum'
+)
+
+def compact_body(text: Optional[str]) -> tuple[Optional[str], Optional[str]]:
+    """Return the body to store and its SHA-256 according to ``METRICS_BODY_MODE``."""
+    if text is None:
+        return None, None
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    if METRICS_BODY_MODE == "hash":
+        return None, digest
+    if METRICS_BODY_MODE == "truncate" and len(text) > METRICS_MAX_BODY_CHARS:
+        return text[:METRICS_MAX_BODY_CHARS], digest
+    return text, digest
+
+# Pre-aggregated rollups: one document per (granularity, bucket) plus a running total
+ROLLUP_GRANULARITIES = ['minute', 'hour', 'day']
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0]  # upper bounds, seconds
+
+def as_utc(timestamp: Optional[datetime]) -> Optional[datetime]:
+    """Convert an aware datetime to the naive UTC form stored in MongoDB."""
+    if timestamp is None or timestamp.tzinfo is None:
+        return timestamp
+    return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+def bucket_start(timestamp: datetime, granularity: str) -> datetime:
+    if granularity == 'minute':
+        return timestamp.replace(second=0, microsecond=0)
+    if granularity == 'hour':
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def _rollup_ids(timestamp: datetime) -> List[tuple]:
+    ids = [("total", "total", None)]
+    for granularity in ROLLUP_GRANULARITIES:
+        start = bucket_start(timestamp, granularity)
+        ids.append((f"{granularity}:{start.isoformat()}", granularity, start))
+    return ids
+
+def _latency_bucket(latency: float) -> int:
+    for i, bound in enumerate(LATENCY_BUCKETS):
+        if latency <= bound:
+            return i
+    return len(LATENCY_BUCKETS)
+
+def _score_increments(scores: Dict[str, Any]) -> Dict[str, float]:
+    inc = {}
+    for name in SCORE_NAMES:
+        value = scores.get(name) if scores else None
+        if value is not None:
+            inc[f"score_sum.{name}"] = value
+            inc[f"score_count.{name}"] = 1
+    return inc
+
+def _call_increments(document: Dict[str, Any]) -> Dict[str, float]:
+    latency = document.get("latency") or 0.0
+    inc = {
+        "count": 1,
+        "success_count": 1 if document.get("status") == "success" else 0,
+        "latency_sum": latency,
+        "token_usage_sum": document.get("token_usage") or 0,
+        f"latency_hist.{_latency_bucket(latency)}": 1
+    }
+    inc.update(_score_increments(document.get("metrics")))
+    return inc
+
+def apply_rollups(increments: List[tuple]):
+    """Merge ``(timestamp, $inc fields)`` pairs into the rollup documents with one bulk write."""
+    merged = {}
+    for timestamp, inc in increments:
+        for rollup_id, granularity, start in _rollup_ids(timestamp):
+            entry = merged.setdefault(rollup_id, (granularity, start, {}))
+            for field, value in inc.items():
+                entry[2][field] = entry[2].get(field, 0) + value
+
+    if not merged:
+        return
+    gemini_metrics_rollups.bulk_write([
+        UpdateOne(
+            {"_id": rollup_id},
+            {"$inc": inc, "$setOnInsert": {"granularity": granularity, "bucket": start}},
+            upsert=True
+        )
+        for rollup_id, (granularity, start, inc) in merged.items()
+    ], ordered=False)
+
+def _latency_percentile(histogram: List[int], total: int, q: float) -> Optional[float]:
+    """Estimate a latency percentile by interpolating inside histogram buckets."""
+    if total == 0:
+        return None
+    rank = q * total
+    seen = 0
+    for i, count in enumerate(histogram):
+        if count and seen + count >= rank:
+            lower = LATENCY_BUCKETS[i - 1] if i > 0 else 0.0
+            if i == len(LATENCY_BUCKETS):
+                return lower
+            return lower + (LATENCY_BUCKETS[i] - lower) * (rank - seen) / count
+        seen += count
+    return LATENCY_BUCKETS[-1]
+
+def summarize_rollups(rollups: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Combine rollup documents into call counts, averages and latency percentiles."""
+    total_calls = sum(r.get("count", 0) for r in rollups)
+    success_calls = sum(r.get("success_count", 0) for r in rollups)
+    latency_sum = sum(r.get("latency_sum", 0) for r in rollups)
+    histogram = [
+        sum(r.get("latency_hist", {}).get(str(i), 0) for r in rollups)
+        for i in range(len(LATENCY_BUCKETS) + 1)
+    ]
+
+    average_scores = {}
+    for name in SCORE_NAMES:
+        score_sum = sum(r.get("score_sum", {}).get(name, 0) for r in rollups)
+        score_count = sum(r.get("score_count", {}).get(name, 0) for r in rollups)
+        average_scores[name] = score_sum / score_count if score_count else None
+
+    return {
+        "total_calls": total_calls,
+        "success_rate": success_calls / total_calls if total_calls > 0 else 0,
+        "average_latency": latency_sum / total_calls if total_calls > 0 else None,
+        "latency_percentiles": {
+            "p50": _latency_percentile(histogram, total_calls, 0.5),
+            "p90": _latency_percentile(histogram, total_calls, 0.9),
+            "p99": _latency_percentile(histogram, total_calls, 0.99)
+        },
+        "total_tokens": sum(r.get("token_usage_sum", 0) for r in rollups),
+        "average_scores": average_scores
+    }
+
+def _write_rollups(documents: List[Dict[str, Any]]):
+    try:
+        apply_rollups([(doc["timestamp"], _call_increments(doc)) for doc in documents])
+    except Exception as e:
+        logger.error(f"Error updating metrics rollups: {e}")
+
+class BufferedMetricsWriter:
+    """Batch inserts into a collection from a background thread.
+
+    Records are written with ``insert_many`` once ``batch_size`` are queued
+    or every ``flush_interval`` seconds, and each written batch is passed to
+    ``after_write``. A full queue drops new records instead of blocking.
+    """
+
+    def __init__(self, collection, batch_size: int, flush_interval: float, max_queue: int, after_write=None):
+        self.collection = collection
+        self.after_write = after_write
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+
+    def add(self, document: Dict[str, Any]) -> bool:
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                METRICS_DROPPED.labels(reason="overflow").inc()
+                return False
+            self._queue.append(document)
+            METRICS_QUEUE_SIZE.set(len(self._queue))
+            self._ensure_thread()
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify()
+        return True
+
+    def _ensure_thread(self):
+        # Started lazily, and again in forked worker processes
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="gemini-metrics-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self._queue) < self.batch_size:
+                    self._cond.wait(timeout=self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Write every queued record now."""
+        with self._cond:
+            batch = list(self._queue)
+            self._queue.clear()
+            METRICS_QUEUE_SIZE.set(0)
+
+        for i in range(0, len(batch), self.batch_size):
+            chunk = batch[i:i + self.batch_size]
+            try:
+                self.collection.insert_many(chunk, ordered=False)
+            except Exception as e:
+                logger.error(f"Error writing {len(chunk)} metrics to MongoDB: {e}")
+                METRICS_DROPPED.labels(reason="write_error").inc(len(chunk))
+                continue
+            if self.after_write is not None:
+                self.after_write(chunk)
+
+metrics_writer = BufferedMetricsWriter(
+    gemini_metrics, METRICS_BATCH_SIZE, METRICS_FLUSH_INTERVAL, METRICS_MAX_QUEUE,
+    after_write=_write_rollups
+)
+atexit.register(metrics_writer.flush)
 
 class GeminiMetrics:
     @staticmethod
@@ -24,87 +266,192 @@ class GeminiMetrics:
         error: Optional[str] = None,
         token_usage: Optional[int] = None
     ):
-        """Save a Gemini API call and its metrics to MongoDB."""
+        """Queue a Gemini API call and its metrics for a buffered write to MongoDB.
+
+        Calls without evaluation scores are sampled at ``EVAL_SAMPLE_RATE``
+        and marked ``pending`` for the background evaluation task. When the
+        stored response is compacted, the full one is kept in
+        ``evaluation_input`` until it has been scored.
+        """
         try:
+            stored_prompt, prompt_hash = compact_body(prompt)
+            stored_response, response_hash = compact_body(response)
+
+            if status != "success":
+                # Failed calls carry no quality scores, so they never drag the averages down
+                metrics = {}
+            if metrics:
+                evaluation_status = "done"
+            elif status == "success" and response and random.random() < EVAL_SAMPLE_RATE:
+                evaluation_status = "pending"
+            else:
+                evaluation_status = "skipped"
+
             document = {
                 "timestamp": datetime.utcnow(),
-                "prompt": prompt,
-                "response": response,
+                "prompt": stored_prompt,
+                "response": stored_response,
+                "prompt_sha256": prompt_hash,
+                "response_sha256": response_hash,
+                "prompt_chars": len(prompt) if prompt is not None else None,
+                "response_chars": len(response) if response is not None else None,
                 "metrics": metrics,
                 "latency": latency,
                 "status": status,
                 "token_usage": token_usage,
                 "error": error,
-                # Add evaluation metrics
-                "relevance_score": metrics.get('relevance', 0),
-                "accuracy_score": metrics.get('accuracy', 0),
-                "completeness_score": metrics.get('completeness', 0),
-                "toxicity_score": metrics.get('toxicity', 0),
-                "factuality_score": metrics.get('factuality', 0),
-                "grammar_score": metrics.get('grammar', 0)
+                "evaluation_status": evaluation_status,
+                # Add evaluation metrics (None until evaluated, ignored by $avg)
+                **GeminiMetrics._score_fields(metrics)
             }
-            gemini_metrics.insert_one(document)
-            logger.info(f"Saved metrics to MongoDB: {metrics}")
+            if evaluation_status == "pending" and stored_response != response:
+                # The evaluator needs the whole response; kept only until it is scored
+                document["evaluation_input"] = response
+            metrics_writer.add(document)
         except Exception as e:
             logger.error(f"Error saving metrics to MongoDB: {e}")
 
     @staticmethod
-    def get_recent_metrics(limit: int = 100) -> list:
-        """Get recent metrics from MongoDB."""
+    def flush():
+        """Write any buffered API call records to MongoDB."""
+        metrics_writer.flush()
+
+    @staticmethod
+    def _score_fields(metrics: Dict[str, float]) -> Dict[str, Optional[float]]:
+        return {f"{name}_score": metrics.get(name) for name in SCORE_NAMES}
+
+    @staticmethod
+    def claim_pending_evaluations(limit: int) -> List[Dict[str, Any]]:
+        """Atomically claim up to ``limit`` records awaiting evaluation.
+
+        Claims older than ``EVAL_CLAIM_STALE_SECONDS`` go back to ``pending`` first.
+        """
+        claimed = []
+        try:
+            now = datetime.utcnow()
+            requeued = gemini_metrics.update_many(
+                {
+                    "evaluation_status": "in_progress",
+                    # Also matches claims recorded before claimed_at existed
+                    "evaluation_claimed_at": {"$not": {"$gte": now - timedelta(seconds=EVAL_CLAIM_STALE_SECONDS)}}
+                },
+                {"$set": {"evaluation_status": "pending"}}
+            )
+            if requeued.modified_count:
+                logger.warning(f"Requeued {requeued.modified_count} stale Gemini evaluations")
+
+            for _ in range(limit):
+                record = gemini_metrics.find_one_and_update(
+                    {"evaluation_status": "pending"},
+                    {"$set": {"evaluation_status": "in_progress", "evaluation_claimed_at": now}},
+                    projection={"response": 1, "evaluation_input": 1, "timestamp": 1},
+                    sort=[("timestamp", 1)],
+                    return_document=ReturnDocument.AFTER
+                )
+                if record is None:
+                    break
+                claimed.append(record)
+        except Exception as e:
+            logger.error(f"Error claiming pending evaluations: {e}")
+        return claimed
+
+    @staticmethod
+    def save_evaluation(record_id: ObjectId, scores: Optional[Dict[str, float]], timestamp: Optional[datetime] = None):
+        """Write evaluation scores back to a recorded API call.
+
+        ``None`` marks the evaluation as failed. When the call's ``timestamp``
+        is given the scores are also added to its rollup buckets.
+        """
+        try:
+            if scores is None:
+                update = {"$set": {"evaluation_status": "failed"}}
+            else:
+                update = {"$set": {
+                    "metrics": scores,
+                    "evaluation_status": "done",
+                    "evaluated_at": datetime.utcnow(),
+                    **GeminiMetrics._score_fields(scores)
+                }}
+            update["$unset"] = {"evaluation_input": ""}
+            gemini_metrics.update_one({"_id": record_id}, update)
+            if scores is not None and timestamp is not None:
+                apply_rollups([(timestamp, _score_increments(scores))])
+        except Exception as e:
+            logger.error(f"Error saving evaluation to MongoDB: {e}")
+
+    @staticmethod
+    def get_recent_metrics(limit: int = 100, cursor: Optional[str] = None, include_bodies: bool = False) -> tuple[list, Optional[str]]:
+        """Get one page of recent metrics from MongoDB and the next page cursor.
+
+        Prompt and response bodies are only loaded when ``include_bodies`` is set.
+        """
+        projection = None if include_bodies else RECENT_METRICS_PROJECTION
         try:
-            return list(gemini_metrics.find().sort("timestamp", -1).limit(limit))
+            records, next_cursor = keyset_page(gemini_metrics, {}, "timestamp", limit, cursor, projection)
+        except ValueError:
+            raise
         except Exception as e:
             logger.error(f"Error retrieving metrics from MongoDB: {e}")
+            return [], None
+
+        for record in records:
+            record["_id"] = str(record["_id"])
+            record["timestamp"] = record["timestamp"].isoformat()
+            record.pop("evaluated_at", None)
+        return records, next_cursor
+
+    @staticmethod
+    def get_rollups(granularity: str, start: datetime, end: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        """Get rollup buckets of one granularity overlapping ``[start, end)``."""
+        start, end = as_utc(start), as_utc(end)
+        query = {"granularity": granularity, "bucket": {"$gte": bucket_start(start, granularity)}}
+        if end is not None:
+            query["bucket"]["$lt"] = end
+        try:
+            return list(gemini_metrics_rollups.find(query, {"_id": 0}).sort("bucket", 1))
+        except Exception as e:
+            logger.error(f"Error retrieving metrics rollups from MongoDB: {e}")
             return []
 
     @staticmethod
-    def get_metrics_summary() -> Dict[str, Any]:
-        """Get summary statistics of metrics."""
+    def get_metrics_summary(start: Optional[datetime] = None, end: Optional[datetime] = None) -> Dict[str, Any]:
+        """Get summary statistics of metrics from the pre-aggregated rollups.
+
+        Without a range this reads the single running-total document. With a
+        range it reads the coarsest buckets that fit it (minute up to 2 hours,
+        hour up to 7 days, day beyond), so the cost does not grow with history.
+        """
         try:
-            total_calls = gemini_metrics.count_documents({})
-            success_calls = gemini_metrics.count_documents({"status": "success"})
-            
-            # Calculate average scores
-            avg_scores = gemini_metrics.aggregate([
-                {
-                    "$group": {
-                        "_id": None,
-                        "avg_relevance": {"$avg": "$relevance_score"},
-                        "avg_accuracy": {"$avg": "$accuracy_score"},
-                        "avg_completeness": {"$avg": "$completeness_score"},
-                        "avg_toxicity": {"$avg": "$toxicity_score"},
-                        "avg_factuality": {"$avg": "$factuality_score"},
-                        "avg_grammar": {"$avg": "$grammar_score"},
-                        "avg_latency": {"$avg": "$latency"}
-                    }
-                }
-            ]).next()
-            
-            return {
-                "total_calls": total_calls,
-                "success_rate": success_calls / total_calls if total_calls > 0 else 0,
-                "average_latency": avg_scores["avg_latency"],
-                "average_scores": {
-                    "relevance": avg_scores["avg_relevance"],
-                    "accuracy": avg_scores["avg_accuracy"],
-                    "completeness": avg_scores["avg_completeness"],
-                    "toxicity": avg_scores["avg_toxicity"],
-                    "factuality": avg_scores["avg_factuality"],
-                    "grammar": avg_scores["avg_grammar"]
-                }
-            }
+            start, end = as_utc(start), as_utc(end)
+            if start is None:
+                total = gemini_metrics_rollups.find_one({"_id": "total"})
+                rollups = [total] if total else []
+            else:
+                span = (end or datetime.utcnow()) - start
+                if span <= timedelta(hours=2):
+                    granularity = "minute"
+                elif span <= timedelta(days=7):
+                    granularity = "hour"
+                else:
+                    granularity = "day"
+                rollups = GeminiMetrics.get_rollups(granularity, start, end)
+            return summarize_rollups(rollups)
         except Exception as e:
             logger.error(f"Error calculating metrics summary: {e}")
-            return {
-                "total_calls": 0,
-                "success_rate": 0,
-                "average_latency": 0,
-                "average_scores": {
-                    "relevance": 0,
-                    "accuracy": 0,
-                    "completeness": 0,
-                    "toxicity": 0,
-                    "factuality": 0,
-                    "grammar": 0
-                }
-            } 
\ No newline at end of file
+            return summarize_rollups([])
+
+    @staticmethod
+    def rebuild_rollups(batch_size: int = 1000):
+        """Recompute every rollup from the raw gemini_metrics records.
+
+        Used to backfill history recorded before rollups existed.
+        """
+        gemini_metrics_rollups.delete_many({})
+        batch = []
+        cursor = gemini_metrics.find({}, {"timestamp": 1, "status": 1, "latency": 1, "token_usage": 1, "metrics": 1})
+        for document in cursor:
+            batch.append((document["timestamp"], _call_increments(document)))
+            if len(batch) >= batch_size:
+                apply_rollups(batch)
+                batch = []
+        apply_rollups(batch)
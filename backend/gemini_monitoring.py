@@ -1,19 +1,27 @@
 from prometheus_client import Counter, Gauge, Histogram
 import time
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Iterator, List
 import google.generativeai as genai
 import logging
 import json
 
 logger = logging.getLogger(__name__)
 
-# Initialize metrics
-relevance_score = Gauge('gemini_relevance_score', 'Relevance score (1-10) for Gemini responses')
-accuracy_score = Gauge('gemini_accuracy_score', 'Accuracy score (1-10) for Gemini responses')
-completeness_score = Gauge('gemini_completeness_score', 'Completeness score (1-10) for Gemini responses')
-toxicity_score = Gauge('gemini_toxicity_score', 'Toxicity score (1-10) for Gemini responses')
-factuality_score = Gauge('gemini_factuality_score', 'Factuality score (1-10) for Gemini responses')
-grammar_score = Gauge('gemini_grammar_score', 'Grammar & fluency score (1-10) for Gemini responses')
+# Initialize metrics; the latest evaluation from any worker process wins
+relevance_score = Gauge('gemini_relevance_score', 'Relevance score (1-10) for Gemini responses', multiprocess_mode='mostrecent')
+accuracy_score = Gauge('gemini_accuracy_score', 'Accuracy score (1-10) for Gemini responses', multiprocess_mode='mostrecent')
+completeness_score = Gauge('gemini_completeness_score', 'Completeness score (1-10) for Gemini responses', multiprocess_mode='mostrecent')
+toxicity_score = Gauge('gemini_toxicity_score', 'Toxicity score (1-10) for Gemini responses', multiprocess_mode='mostrecent')
+factuality_score = Gauge('gemini_factuality_score', 'Factuality score (1-10) for Gemini responses', multiprocess_mode='mostrecent')
+grammar_score = Gauge('gemini_grammar_score', 'Grammar & fluency score (1-10) for Gemini responses', multiprocess_mode='mostrecent')
+SCORE_GAUGES = {
+    'relevance': relevance_score,
+    'accuracy': accuracy_score,
+    'completeness': completeness_score,
+    'toxicity': toxicity_score,
+    'factuality': factuality_score,
+    'grammar': grammar_score
+}
 api_calls_total = Counter('gemini_api_calls_total', 'Total number of Gemini API calls', ['status'])
 api_latency_seconds = Histogram('gemini_api_latency_seconds', 'Latency of Gemini API calls in seconds')
 api_errors_total = Counter('gemini_api_errors_total', 'Total number of Gemini API errors')
@@ -26,16 +34,26 @@ class GeminiMonitor:
         self.model = genai.GenerativeModel('gemini-1.5-flash')
         
     def _evaluate_response(self, text: str) -> Dict[str, float]:
-        """Use Gemini to evaluate its own response."""
+        """Use Gemini to evaluate a single response."""
+        return self.evaluate_batch([text])[0]
+
+    def evaluate_batch(self, texts: List[str]) -> List[Dict[str, float]]:
+        """Use Gemini to evaluate several responses with a single prompt.
+
+        Returns one score dict per input text, in order. Texts that cannot be
+        scored get the default (all zero) scores.
+        """
         try:
-            if not text or not isinstance(text, str):
+            if not texts or not all(text and isinstance(text, str) for text in texts):
                 logger.error("Invalid text for evaluation")
-                return self._get_default_scores()
+                return [self._get_default_scores() for _ in texts]
 
-            evaluation_prompt = f"""Evaluate this response based on the following criteria. Rate each from 1 to 10:
+            responses = "\n\n".join(
+                f"### Response {i + 1}\n{text}" for i, text in enumerate(texts)
+            )
+            evaluation_prompt = f"""Evaluate each of the following {len(texts)} responses based on the following criteria. Rate each from 1 to 10:
 
-Response to evaluate:
-{text}
+{responses}
 
 Please provide scores for:
 1. Relevance (how well it addresses the topic)
@@ -45,40 +63,46 @@ Please provide scores for:
 5. Factuality (how factual and well-supported the claims are)
 6. Grammar & fluency (how well-written and clear the text is)
 
-Provide the scores in JSON format like this:
-{{
-    "relevance": 8,
-    "accuracy": 7,
-    "completeness": 9,
-    "toxicity": 1,
-    "factuality": 8,
-    "grammar": 9
-}}"""
+Provide the scores as a JSON array with one object per response, in the same order, like this:
+[
+    {{
+        "relevance": 8,
+        "accuracy": 7,
+        "completeness": 9,
+        "toxicity": 1,
+        "factuality": 8,
+        "grammar": 9
+    }}
+]"""
 
             evaluation = self.model.generate_content(evaluation_prompt)
 
             try:
-                # Extract JSON from the response
-                scores = json.loads(evaluation.text)
-                
-                # Update Prometheus metrics
-                relevance_score.set(scores.get('relevance', 0))
-                accuracy_score.set(scores.get('accuracy', 0))
-                completeness_score.set(scores.get('completeness', 0))
-                toxicity_score.set(scores.get('toxicity', 0))
-                factuality_score.set(scores.get('factuality', 0))
-                grammar_score.set(scores.get('grammar', 0))
-                
+                # Extract JSON from the response, tolerating markdown fences
+                raw = evaluation.text.strip().strip('`')
+                if raw.startswith('json'):
+                    raw = raw[4:]
+                scores = json.loads(raw)
+                if isinstance(scores, dict):
+                    scores = [scores]
+                if not isinstance(scores, list) or len(scores) != len(texts):
+                    logger.error("Evaluation returned an unexpected number of scores")
+                    return [self._get_default_scores() for _ in texts]
+
+                # Update Prometheus metrics with the batch averages
+                for name, gauge in SCORE_GAUGES.items():
+                    gauge.set(sum(s.get(name, 0) for s in scores) / len(scores))
+
                 logger.info(f"Evaluation scores: {scores}")
                 return scores
-                
+
             except json.JSONDecodeError:
                 logger.error("Failed to parse evaluation scores as JSON")
-                return self._get_default_scores()
-                
+                return [self._get_default_scores() for _ in texts]
+
         except Exception as e:
             logger.error(f"Error in self-evaluation: {str(e)}")
-            return self._get_default_scores()
+            return [self._get_default_scores() for _ in texts]
     
     def _get_default_scores(self) -> Dict[str, float]:
         """Return default scores when evaluation fails."""
@@ -103,21 +127,11 @@ Provide the scores in JSON format like this:
             api_latency_seconds.observe(latency)
             api_calls_total.labels(status=status).inc()
             
-            evaluation_scores = self._evaluate_response(response.text)
-            
-            # Update Prometheus gauges
-            relevance_score.set(evaluation_scores.get('relevance', 0))
-            accuracy_score.set(evaluation_scores.get('accuracy', 0))
-            completeness_score.set(evaluation_scores.get('completeness', 0))
-            toxicity_score.set(evaluation_scores.get('toxicity', 0))
-            factuality_score.set(evaluation_scores.get('factuality', 0))
-            grammar_score.set(evaluation_scores.get('grammar', 0))
-            
-            logger.info(f"Updated metrics: {evaluation_scores}")
-            
+            # Quality scores are filled in later by the sampled background
+            # evaluation (tasks.evaluate_pending_responses)
             return {
                 'text': response.text,
-                'metrics': evaluation_scores,
+                'metrics': {},
                 'latency': latency,
                 'status': status,
                 'token_usage': getattr(response.usage, 'total_tokens', None) if hasattr(response, 'usage') else None
@@ -127,11 +141,52 @@ Provide the scores in JSON format like this:
             api_errors_total.inc()
             api_calls_total.labels(status=status).inc()
             logger.error(f"Error in Gemini API call: {str(e)}")
+            # No scores: the call is stored as skipped and stays out of the score averages
             return {
                 'text': None,
-                'metrics': self._get_default_scores(),
+                'metrics': {},
                 'latency': time.time() - start_time,
                 'status': status,
                 'error': str(e)
             }
 
+    def stream_with_metrics(self, prompt: str) -> Iterator[Dict[str, Any]]:
+        """Stream text from Gemini as it is generated.
+
+        Yields ``{'type': 'token', 'text': ...}`` events followed by a single
+        ``'done'`` or ``'error'`` event carrying the full text, latency,
+        status and token usage.
+        """
+        start_time = time.time()
+        parts = []
+
+        try:
+            response = self.model.generate_content(prompt, stream=True)
+            for chunk in response:
+                if chunk.text:
+                    parts.append(chunk.text)
+                    yield {'type': 'token', 'text': chunk.text}
+
+            latency = time.time() - start_time
+            api_latency_seconds.observe(latency)
+            api_calls_total.labels(status='success').inc()
+
+            usage = getattr(response, 'usage_metadata', None)
+            yield {
+                'type': 'done',
+                'text': ''.join(parts),
+                'latency': latency,
+                'status': 'success',
+                'token_usage': getattr(usage, 'total_token_count', None)
+            }
+        except Exception as e:
+            api_errors_total.inc()
+            api_calls_total.labels(status='error').inc()
+            logger.error(f"Error in Gemini streaming call: {str(e)}")
+            yield {
+                'type': 'error',
+                'text': ''.join(parts),
+                'latency': time.time() - start_time,
+                'status': 'error',
+                'error': str(e)
+            }
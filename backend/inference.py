@@ -0,0 +1,229 @@
+from typing import Dict, List, Optional
+import os
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "sentence-transformers/all-MiniLM-L6-v2")
+# Chunks per forward pass of the embedding model
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+# Intra-op threads for torch; 0 leaves the torch default (one per core)
+INFERENCE_TORCH_THREADS = int(os.getenv("INFERENCE_TORCH_THREADS", "0"))
+OCR_USE_GPU = os.getenv("OCR_USE_GPU", "false").lower() == "true"
+
+# torch: full-precision PyTorch; onnx: int8-quantized ONNX Runtime export of the same model
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", os.path.join("models", "onnx"))
+# Intra-op threads for ONNX Runtime; 0 uses every core
+ONNX_INTRA_OP_THREADS = int(os.getenv("ONNX_INTRA_OP_THREADS", "0"))
+# Largest allowed 1 - cosine(torch, onnx) over the parity sentences
+EMBEDDING_PARITY_MAX_DRIFT = float(os.getenv("EMBEDDING_PARITY_MAX_DRIFT", "0.02"))
+
+# Uploaded contracts are mostly Vietnamese, with some English; the check covers both
+PARITY_SENTENCES = [
+    "Hợp đồng này được điều chỉnh bởi pháp luật nước Cộng hòa Xã hội Chủ nghĩa Việt Nam.",
+    "Bên thuê có nghĩa vụ thanh toán tiền thuê nhà vào ngày đầu tiên của mỗi tháng.",
+    "Mỗi bên có quyền đơn phương chấm dứt hợp đồng với điều kiện thông báo bằng văn bản trước ba mươi (30) ngày.",
+    "Bên vi phạm phải bồi thường toàn bộ thiệt hại phát sinh cho bên bị vi phạm.",
+    "Thông tin bảo mật không bao gồm thông tin đã được công bố công khai.",
+    "Nếu bên mua chậm thanh toán thì phải chịu lãi suất như thế nào?",
+    "This Agreement shall be governed by the laws of the State of New York.",
+    "The Tenant shall pay rent on the first day of each calendar month.",
+    "Either party may terminate this Agreement upon thirty (30) days written notice.",
+    "The Contractor shall indemnify and hold harmless the Owner from all claims.",
+    "Confidential Information does not include information that is publicly available.",
+    "What happens if the buyer fails to pay on time?",
+]
+
+_lock = threading.Lock()
+_embedder = None
+_ocr = None
+
+class TorchEmbedder:
+    """MiniLM sentence embeddings with mean pooling, in padded batches."""
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL_NAME):
+        import torch
+        from transformers import AutoTokenizer, AutoModel
+        if INFERENCE_TORCH_THREADS > 0:
+            torch.set_num_threads(INFERENCE_TORCH_THREADS)
+        self.torch = torch
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModel.from_pretrained(model_name)
+        self.model.eval()
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        torch = self.torch
+        embeddings = []
+        with torch.no_grad():
+            # The attention mask keeps padding out of the mean
+            for start in range(0, len(texts), EMBED_BATCH_SIZE):
+                batch = texts[start:start + EMBED_BATCH_SIZE]
+                inputs = self.tokenizer(batch, return_tensors="pt", padding=True, truncation=True, max_length=512)
+                outputs = self.model(**inputs)
+                attention_mask = inputs["attention_mask"]
+                token_embeddings = outputs.last_hidden_state
+                input_mask_expanded = attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
+                embedding = torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(input_mask_expanded.sum(1), min=1e-9)
+                embeddings.extend(embedding.numpy().tolist())
+        return embeddings
+
+def _mean_pool(token_embeddings, attention_mask):
+    import numpy as np
+    mask = attention_mask[..., None].astype(np.float32)
+    return (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+def onnx_model_paths(model_dir: str = ONNX_MODEL_DIR) -> Dict[str, str]:
+    return {
+        "fp32": os.path.join(model_dir, "model.onnx"),
+        "int8": os.path.join(model_dir, "model.int8.onnx"),
+        "tokenizer": os.path.join(model_dir, "tokenizer"),
+    }
+
+def export_onnx(model_name: str = EMBEDDING_MODEL_NAME, model_dir: str = ONNX_MODEL_DIR) -> str:
+    """Export the embedding model to ONNX, quantize it to int8 and return its path."""
+    import torch
+    from transformers import AutoTokenizer, AutoModel
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    paths = onnx_model_paths(model_dir)
+    os.makedirs(model_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name)
+    model.eval()
+
+    sample = tokenizer(PARITY_SENTENCES[:2], return_tensors="pt", padding=True)
+    # Sequence length and batch size stay dynamic so any padded batch can run
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in ("input_ids", "attention_mask", "token_type_ids")}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (sample["input_ids"], sample["attention_mask"], sample["token_type_ids"]),
+            paths["fp32"],
+            input_names=["input_ids", "attention_mask", "token_type_ids"],
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=14
+        )
+    quantize_dynamic(paths["fp32"], paths["int8"], weight_type=QuantType.QInt8)
+    tokenizer.save_pretrained(paths["tokenizer"])
+    logger.info(f"Exported quantized ONNX embedding model to {paths['int8']}")
+    return paths["int8"]
+
+class OnnxEmbedder:
+    """The same embeddings as ``TorchEmbedder`` from an int8 ONNX Runtime model.
+
+    The model is exported and quantized on first use if ``ONNX_MODEL_DIR``
+    has no copy yet. Loading an exported model needs neither torch nor the
+    original weights.
+    """
+
+    def __init__(self, model_dir: str = ONNX_MODEL_DIR):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        paths = onnx_model_paths(model_dir)
+        if not os.path.exists(paths["int8"]):
+            export_onnx(model_dir=model_dir)
+            try:
+                logger.info(f"ONNX parity: {check_parity(model_dir=model_dir)}")
+            except ValueError:
+                # Do not leave a model that failed the check for the next start to pick up
+                os.remove(paths["int8"])
+                raise
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = ONNX_INTRA_OP_THREADS or os.cpu_count() or 1
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(paths["int8"], options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(paths["tokenizer"])
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        embeddings = []
+        for start in range(0, len(texts), EMBED_BATCH_SIZE):
+            batch = texts[start:start + EMBED_BATCH_SIZE]
+            inputs = self.tokenizer(batch, return_tensors="np", padding=True, truncation=True, max_length=512)
+            feed = {name: value.astype("int64") for name, value in inputs.items() if name in self.input_names}
+            token_embeddings = self.session.run(["last_hidden_state"], feed)[0]
+            embeddings.extend(_mean_pool(token_embeddings, inputs["attention_mask"]).tolist())
+        return embeddings
+
+EMBEDDERS = {"torch": TorchEmbedder, "onnx": OnnxEmbedder}
+
+def get_embedder():
+    """Load the embedding model on first use; processes that never embed never load it."""
+    global _embedder
+    if _embedder is None:
+        with _lock:
+            if _embedder is None:
+                if EMBEDDING_BACKEND not in EMBEDDERS:
+                    raise ValueError(f"Unknown EMBEDDING_BACKEND: {EMBEDDING_BACKEND}")
+                logger.info(f"Loading embedding model {EMBEDDING_MODEL_NAME} ({EMBEDDING_BACKEND})")
+                _embedder = EMBEDDERS[EMBEDDING_BACKEND]()
+    return _embedder
+
+def check_parity(texts: Optional[List[str]] = None, max_drift: float = EMBEDDING_PARITY_MAX_DRIFT,
+                 model_dir: str = ONNX_MODEL_DIR) -> Dict[str, float]:
+    """Compare ONNX against torch embeddings; raise if the cosine drift exceeds ``max_drift``."""
+    import numpy as np
+    texts = texts or PARITY_SENTENCES
+    reference = np.array(TorchEmbedder().embed(texts))
+    candidate = np.array(OnnxEmbedder(model_dir).embed(texts))
+    cosine = (reference * candidate).sum(axis=1) / (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1)
+    )
+    report = {"min_cosine": float(cosine.min()), "mean_cosine": float(cosine.mean()), "max_drift": float(1 - cosine.min())}
+    if report["max_drift"] > max_drift:
+        raise ValueError(f"ONNX embeddings drift {report['max_drift']:.4f} from torch (limit {max_drift})")
+    return report
+
+def sample_stored_chunks(limit: int = 50) -> List[str]:
+    """Random chunks of stored documents, for a parity check on real text."""
+    from mongo import db
+    cursor = db.documents.aggregate([
+        {"$match": {"chunks.0": {"$exists": True}}},
+        {"$sample": {"size": limit}},
+        {"$project": {"_id": 0, "chunk": {"$arrayElemAt": ["$chunks", 0]}}},
+    ])
+    return [doc["chunk"] for doc in cursor if doc.get("chunk")]
+
+def get_ocr():
+    global _ocr
+    if _ocr is None:
+        with _lock:
+            if _ocr is None:
+                from paddleocr import PaddleOCR
+                logger.info("Loading PaddleOCR")
+                _ocr = PaddleOCR(use_angle_cls=True, lang='en', use_gpu=OCR_USE_GPU)
+    return _ocr
+
+def embed_texts_local(texts: List[str]) -> List[List[float]]:
+    return get_embedder().embed(texts)
+
+def ocr_image_local(image_bytes: bytes) -> List[str]:
+    """Return the text lines PaddleOCR finds in an encoded image."""
+    import numpy as np
+    import cv2
+    nparr = np.frombuffer(image_bytes, np.uint8)
+    img_np = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    if img_np is None:
+        return []
+    result = get_ocr().ocr(img_np, cls=True)
+    lines: List[str] = []
+    if result and len(result) > 0 and result[0]:
+        for line in result[0]:
+            lines.append(line[1][0])
+    return lines
+
+if __name__ == "__main__":
+    # python inference.py [N]: export the quantized ONNX model and check it against torch,
+    # on N chunks sampled from stored documents as well as the built-in sentences
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    export_onnx()
+    sample = sample_stored_chunks(int(sys.argv[1])) if len(sys.argv) > 1 else []
+    print(check_parity(PARITY_SENTENCES + sample))
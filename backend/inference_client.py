@@ -0,0 +1,111 @@
+from multiprocessing.connection import Client
+from typing import Any, List
+from dotenv import load_dotenv
+import os
+import sys
+import threading
+import logging
+
+from inference import embed_texts_local, ocr_image_local
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# server: send embedding/OCR work to inference_server.py; local: load the models in this process
+INFERENCE_MODE = os.getenv("INFERENCE_MODE", "server")
+# Named pipe on Windows, Unix socket elsewhere; keep it local, the channel carries pickles
+INFERENCE_ADDRESS = os.getenv(
+    "INFERENCE_ADDRESS",
+    r"\\.\pipe\legal_doc_inference" if sys.platform == "win32" else "/tmp/legal_doc_inference.sock"
+)
+# Shared secret for the server and its clients; every deployment must set its own
+INFERENCE_AUTHKEY = os.getenv("INFERENCE_AUTHKEY", "").encode("utf-8")
+INFERENCE_TIMEOUT = float(os.getenv("INFERENCE_TIMEOUT", "120"))
+# Fall back to in-process models when the server is not running
+INFERENCE_LOCAL_FALLBACK = os.getenv("INFERENCE_LOCAL_FALLBACK", "true").lower() == "true"
+
+class InferenceError(Exception):
+    """The inference server could not serve a request."""
+
+def require_authkey():
+    """Refuse to serve or connect without INFERENCE_AUTHKEY.
+
+    multiprocessing.connection unpickles what it receives, so anyone who
+    knows the key and can reach the address can run code on either side.
+    """
+    if not INFERENCE_AUTHKEY:
+        raise RuntimeError(
+            "INFERENCE_AUTHKEY is not set; generate one per deployment, e.g. "
+            "python -c \"import secrets; print(secrets.token_hex(32))\", or set INFERENCE_MODE=local"
+        )
+
+_local = threading.local()
+_warned_fallback = False
+
+def _connection():
+    # One connection per thread; the server handles each on its own thread
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = Client(INFERENCE_ADDRESS, authkey=INFERENCE_AUTHKEY)
+        _local.conn = conn
+    return conn
+
+def _drop_connection():
+    conn = getattr(_local, "conn", None)
+    _local.conn = None
+    if conn is not None:
+        try:
+            conn.close()
+        except OSError:
+            pass
+
+def _call(kind: str, payload: Any) -> Any:
+    for attempt in (1, 2):
+        try:
+            conn = _connection()
+            conn.send((kind, payload))
+            if not conn.poll(INFERENCE_TIMEOUT):
+                # A late reply would desynchronise the connection
+                _drop_connection()
+                raise InferenceError(f"Inference server did not answer {kind} within {INFERENCE_TIMEOUT}s")
+            status, result = conn.recv()
+        except (OSError, EOFError):
+            # Server restarted since this thread connected; reconnect once
+            _drop_connection()
+            if attempt == 2:
+                raise
+            continue
+        if status != "ok":
+            raise InferenceError(result)
+        return result
+
+def _fall_back(reason: str, payload: Any, local_fn):
+    global _warned_fallback
+    if not _warned_fallback:
+        _warned_fallback = True
+        logger.warning(f"{reason}; loading models in this process")
+    return local_fn(payload)
+
+def _with_fallback(kind: str, payload: Any, local_fn):
+    if INFERENCE_MODE == "local":
+        return local_fn(payload)
+    if not INFERENCE_AUTHKEY:
+        # Checked here rather than at import so the app still starts and can fall back
+        if not INFERENCE_LOCAL_FALLBACK:
+            require_authkey()
+        return _fall_back("INFERENCE_AUTHKEY is not set", payload, local_fn)
+    try:
+        return _call(kind, payload)
+    except (OSError, EOFError):
+        if not INFERENCE_LOCAL_FALLBACK:
+            raise
+        return _fall_back(f"Inference server unavailable at {INFERENCE_ADDRESS}", payload, local_fn)
+
+def embed_texts(texts: List[str]) -> List[List[float]]:
+    if not texts:
+        return []
+    return _with_fallback("embed", list(texts), embed_texts_local)
+
+def ocr_image(image_bytes: bytes) -> List[str]:
+    return _with_fallback("ocr", bytes(image_bytes), ocr_image_local)
@@ -0,0 +1,186 @@
+"""Local inference server for embeddings and OCR.
+
+One process owns the MiniLM and PaddleOCR models so API and Celery workers
+do not each load their own copy. Clients (``inference_client``) connect
+over a Unix socket, or a named pipe on Windows. Requests that arrive
+within ``INFERENCE_BATCH_WINDOW_MS`` of each other are run as one batch.
+
+Run with ``python inference_server.py``.
+"""
+from multiprocessing.connection import Listener
+from typing import Any, Callable, List
+from prometheus_client import Counter, Histogram, start_http_server
+import os
+import queue
+import sys
+import threading
+import time
+import logging
+
+import inference
+from inference_client import INFERENCE_ADDRESS, INFERENCE_AUTHKEY, require_authkey
+
+logger = logging.getLogger(__name__)
+
+INFERENCE_BATCH_WINDOW_MS = float(os.getenv("INFERENCE_BATCH_WINDOW_MS", "5"))
+INFERENCE_MAX_BATCH_TEXTS = int(os.getenv("INFERENCE_MAX_BATCH_TEXTS", "256"))
+INFERENCE_METRICS_PORT = int(os.getenv("INFERENCE_METRICS_PORT", "0"))
+
+INFERENCE_REQUESTS = Counter('inference_requests_total', 'Inference server requests', ['kind', 'status'])
+INFERENCE_BATCH_SIZE = Histogram(
+    'inference_batch_requests', 'Requests merged into one inference batch', ['kind'],
+    buckets=(1, 2, 4, 8, 16, 32, 64)
+)
+INFERENCE_BATCH_SECONDS = Histogram('inference_batch_seconds', 'Time to run one inference batch', ['kind'])
+
+class _Pending:
+    def __init__(self, payload: Any):
+        self.payload = payload
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class MicroBatcher:
+    """Collect requests for a short window and run them through ``run_batch`` together.
+
+    ``run_batch`` returns one result per payload; an exception in place of a
+    result fails only that request.
+    """
+
+    def __init__(self, kind: str, run_batch: Callable[[List[Any]], List[Any]], size: Callable[[Any], int], max_size: int):
+        self.kind = kind
+        self.run_batch = run_batch
+        self.size = size
+        self.max_size = max_size
+        self._queue: "queue.Queue[_Pending]" = queue.Queue()
+        threading.Thread(target=self._loop, name=f"batch-{kind}", daemon=True).start()
+
+    def submit(self, payload: Any) -> Any:
+        pending = _Pending(payload)
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _collect(self) -> List[_Pending]:
+        batch = [self._queue.get()]
+        total = self.size(batch[0].payload)
+        deadline = time.monotonic() + INFERENCE_BATCH_WINDOW_MS / 1000
+        while total < self.max_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                pending = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(pending)
+            total += self.size(pending.payload)
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            INFERENCE_BATCH_SIZE.labels(kind=self.kind).observe(len(batch))
+            start_time = time.time()
+            try:
+                results = self.run_batch([pending.payload for pending in batch])
+                for pending, result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        pending.error = result
+                    else:
+                        pending.result = result
+            except Exception as e:
+                logger.error(f"{self.kind} batch failed: {e}", exc_info=True)
+                for pending in batch:
+                    pending.error = e
+            finally:
+                INFERENCE_BATCH_SECONDS.labels(kind=self.kind).observe(time.time() - start_time)
+                for pending in batch:
+                    pending.done.set()
+
+def _embed_batch(payloads: List[List[str]]) -> List[List[List[float]]]:
+    texts = [text for texts in payloads for text in texts]
+    vectors = inference.embed_texts_local(texts)
+    results = []
+    position = 0
+    for texts in payloads:
+        results.append(vectors[position:position + len(texts)])
+        position += len(texts)
+    return results
+
+def _ocr_batch(payloads: List[bytes]) -> List[Any]:
+    # PaddleOCR takes one image at a time; a failed image only fails its own request
+    results: List[Any] = []
+    for image_bytes in payloads:
+        try:
+            results.append(inference.ocr_image_local(image_bytes))
+        except Exception as e:
+            results.append(e)
+    return results
+
+def configure_threads():
+    """Give torch every core unless INFERENCE_TORCH_THREADS says otherwise; this process is the only model user."""
+    if inference.EMBEDDING_BACKEND != "torch":
+        return  # ONNX Runtime sizes its own pool (ONNX_INTRA_OP_THREADS)
+    import torch
+    threads = inference.INFERENCE_TORCH_THREADS or os.cpu_count() or 1
+    torch.set_num_threads(threads)
+    logger.info(f"torch using {threads} intra-op threads")
+
+def handle_connection(conn, batchers: dict):
+    with conn:
+        while True:
+            try:
+                kind, payload = conn.recv()
+            except (EOFError, OSError):
+                return
+            batcher = batchers.get(kind)
+            if batcher is None:
+                conn.send(("error", f"Unknown request kind: {kind}"))
+                continue
+            try:
+                result = batcher.submit(payload)
+                INFERENCE_REQUESTS.labels(kind=kind, status="ok").inc()
+                conn.send(("ok", result))
+            except Exception as e:
+                INFERENCE_REQUESTS.labels(kind=kind, status="error").inc()
+                conn.send(("error", str(e)))
+
+def serve():
+    require_authkey()
+    configure_threads()
+    # Load both models before accepting requests
+    inference.get_embedder()
+    inference.get_ocr()
+
+    batchers = {
+        "embed": MicroBatcher("embed", _embed_batch, len, INFERENCE_MAX_BATCH_TEXTS),
+        "ocr": MicroBatcher("ocr", _ocr_batch, lambda payload: 1, 8),
+    }
+    if INFERENCE_METRICS_PORT:
+        start_http_server(INFERENCE_METRICS_PORT)
+
+    if sys.platform != "win32" and os.path.exists(INFERENCE_ADDRESS):
+        os.remove(INFERENCE_ADDRESS)  # Stale socket from a previous run
+    # Only this user may connect to the socket
+    previous_umask = os.umask(0o177) if sys.platform != "win32" else None
+    try:
+        listener = Listener(INFERENCE_ADDRESS, authkey=INFERENCE_AUTHKEY)
+    finally:
+        if previous_umask is not None:
+            os.umask(previous_umask)
+    with listener:
+        logger.info(f"Inference server listening on {INFERENCE_ADDRESS}")
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                logger.warning(f"Rejected inference connection: {e}")
+                continue
+            threading.Thread(target=handle_connection, args=(conn, batchers), daemon=True).start()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    serve()
@@ -0,0 +1,347 @@
+"""Document ingestion pipeline shared by single and batch uploads.
+
+Each stage runs on its own shared pool: text extraction (PyMuPDF and OCR)
+on ``INGEST_EXTRACT_WORKERS`` threads, embedding on a single thread that
+batches the chunks of every document waiting for it, and the Gemini calls
+on ``INGEST_LLM_WORKERS`` threads. Documents move through the stages
+independently, so while one document is being summarised the next is being
+embedded and the one after that extracted, and throughput is bound by the
+slowest stage rather than the sum of all of them.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from prometheus_client import Histogram
+import asyncio
+import contextvars
+import functools
+import os
+import shutil
+import time
+import uuid
+import zipfile
+import logging
+from bson import ObjectId
+
+from mongo import db, get_async_db
+from async_database import save_document
+from document_processor import (
+    extract_text_from_pdf, chunk_text, generate_embeddings, embedding_norms, generate_summary
+)
+from pdf_cache import pdf_cache
+from storage_uploads import new_storage_record, stage_file, discard_staged, schedule_upload
+from clause_extraction import schedule_clause_extraction
+from tracing import span
+from monitoring import UPLOAD_COUNT
+
+logger = logging.getLogger(__name__)
+
+INGEST_EXTRACT_WORKERS = int(os.getenv("INGEST_EXTRACT_WORKERS", "2"))
+INGEST_LLM_WORKERS = int(os.getenv("INGEST_LLM_WORKERS", "2"))
+# Upper bound on chunks embedded in one call across documents
+INGEST_EMBED_BATCH_CHUNKS = int(os.getenv("INGEST_EMBED_BATCH_CHUNKS", "512"))
+# Documents between upload and save at once, across all batches
+INGEST_MAX_IN_FLIGHT = int(os.getenv("INGEST_MAX_IN_FLIGHT", "6"))
+INGEST_BATCH_DIR = os.getenv("INGEST_BATCH_DIR", "uploads")
+INGEST_BATCH_MAX_FILES = int(os.getenv("INGEST_BATCH_MAX_FILES", "100"))
+INGEST_BATCH_MAX_BYTES = int(os.getenv("INGEST_BATCH_MAX_BYTES", str(2 * 1024 ** 3)))
+COPY_CHUNK_BYTES = 1024 * 1024
+# A running batch refreshes heartbeat_at this often; one silent for INGEST_BATCH_STALE_SECONDS died with its worker
+INGEST_BATCH_HEARTBEAT_SECONDS = float(os.getenv("INGEST_BATCH_HEARTBEAT_SECONDS", "30"))
+INGEST_BATCH_STALE_SECONDS = int(os.getenv("INGEST_BATCH_STALE_SECONDS", "300"))
+
+INGEST_EMBED_BATCH_CHUNKS_OBSERVED = Histogram(
+    'ingest_embed_batch_chunks', 'Chunks embedded per batched embedding call',
+    buckets=(1, 8, 32, 64, 128, 256, 512, 1024)
+)
+
+_extract_pool = ThreadPoolExecutor(max_workers=INGEST_EXTRACT_WORKERS, thread_name_prefix="ingest-extract")
+_embed_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest-embed")
+_llm_pool = ThreadPoolExecutor(max_workers=INGEST_LLM_WORKERS, thread_name_prefix="ingest-llm")
+
+ProgressCallback = Callable[[str], Awaitable[None]]
+
+class EmbeddingBatcher:
+    """Merge embedding requests that arrive while the model is busy into one call."""
+
+    def __init__(self, max_chunks: int):
+        self.max_chunks = max_chunks
+        self._pending: List[Tuple[List[str], asyncio.Future]] = []
+        self._draining = False
+
+    async def embed(self, chunks: List[str]) -> List[List[float]]:
+        if not chunks:
+            return []
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((chunks, future))
+        if not self._draining:
+            self._draining = True
+            asyncio.ensure_future(self._drain())
+        return await future
+
+    def _take_batch(self) -> List[Tuple[List[str], asyncio.Future]]:
+        batch = []
+        total = 0
+        while self._pending and (not batch or total + len(self._pending[0][0]) <= self.max_chunks):
+            chunks, future = self._pending.pop(0)
+            batch.append((chunks, future))
+            total += len(chunks)
+        return batch
+
+    async def _drain(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self._pending:
+                batch = self._take_batch()
+                texts = [chunk for chunks, _ in batch for chunk in chunks]
+                INGEST_EMBED_BATCH_CHUNKS_OBSERVED.observe(len(texts))
+                try:
+                    vectors = await loop.run_in_executor(_embed_pool, generate_embeddings, texts)
+                except Exception as e:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                position = 0
+                for chunks, future in batch:
+                    if not future.done():
+                        future.set_result(vectors[position:position + len(chunks)])
+                    position += len(chunks)
+        finally:
+            self._draining = False
+
+embedding_batcher = EmbeddingBatcher(INGEST_EMBED_BATCH_CHUNKS)
+_in_flight: Optional[asyncio.Semaphore] = None
+
+def _in_flight_slots() -> asyncio.Semaphore:
+    # Created on first use so it belongs to the server's event loop
+    global _in_flight
+    if _in_flight is None:
+        _in_flight = asyncio.Semaphore(INGEST_MAX_IN_FLIGHT)
+    return _in_flight
+
+def _extract(file_path: str) -> Tuple[str, List[str]]:
+    text = extract_text_from_pdf(file_path)
+    return text, chunk_text(text)
+
+def _run_in(pool: ThreadPoolExecutor, fn: Callable, *args):
+    # Carry the current trace context into the worker thread
+    context = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(pool, functools.partial(context.run, fn, *args))
+
+async def ingest_pdf(file_path: str, filename: str, user_id, progress: Optional[ProgressCallback] = None) -> str:
+    """Run one PDF through extraction, embedding, analysis and save.
+
+    Raises on failure. On success the file has been moved to upload staging
+    and the storage key is returned; on failure the file is left in place.
+    """
+    async def report(stage: str):
+        if progress is not None:
+            await progress(stage)
+
+    public_id = str(user_id) + "_" + os.path.splitext(filename)[0]
+    with span("ingest", filename=filename):
+        try:
+            async with _in_flight_slots():
+                await report("extracting")
+                with span("ingest.extract"):
+                    text, chunks = await _run_in(_extract_pool, _extract, file_path)
+                await report("embedding")
+                with span("ingest.embed", chunks=len(chunks)):
+                    embeddings = await embedding_batcher.embed(chunks)
+                norms = embedding_norms(embeddings)
+                # Warm the local cache so the first view never leaves the node
+                await _run_in(_extract_pool, pdf_cache.put_file, public_id, file_path)
+                # Clauses are extracted later, on first request (see clause_extraction)
+                await report("summarising")
+                with span("ingest.summarise"):
+                    success, summary = await _run_in(_llm_pool, generate_summary, text, str(user_id))
+                if not success:
+                    raise RuntimeError(summary)
+
+                await report("saving")
+                # Keep the PDF staged on local disk until the storage backend has it
+                stage_file(file_path, public_id)
+                document_id = ObjectId()
+                success, message = await save_document(
+                    user_id, filename, summary, None, chunks, embeddings, new_storage_record(public_id), norms, document_id
+                )
+                if not success:
+                    raise RuntimeError(message)
+
+            # Stored in the background; the PDF is served from the cache or staging meanwhile
+            schedule_upload(public_id)
+            schedule_clause_extraction(str(document_id))
+            UPLOAD_COUNT.labels(status="success").inc()
+            return public_id
+        except Exception:
+            UPLOAD_COUNT.labels(status="error").inc()
+            pdf_cache.delete(public_id)
+            discard_staged(public_id)
+            raise
+
+# Strong references so running batches are not garbage collected
+_batch_tasks = set()
+
+def _batches():
+    return get_async_db()["ingest_batches"]
+
+def batch_status(batch: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "batch_id": batch["_id"],
+        "status": batch["status"],
+        "created_at": batch["created_at"].isoformat(),
+        "documents": batch["documents"]
+    }
+
+def _unpack_uploads(batch_dir: str, uploads: List[Tuple[str, Any]]) -> List[Dict[str, Any]]:
+    """Write uploaded PDFs and the PDFs inside uploaded ZIPs to ``batch_dir``."""
+    entries: List[Dict[str, Any]] = []
+    seen = set()
+    total_bytes = 0
+
+    def copy_within_limit(src, dst) -> bool:
+        # Stops as soon as the batch passes the limit, whatever the source claims its size is
+        nonlocal total_bytes
+        while True:
+            chunk = src.read(COPY_CHUNK_BYTES)
+            if not chunk:
+                return True
+            total_bytes += len(chunk)
+            if total_bytes > INGEST_BATCH_MAX_BYTES:
+                return False
+            dst.write(chunk)
+
+    def add(name: str, src, declared_size: Optional[int] = None) -> None:
+        entry = {"filename": name, "status": "queued", "error": None}
+        entries.append(entry)
+        if len(entries) > INGEST_BATCH_MAX_FILES:
+            entry.update(status="failed", error=f"Batch is limited to {INGEST_BATCH_MAX_FILES} documents")
+            return
+        if name in seen:
+            entry.update(status="failed", error="Duplicate filename in batch")
+            return
+        seen.add(name)
+        if total_bytes + (declared_size or 0) > INGEST_BATCH_MAX_BYTES:
+            entry.update(status="failed", error="Batch size limit exceeded")
+            return
+        path = os.path.join(batch_dir, f"{len(entries)}_{name}")
+        with open(path, "wb") as dst:
+            within_limit = copy_within_limit(src, dst)
+        if not within_limit:
+            os.remove(path)
+            entry.update(status="failed", error="Batch size limit exceeded")
+            return
+        entry["path"] = path
+
+    for name, fileobj in uploads:
+        lower = name.lower()
+        if lower.endswith(".pdf"):
+            add(os.path.basename(name), fileobj)
+        elif lower.endswith(".zip"):
+            with zipfile.ZipFile(fileobj) as archive:
+                for info in archive.infolist():
+                    # Only the base name is used, so archive paths cannot escape batch_dir
+                    member = os.path.basename(info.filename)
+                    if info.is_dir() or not member.lower().endswith(".pdf") or member.startswith("."):
+                        continue
+                    # The header size rejects oversized members before any of it is inflated
+                    with archive.open(info) as src:
+                        add(member, src, info.file_size)
+        else:
+            entries.append({"filename": name, "status": "failed", "error": "Only PDF and ZIP files are allowed"})
+    return entries
+
+async def create_batch(user: Dict[str, Any], uploads: List[Tuple[str, Any]]) -> Dict[str, Any]:
+    """Unpack uploaded files, record the batch and start ingesting it in the background."""
+    batch_id = uuid.uuid4().hex
+    batch_dir = os.path.join(INGEST_BATCH_DIR, f"batch_{batch_id}")
+    os.makedirs(batch_dir, exist_ok=True)
+    try:
+        entries = await asyncio.get_running_loop().run_in_executor(_extract_pool, _unpack_uploads, batch_dir, uploads)
+    except Exception:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        raise
+
+    paths = [entry.pop("path", None) for entry in entries]
+    batch = {
+        "_id": batch_id,
+        "user_id": str(user["_id"]),
+        "status": "running",
+        "created_at": datetime.utcnow(),
+        "heartbeat_at": datetime.utcnow(),
+        "documents": entries
+    }
+    await _batches().insert_one(batch)
+
+    task = asyncio.ensure_future(_run_batch(batch_id, user["_id"], batch_dir, entries, paths))
+    _batch_tasks.add(task)
+    task.add_done_callback(_batch_tasks.discard)
+    return batch
+
+async def _run_batch(batch_id: str, user_id, batch_dir: str, entries: List[Dict[str, Any]], paths: List[Optional[str]]):
+    async def set_document(index: int, **fields):
+        await _batches().update_one(
+            {"_id": batch_id}, {"$set": {f"documents.{index}.{name}": value for name, value in fields.items()}}
+        )
+
+    async def ingest(index: int, path: str):
+        async def progress(stage: str):
+            await set_document(index, status=stage)
+        try:
+            await ingest_pdf(path, entries[index]["filename"], user_id, progress)
+            await set_document(index, status="done")
+        except Exception as e:
+            logger.error(f"Batch {batch_id}: {entries[index]['filename']} failed: {e}", exc_info=True)
+            await set_document(index, status="failed", error=str(e))
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(INGEST_BATCH_HEARTBEAT_SECONDS)
+            try:
+                await _batches().update_one({"_id": batch_id}, {"$set": {"heartbeat_at": datetime.utcnow()}})
+            except Exception as e:
+                logger.warning(f"Batch {batch_id}: heartbeat failed: {e}")
+
+    beat = asyncio.ensure_future(heartbeat())
+    try:
+        await asyncio.gather(*(ingest(index, path) for index, path in enumerate(paths) if path))
+    finally:
+        beat.cancel()
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        await _batches().update_one({"_id": batch_id}, {"$set": {"status": "done", "finished_at": datetime.utcnow()}})
+
+async def get_batch(batch_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+    return await _batches().find_one({"_id": batch_id, "user_id": user_id})
+
+def recover_orphaned_batches() -> int:
+    """Fail batches whose worker died mid-run and remove leftover batch directories.
+
+    A running batch whose heartbeat is older than ``INGEST_BATCH_STALE_SECONDS``
+    is marked failed, along with its unfinished documents. Returns the number
+    of batches failed.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=INGEST_BATCH_STALE_SECONDS)
+    result = db.ingest_batches.update_many(
+        # Also matches batches recorded before heartbeat_at existed
+        {"status": "running", "heartbeat_at": {"$not": {"$gte": cutoff}}},
+        {"$set": {
+            "status": "failed",
+            "finished_at": datetime.utcnow(),
+            "documents.$[open].status": "failed",
+            "documents.$[open].error": "Interrupted by a server restart",
+        }},
+        array_filters=[{"open.status": {"$nin": ["done", "failed"]}}]
+    )
+
+    if os.path.isdir(INGEST_BATCH_DIR):
+        names = [name for name in os.listdir(INGEST_BATCH_DIR) if name.startswith("batch_")]
+        ids = [name[len("batch_"):] for name in names]
+        running = {doc["_id"] for doc in db.ingest_batches.find({"_id": {"$in": ids}, "status": "running"}, {"_id": 1})}
+        for name, batch_id in zip(names, ids):
+            path = os.path.join(INGEST_BATCH_DIR, name)
+            # A directory without a record may still be unpacking in another worker
+            if batch_id in running or os.path.getmtime(path) > time.time() - INGEST_BATCH_STALE_SECONDS:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+    return result.modified_count
@@ -0,0 +1,146 @@
+"""Event-loop lag and blocking-call detection.
+
+A ticker coroutine sleeps for ``LOOP_MONITOR_INTERVAL`` and records how
+late it wakes up in ``event_loop_lag_seconds``. A watchdog thread watches
+the ticker's heartbeat: once the loop has not come back for
+``LOOP_BLOCK_THRESHOLD`` it captures the loop thread's stack, which is the
+blocking call still in progress, and logs it with the route being served,
+at most once per ``LOOP_BLOCK_LOG_INTERVAL`` for each route.
+"""
+from prometheus_client import Counter, Histogram
+from starlette.types import ASGIApp, Receive, Scope, Send
+from typing import Dict, Optional, Tuple
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+import weakref
+import logging
+
+from monitoring import route_template
+
+logger = logging.getLogger(__name__)
+
+LOOP_MONITOR_ENABLED = os.getenv("LOOP_MONITOR_ENABLED", "true").lower() == "true"
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", "0.05"))
+# A loop that has not run a callback for this long is reported as blocked
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.25"))
+LOOP_BLOCK_LOG_INTERVAL = float(os.getenv("LOOP_BLOCK_LOG_INTERVAL", "60"))
+
+EVENT_LOOP_LAG = Histogram(
+    'event_loop_lag_seconds', 'How late the event loop ran a scheduled callback',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+EVENT_LOOP_BLOCKS = Counter(
+    'event_loop_blocked_total', 'Times the event loop was blocked longer than LOOP_BLOCK_THRESHOLD',
+    ['method', 'endpoint']
+)
+
+UNKNOWN_ROUTE = ("", "<unknown>")
+
+# Request task -> (method, route template), for attributing a blocked loop
+_task_routes: "weakref.WeakKeyDictionary[asyncio.Task, Tuple[str, str]]" = weakref.WeakKeyDictionary()
+
+class LoopMonitor:
+    """Measure lag of one event loop and report calls that block it.
+
+    Must be created on the loop's own thread.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, interval: float, threshold: float, log_interval: float):
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.log_interval = log_interval
+        self._thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._reported = False
+        self._last_logged: Dict[Tuple[str, str], float] = {}
+        self._stopped = threading.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = self.loop.create_task(self._tick())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _tick(self):
+        while True:
+            start = self.loop.time()
+            await asyncio.sleep(self.interval)
+            EVENT_LOOP_LAG.observe(max(0.0, self.loop.time() - start - self.interval))
+            self._heartbeat = time.monotonic()
+            self._reported = False
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            blocked_for = time.monotonic() - self._heartbeat - self.interval
+            if blocked_for >= self.threshold and not self._reported:
+                # Once per blocking episode; the next heartbeat re-arms it
+                self._reported = True
+                self._report(blocked_for)
+
+    def _current_route(self) -> Tuple[str, str]:
+        try:
+            task = asyncio.current_task(self.loop)
+            return _task_routes.get(task, UNKNOWN_ROUTE) if task is not None else UNKNOWN_ROUTE
+        except Exception:
+            return UNKNOWN_ROUTE
+
+    def _report(self, blocked_for: float):
+        method, endpoint = self._current_route()
+        EVENT_LOOP_BLOCKS.labels(method=method, endpoint=endpoint).inc()
+
+        now = time.monotonic()
+        if now - self._last_logged.get((method, endpoint), float("-inf")) < self.log_interval:
+            return
+        self._last_logged[(method, endpoint)] = now
+        frame = sys._current_frames().get(self._thread_id)
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else "<no stack>"
+        logger.warning(
+            f"Event loop blocked for {blocked_for:.2f}s and counting while serving {method} {endpoint}:\n{stack}"
+        )
+
+monitor: Optional[LoopMonitor] = None
+
+def start_loop_monitor():
+    """Start monitoring the running loop; call from the loop's thread, e.g. a startup hook."""
+    global monitor
+    if not LOOP_MONITOR_ENABLED or monitor is not None:
+        return
+    monitor = LoopMonitor(asyncio.get_running_loop(), LOOP_MONITOR_INTERVAL, LOOP_BLOCK_THRESHOLD, LOOP_BLOCK_LOG_INTERVAL)
+    monitor.start()
+
+async def stop_loop_monitor():
+    global monitor
+    if monitor is not None:
+        await monitor.stop()
+        monitor = None
+
+class LoopMonitorMiddleware:
+    """Remember which route each request task serves, so blocked-loop reports can name it."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        task = asyncio.current_task() if scope["type"] == "http" else None
+        if task is None:
+            await self.app(scope, receive, send)
+            return
+
+        _task_routes[task] = (scope["method"], route_template(scope))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _task_routes.pop(task, None)
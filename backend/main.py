@@ -2,38 +2,52 @@ from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Body, Req
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm, HTTPBasic, HTTPBasicCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse, StreamingResponse, JSONResponse, Response
-from datetime import timedelta
+from datetime import datetime, timedelta
 import shutil
 import time
+import zipfile
 import os
-from typing import List, Optional
+from typing import Any, AsyncIterator, Dict, List, Optional
 from jose import jwt, JWTError
 from pydantic import BaseModel
 import logging
+import json
 from fastapi.responses import StreamingResponse
-import httpx
-from io import BytesIO
-import threading
 from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
-from starlette_prometheus import metrics, PrometheusMiddleware
 from gemini_integration import gemini_service
-from gemini_metrics import GeminiMetrics
+from gemini_metrics import GeminiMetrics, ROLLUP_GRANULARITIES, summarize_rollups
+from single_flight import SingleFlight, make_key, normalize_prompt
+from starlette.concurrency import run_in_threadpool, iterate_in_threadpool
 
 from database import (
-    create_user, verify_user, create_access_token,
-    save_document, get_user_documents, get_document_by_filename, get_document_by_id, delete_pdf_file,
-    SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES,
-    users_collection, documents_collection
+    create_access_token, ensure_indexes, verify_query_coverage,
+    SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
 )
-from document_processor import (
-    extract_text_from_pdf, chunk_text, generate_embeddings, generate_summary, extract_clauses, generate_chat_response,
-    get_similar_chunks
+from password_hashing import PasswordHashingBusy
+from user_cache import user_cache
+from async_database import (
+    create_user, verify_user, get_user_by_username,
+    get_user_documents, get_user_document_by_filename, get_user_document, delete_pdf_file
+)
+from document_processor import generate_chat_response, get_similar_chunks, stream_chat_response
+from ingestion import ingest_pdf, create_batch, get_batch, batch_status, recover_orphaned_batches
+from clause_extraction import ensure_clauses
+from pdf_proxy import serve_pdf as serve_document_pdf, close_http_client
+from storage import get_storage
+from storage_uploads import discard_staged, resume_pending_uploads
+from pdf_cache import pdf_cache
+from upload_sessions import (
+    UploadError, create_session, get_session, write_part, complete_session,
+    reopen_session, finish_session, abort_session, session_status, purge_expired_sessions
 )
-from cloud_storage import (upload_file_to_cloud, get_file, delete_file, get_pdf_url)
 from monitoring import (
-    monitor_request, update_system_metrics,
-    UPLOAD_COUNT, CHAT_REQUESTS, SUMMARY_REQUESTS
+    RequestMetricsMiddleware, metrics, system_metrics,
+    CHAT_REQUESTS, SUMMARY_REQUESTS
 )
+from metrics_registry import scrape_registry, process_exited, sweep_dead_processes
+from tracing import TracingMiddleware
+from profiling import ProfilingMiddleware, list_profiles, get_profile_path
+from loop_monitor import LoopMonitorMiddleware, start_loop_monitor, stop_loop_monitor
 
 logger = logging.getLogger('uvicorn.error')
 logger.setLevel(logging.DEBUG)
@@ -46,6 +60,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Content-Range", "Accept-Ranges", "Content-Length", "ETag", "Last-Modified", "Upload-Offset", "Retry-After", "X-Trace-Id", "X-Profile-Id"],
 )
 
 # Add basic auth security
@@ -62,18 +77,82 @@ def verify_metrics_auth(credentials: HTTPBasicCredentials = Security(security)):
         )
     return credentials
 
-# Add Prometheus middleware
-app.add_middleware(PrometheusMiddleware)
+# Opt-in profiling (X-Profile header or PROFILE_SAMPLE_RATES); see /admin/profiles
+app.add_middleware(ProfilingMiddleware)
+# Request metrics by route template; /metrics aggregates every worker process in multiprocess mode
+app.add_middleware(RequestMetricsMiddleware)
+# Names the route in reports of a blocked event loop
+app.add_middleware(LoopMonitorMiddleware)
+# Outermost, so every stage of a request (including the metrics middleware) is in its trace
+app.add_middleware(TracingMiddleware)
 app.add_route("/metrics", metrics)
 
-# Add request monitoring middleware
-@app.middleware("http")
-async def monitoring_middleware(request: Request, call_next):
-    return await monitor_request(request, call_next)
+@app.on_event("startup")
+def check_indexes():
+    try:
+        ensure_indexes()
+        uncovered = verify_query_coverage()
+        if uncovered:
+            logger.warning(f"Queries without index coverage: {uncovered}")
+    except Exception as e:
+        logger.error(f"Error checking indexes: {str(e)}")
+
+@app.on_event("startup")
+def resume_storage_uploads():
+    try:
+        resumed = resume_pending_uploads()
+        if resumed:
+            logger.info(f"Resumed {resumed} pending storage uploads")
+    except Exception as e:
+        logger.error(f"Error resuming storage uploads: {str(e)}")
+
+@app.on_event("startup")
+def recover_ingest_batches():
+    try:
+        failed = recover_orphaned_batches()
+        if failed:
+            logger.info(f"Marked {failed} interrupted ingest batches as failed")
+    except Exception as e:
+        logger.error(f"Error recovering ingest batches: {str(e)}")
 
-# Start system metrics update thread
-metrics_thread = threading.Thread(target=update_system_metrics, daemon=True)
-metrics_thread.start()
+@app.on_event("startup")
+def purge_upload_sessions():
+    try:
+        purged = purge_expired_sessions()
+        if purged:
+            logger.info(f"Removed {purged} expired upload session files")
+    except Exception as e:
+        logger.error(f"Error purging upload sessions: {str(e)}")
+
+@app.on_event("startup")
+def sweep_prometheus_files():
+    # Live gauges of workers that crashed would otherwise be counted forever
+    try:
+        swept = sweep_dead_processes()
+        if swept:
+            logger.info(f"Removed Prometheus samples of {swept} dead worker processes")
+    except Exception as e:
+        logger.error(f"Error sweeping Prometheus multiprocess files: {str(e)}")
+
+@app.on_event("startup")
+async def monitor_event_loop():
+    start_loop_monitor()
+
+@app.on_event("shutdown")
+async def stop_event_loop_monitor():
+    await stop_loop_monitor()
+
+@app.on_event("shutdown")
+def flush_gemini_metrics():
+    GeminiMetrics.flush()
+
+@app.on_event("shutdown")
+def mark_metrics_process_dead():
+    process_exited()
+
+@app.on_event("shutdown")
+async def close_pdf_proxy():
+    await close_http_client()
 
 # OAuth2 scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
@@ -81,6 +160,9 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 UPLOAD_DIR = "uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+# Identical questions on the same document share one retrieval + Gemini call
+document_chat_flight = SingleFlight("document_chat")
+
 class SignupRequest(BaseModel):
     username: str
     email: str
@@ -89,6 +171,13 @@ class SignupRequest(BaseModel):
 class ChatRequest(BaseModel):
     query: str
 
+class UploadInitRequest(BaseModel):
+    filename: str
+    size: int
+
+class UploadCompleteRequest(BaseModel):
+    sha256: Optional[str] = None
+
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
@@ -98,21 +187,77 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
     
-    user = users_collection.find_one({"username": username})
+    user = user_cache.get(username)
     if user is None:
-        raise HTTPException(status_code=401, detail="User not found")
+        user = await get_user_by_username(username)
+        if user is None:
+            raise HTTPException(status_code=401, detail="User not found")
+        user_cache.set(username, user)
     return user
 
+def answer_document_query(query: str, chunks: List[str], embeddings: List[List[float]], user_id: str,
+                          norms: Optional[List[float]] = None):
+    similar_chunks = get_similar_chunks(query, chunks, embeddings, document_norms=norms)
+    return generate_chat_response(query, similar_chunks, user_id)
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def format_sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def sse_stream(request: Request, events: AsyncIterator[Dict[str, Any]], counter=None) -> AsyncIterator[str]:
+    """Relay ``token``/``done``/``error`` events to the client as server-sent events."""
+    status = "cancelled"
+    try:
+        async for event in events:
+            if await request.is_disconnected():
+                break
+            if event["type"] == "token":
+                yield format_sse("token", {"text": event["text"]})
+            elif event["type"] == "done":
+                status = "success"
+                yield format_sse("done", {"latency": event.get("latency"), "token_usage": event.get("token_usage")})
+            else:
+                status = "error"
+                yield format_sse("error", {"error": event.get("error")})
+    finally:
+        await events.aclose()
+        if counter is not None:
+            counter.labels(status=status).inc()
+
+async def document_chat_events(chunks) -> AsyncIterator[Dict[str, Any]]:
+    """Adapt the text chunks of a document chat stream to SSE events."""
+    start_time = time.time()
+    try:
+        async for text in iterate_in_threadpool(chunks):
+            yield {"type": "token", "text": text}
+        yield {"type": "done", "latency": time.time() - start_time}
+    except Exception as e:
+        logger.error(f"Error streaming chat response: {str(e)}", exc_info=True)
+        yield {"type": "error", "error": str(e)}
+    finally:
+        try:
+            # Closing the generator records usage for partially streamed answers
+            chunks.close()
+        except ValueError:
+            pass
+
 @app.post("/signup")
 async def signup(request: SignupRequest):
-    success, message = create_user(request.username, request.email, request.password)
+    try:
+        success, message = await create_user(request.username, request.email, request.password)
+    except PasswordHashingBusy as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
     if not success:
         raise HTTPException(status_code=400, detail=message)
     return {"message": message}
 
 @app.post("/token")
 async def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    success, result = verify_user(form_data.username, form_data.password)
+    try:
+        success, result = await verify_user(form_data.username, form_data.password)
+    except PasswordHashingBusy as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
     if not success:
         raise HTTPException(status_code=401, detail=result)
     
@@ -122,6 +267,19 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
+async def ingest_document(file_path: str, filename: str, current_user: dict) -> dict:
+    """Run an uploaded PDF through the ingestion pipeline.
+
+    On success the file has been moved to upload staging; on failure it is
+    left where it was (if still there) for the caller to clean up.
+    """
+    try:
+        await ingest_pdf(file_path, filename, current_user["_id"])
+        return {"message": "File processed successfully"}
+    except Exception as e:
+        logger.error(f"Error in upload endpoint: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error processing file: {str(e)}")
+
 @app.post("/upload")
 async def upload_file(
     file: UploadFile = File(...),
@@ -130,101 +288,124 @@ async def upload_file(
     if not file.filename.endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Only PDF files are allowed")
     
-    file_name = os.path.splitext(file.filename)[0]
-    current_user_id = str(current_user["_id"])
-    file_path = os.path.join(UPLOAD_DIR, file_name)
-    public_id = None
+    file_path = os.path.join(UPLOAD_DIR, os.path.splitext(file.filename)[0])
     try:
         with open(file_path, "wb") as buffer:
             shutil.copyfileobj(file.file, buffer)
-        
-        file.file.seek(0)
-        
-        text = extract_text_from_pdf(file_path)
-        chunks = chunk_text(text)
-        embeddings = generate_embeddings(chunks)
-
-        public_id = current_user_id + "_" + file_name
-        logger.debug(f"Uploading to Cloudinary with public_id: {public_id}")
-        
-        # Upload to Cloudinary
-        upload_result = upload_file_to_cloud(file.file, public_id)
-        if not upload_result:
-            raise HTTPException(status_code=500, detail="Failed to upload file to cloud storage")
-        result1, clause_list = extract_clauses(text, str(current_user["_id"]))
-        time.sleep(10)
-        result2, summary = generate_summary(text, str(current_user["_id"])) 
-        print(summary)
-        logger.debug(clause_list)
-        # Save document to database
-        success = None
-        message = None
-        if result1 and result2:
-            success, message = save_document(
-                current_user["_id"],
-                file.filename,
-                summary,
-                clause_list,
-                chunks,
-                embeddings,
-                file.file  # Pass the file object for GridFS
-            )
-        
-        if not success:
-            if (public_id):
-                delete_file(public_id)
-            raise HTTPException(status_code=500, detail=message)
-        
-        UPLOAD_COUNT.labels(status="success").inc()
-        return {"message": "File processed successfully"}
-    
-    except Exception as e:
-        UPLOAD_COUNT.labels(status="error").inc()
-        logger.error(f"Error in upload endpoint: {str(e)}", exc_info=True)
-        if (public_id):
-                delete_file(public_id)
-        # Clean up temporary file if it exists
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        raise HTTPException(status_code=500, detail=f"Error processing file: {str(e)}")
-    
+        return await ingest_document(file_path, file.filename, current_user)
     finally:
         # Clean up temporary file
         if os.path.exists(file_path):
             os.remove(file_path)
 
+@app.post("/upload/batch", status_code=202)
+async def upload_batch(
+    files: List[UploadFile] = File(...),
+    current_user: dict = Depends(get_current_user)
+):
+    """Ingest several PDFs, or ZIPs of PDFs, in the background; poll the batch for progress."""
+    try:
+        batch = await create_batch(current_user, [(file.filename, file.file) for file in files])
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=400, detail="Invalid ZIP file")
+    return batch_status(batch)
+
+@app.get("/upload/batch/{batch_id}")
+async def get_upload_batch(batch_id: str, current_user: dict = Depends(get_current_user)):
+    batch = await get_batch(batch_id, str(current_user["_id"]))
+    if not batch:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return batch_status(batch)
+
+def upload_error(e: UploadError) -> HTTPException:
+    headers = {"Upload-Offset": str(e.offset)} if e.offset is not None else None
+    return HTTPException(status_code=e.status_code, detail=e.detail, headers=headers)
+
+@app.post("/uploads")
+async def initiate_upload(request: UploadInitRequest, current_user: dict = Depends(get_current_user)):
+    try:
+        session = await create_session(str(current_user["_id"]), request.filename, request.size)
+    except UploadError as e:
+        raise upload_error(e)
+    return session_status(session)
+
+@app.get("/uploads/{upload_id}")
+async def get_upload(upload_id: str, current_user: dict = Depends(get_current_user)):
+    try:
+        session = await get_session(upload_id, str(current_user["_id"]))
+    except UploadError as e:
+        raise upload_error(e)
+    return JSONResponse(content=session_status(session), headers={"Upload-Offset": str(session["offset"])})
+
+@app.put("/uploads/{upload_id}")
+async def upload_part(upload_id: str, offset: int, request: Request, current_user: dict = Depends(get_current_user)):
+    """Append the raw request body at ``offset``; send ``X-Part-SHA256`` to have it verified."""
+    try:
+        session = await write_part(
+            upload_id,
+            str(current_user["_id"]),
+            offset,
+            request.stream(),
+            request.headers.get("x-part-sha256")
+        )
+    except UploadError as e:
+        raise upload_error(e)
+    return JSONResponse(content=session_status(session), headers={"Upload-Offset": str(session["offset"])})
+
+@app.post("/uploads/{upload_id}/complete")
+async def complete_upload(
+    upload_id: str,
+    request: Optional[UploadCompleteRequest] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    expected_sha256 = request.sha256 if request else None
+    try:
+        session, file_path = await complete_session(upload_id, str(current_user["_id"]), expected_sha256)
+    except UploadError as e:
+        raise upload_error(e)
+
+    try:
+        result = await ingest_document(file_path, session["filename"], current_user)
+    except HTTPException:
+        if os.path.exists(file_path):
+            # Keep the uploaded bytes so completion can be retried
+            await reopen_session(upload_id)
+        else:
+            await finish_session(upload_id)
+        raise
+    await finish_session(upload_id)
+    return {**result, "sha256": session["sha256"]}
+
+@app.delete("/uploads/{upload_id}")
+async def abort_upload(upload_id: str, current_user: dict = Depends(get_current_user)):
+    try:
+        await abort_session(upload_id, str(current_user["_id"]))
+    except UploadError as e:
+        raise upload_error(e)
+    return {"message": "Upload aborted"}
+
+def page_response(items: list, next_cursor: Optional[str]) -> JSONResponse:
+    """Return one page of a list; the next page's cursor goes in ``X-Next-Cursor``."""
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else {}
+    return JSONResponse(content=items, headers=headers)
+
 @app.get("/documents")
-async def get_documents(current_user: dict = Depends(get_current_user)):
-    documents = get_user_documents(current_user["_id"])
-    return [{"id": str(doc["_id"]),"filename": doc["filename"], "created_at": doc["created_at"]} for doc in documents]
+async def get_documents(limit: int = 100, cursor: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    try:
+        documents, next_cursor = await get_user_documents(current_user["_id"], limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return page_response(
+        [{"id": str(doc["_id"]),"filename": doc["filename"], "created_at": doc["created_at"]} for doc in documents],
+        next_cursor
+    )
 
 @app.get("/document/{filename}/{documentId}")
-async def get_document(filename: str, documentId: str, current_user: dict = Depends(get_current_user)):
-    # document = get_document_by_filename(filename)
-    # if not document or str(document["user_id"]) != str(current_user["_id"]):
-    #     raise HTTPException(status_code=404, detail="Document not found")
-    
-    # document["_id"] = str(document["_id"])
-    # document["user_id"] = str(document["user_id"])
-    # return document
+async def get_document(filename: str, documentId: str, request: Request, current_user: dict = Depends(get_current_user)):
     file_name = os.path.splitext(filename)[0]
     current_user_id = str(current_user["_id"])
     public_id = current_user_id + "_" + file_name
-    file = get_file(public_id)
-    logger.debug(file)
-    try:
-        pdf_url =  get_pdf_url(public_id)
-        async with httpx.AsyncClient() as client:
-            response = await client.get(pdf_url)
-        if response.status_code != 200:
-            raise HTTPException(status_code=404, detail="File not found")
-        return StreamingResponse(
-            BytesIO(response.content),
-            media_type="application/pdf",
-            headers={"Content-Disposition": f"inline; filename={filename}"}
-        )
-    except Exception as e:
-        logger.debug(e)
+    return await serve_document_pdf(public_id, request, filename)
 
 @app.post("/summarize/{filename}/{documentId}")
 async def summarize_document(
@@ -232,9 +413,8 @@ async def summarize_document(
     documentId: str,
     current_user: dict = Depends(get_current_user)
 ):
-    document = get_document_by_id(documentId)
-    
-    if not document or document["user_id"] != str(current_user["_id"]):
+    document = await get_user_document(documentId, current_user["_id"], "summary")
+    if not document:
         raise HTTPException(status_code=404, detail="Document not found or unauthorized")
     SUMMARY_REQUESTS.labels(status="success").inc()
     return {"summary": document['summary']}
@@ -245,11 +425,25 @@ async def get_paragraph_summaries(
     documentId: str,
     current_user: dict = Depends(get_current_user)
 ):
-    document = get_document_by_id(documentId)
-    if not document or document["user_id"] != str(current_user["_id"]):
+    document = await get_user_document(documentId, current_user["_id"], "clauses")
+    if not document:
         raise HTTPException(status_code=404, detail="Document not found")
-    
-    return {"clauses" :document['clauses']}
+    if document.get("clauses") is not None:
+        return {"clauses" :document['clauses']}
+
+    # Extracted on first request; concurrent first requests share the work
+    status, result = await run_in_threadpool(ensure_clauses, documentId)
+    if status == "done":
+        return {"clauses": result}
+    if status == "running":
+        return JSONResponse(status_code=202, content={"status": "running"}, headers={"Retry-After": "5"})
+    if status == "missing":
+        raise HTTPException(status_code=404, detail="Document not found")
+    if status == "rate_limited":
+        raise HTTPException(
+            status_code=429, detail=result["message"], headers={"Retry-After": str(max(1, result["retry_after"]))}
+        )
+    raise HTTPException(status_code=503, detail=result or "Clause extraction failed")
 
 @app.post("/chat/{filename}/{documentId}")
 async def chat_with_document(
@@ -258,39 +452,60 @@ async def chat_with_document(
     request: ChatRequest,
     current_user: dict = Depends(get_current_user)
 ):
-    document = get_document_by_id(documentId)
-    if not document or str(document["user_id"]) != str(current_user["_id"]):
+    document = await get_user_document(documentId, current_user["_id"], "retrieval")
+    if not document:
         raise HTTPException(status_code=404, detail="Document not found")
     
-    similar_chunks = get_similar_chunks(request.query, document["chunks"], document["embeddings"])
-    success, result = generate_chat_response(request.query, similar_chunks, str(current_user["_id"]))
+    flight_key = make_key(documentId, normalize_prompt(request.query))
+    success, result = await document_chat_flight.do_async(
+        flight_key,
+        run_in_threadpool,
+        answer_document_query,
+        request.query,
+        document["chunks"],
+        document["embeddings"],
+        str(current_user["_id"]),
+        document.get("embedding_norms")
+    )
     if not success:
         raise HTTPException(status_code=429, detail=result)
     CHAT_REQUESTS.labels(status="success").inc()
     return {"response": result}
 
+@app.post("/chat/{filename}/{documentId}/stream")
+async def stream_chat_with_document(
+    filename: str,
+    documentId: str,
+    request: ChatRequest,
+    http_request: Request,
+    current_user: dict = Depends(get_current_user)
+):
+    document = await get_user_document(documentId, current_user["_id"], "retrieval")
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    similar_chunks = await run_in_threadpool(
+        get_similar_chunks, request.query, document["chunks"], document["embeddings"],
+        document_norms=document.get("embedding_norms")
+    )
+    success, result = await run_in_threadpool(stream_chat_response, request.query, similar_chunks, str(current_user["_id"]))
+    if not success:
+        raise HTTPException(status_code=429, detail=result)
+    return StreamingResponse(
+        sse_stream(http_request, document_chat_events(result), CHAT_REQUESTS),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
+    )
+
 @app.get("/serve-pdf/{filename}")
-async def serve_pdf(filename: str, current_user: dict = Depends(get_current_user)):
-    document = get_document_by_filename(filename)
-    if not document or document["user_id"] != current_user["_id"]:
+async def serve_pdf(filename: str, request: Request, current_user: dict = Depends(get_current_user)):
+    # Ownership is part of the filter, and only the metadata is fetched (no chunks or embeddings)
+    document = await get_user_document_by_filename(filename, current_user["_id"])
+    if not document:
         raise HTTPException(status_code=404, detail="Document not found")
-    
-    file_path = os.path.join(UPLOAD_DIR, filename)
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="PDF file not found")
-    
-    try:
-        return FileResponse(
-            file_path,
-            media_type="application/pdf",
-            headers={
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "GET",
-                "Access-Control-Allow-Headers": "*"
-            }
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error serving PDF: {str(e)}")
+
+    public_id = (document.get("storage") or {}).get("key") or str(current_user["_id"]) + "_" + os.path.splitext(filename)[0]
+    return await serve_document_pdf(public_id, request, filename)
 
 # Add Gemini endpoints
 @app.post("/api/summarize")
@@ -313,24 +528,53 @@ async def chat(message: str = Form(...)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/summarize/stream")
+async def stream_summarize_text(request: Request, text: str = Form(...), reference: Optional[str] = Form(None)):
+    return StreamingResponse(
+        sse_stream(request, gemini_service.stream_summary(text, reference)),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
+    )
+
+@app.post("/api/chat/stream")
+async def stream_chat(request: Request, message: str = Form(...)):
+    return StreamingResponse(
+        sse_stream(request, gemini_service.stream_chat(message)),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
+    )
+
 @app.get("/api/gemini/metrics/recent")
-async def get_recent_metrics(limit: int = 100):
-    """Get recent Gemini API metrics."""
+async def get_recent_metrics(limit: int = 100, cursor: Optional[str] = None, include_bodies: bool = False):
+    """Get a page of recent Gemini API metrics, newest first."""
     try:
-        metrics = GeminiMetrics.get_recent_metrics(limit)
-        return JSONResponse(content=metrics)
+        metrics, next_cursor = await run_in_threadpool(GeminiMetrics.get_recent_metrics, limit, cursor, include_bodies)
+        return page_response(metrics, next_cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/gemini/metrics/summary")
-async def get_metrics_summary():
-    """Get summary statistics of Gemini API metrics."""
+async def get_metrics_summary(start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """Get summary statistics of Gemini API metrics, optionally for a time range."""
     try:
-        summary = GeminiMetrics.get_metrics_summary()
+        summary = await run_in_threadpool(GeminiMetrics.get_metrics_summary, start, end)
         return JSONResponse(content=summary)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/gemini/metrics/rollups")
+async def get_metrics_rollups(granularity: str, start: datetime, end: Optional[datetime] = None):
+    """Get per-bucket Gemini API metrics (minute, hour or day) for a time range."""
+    if granularity not in ROLLUP_GRANULARITIES:
+        raise HTTPException(status_code=400, detail=f"granularity must be one of {ROLLUP_GRANULARITIES}")
+    rollups = await run_in_threadpool(GeminiMetrics.get_rollups, granularity, start, end)
+    return JSONResponse(content=[
+        {"bucket": rollup["bucket"].isoformat(), **summarize_rollups([rollup])}
+        for rollup in rollups
+    ])
+
 @app.get("/oauth/authorize")
 async def oauth_authorize():
     """OAuth authorization endpoint."""
@@ -361,23 +605,43 @@ async def gemini_metrics(credentials: HTTPBasicCredentials = Security(security))
             headers={"WWW-Authenticate": "Basic"},
         )
     return Response(
-        generate_latest(),
+        generate_latest(scrape_registry(system_metrics)),
         media_type=CONTENT_TYPE_LATEST
     )
 
+@app.get("/admin/profiles")
+async def get_profiles(limit: int = 100, credentials: HTTPBasicCredentials = Depends(verify_metrics_auth)):
+    """List captured request profiles, newest first."""
+    return await run_in_threadpool(list_profiles, max(1, min(limit, 1000)))
+
+@app.get("/admin/profiles/{profile_id}")
+async def download_profile(profile_id: str, credentials: HTTPBasicCredentials = Depends(verify_metrics_auth)):
+    """Download one profile (speedscope JSON or collapsed stacks)."""
+    path = get_profile_path(profile_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, filename=os.path.basename(path))
+
 @app.delete("/delete/{filename}/{documentId}")
 async def delete_document(
     filename: str,
     documentId: str,
     current_user: dict = Depends(get_current_user)
 ):
-    document = get_document_by_id(documentId)
-    result = delete_pdf_file(documentId)
+    document = await get_user_document(documentId, current_user["_id"], "meta")
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found")
+    key = (document.get("storage") or {}).get("key") or str(current_user["_id"]) + "_" + os.path.splitext(filename)[0]
+    # Once the document is gone, a queued or running background upload of it stops and cleans up
+    result = await delete_pdf_file(documentId)
     if result:
-        publicId = str(current_user["_id"]) + "_" + os.path.splitext(filename)[0]
-        print(publicId)
-        result = delete_file(publicId)
+        pdf_cache.delete(key)
+        discard_staged(key)
+        storage = get_storage()
+        if await run_in_threadpool(storage.delete, key):
+            result = (True, "Deleted successfully.")
+        else:
+            result = (False, f"File not found in {storage.name} storage")
         return {"response": result}
     else:
-        result = documents_collection.insert_one(document)
         return {"response": (False, "An error occured")}
\ No newline at end of file
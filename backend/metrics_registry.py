@@ -0,0 +1,80 @@
+"""Prometheus metrics shared across worker processes.
+
+When ``PROMETHEUS_MULTIPROC_DIR`` is set in the environment of every
+process (uvicorn workers, Celery workers, the inference server) before
+``prometheus_client`` is imported, each process writes its samples to
+files in that directory and a scrape of any API worker aggregates all of
+them. The directory must be emptied before the processes start; the
+files of processes that exit are cleaned up here.
+
+Without it, metrics stay in the scraped process's own registry.
+"""
+from prometheus_client import CollectorRegistry, REGISTRY
+from prometheus_client import multiprocess
+from typing import Optional
+import os
+import re
+import psutil
+import logging
+
+logger = logging.getLogger(__name__)
+
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR", "")
+
+# e.g. gauge_livesum_1234.db, counter_1234.db
+_PID_PATTERN = re.compile(r"_(\d+)\.db$")
+
+def multiprocess_enabled() -> bool:
+    return bool(PROMETHEUS_MULTIPROC_DIR)
+
+def scrape_registry(*collectors) -> CollectorRegistry:
+    """Registry for one scrape: every process's samples in multiprocess mode, else this process's.
+
+    ``collectors`` are added to the per-scrape registry in multiprocess mode;
+    in single-process mode they are expected to be in ``REGISTRY`` already.
+    """
+    if not multiprocess_enabled():
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=PROMETHEUS_MULTIPROC_DIR)
+    for collector in collectors:
+        registry.register(collector)
+    return registry
+
+def process_exited(pid: Optional[int] = None):
+    """Drop the live gauge samples of a process that is exiting or has exited.
+
+    Counter and histogram files are kept, so totals do not go backwards
+    when a worker is recycled.
+    """
+    if not multiprocess_enabled():
+        return
+    multiprocess.mark_process_dead(pid or os.getpid(), path=PROMETHEUS_MULTIPROC_DIR)
+
+def sweep_dead_processes() -> int:
+    """Clean up after processes that died without running their exit hook."""
+    if not multiprocess_enabled() or not os.path.isdir(PROMETHEUS_MULTIPROC_DIR):
+        return 0
+    pids = set()
+    for name in os.listdir(PROMETHEUS_MULTIPROC_DIR):
+        match = _PID_PATTERN.search(name)
+        if match:
+            pids.add(int(match.group(1)))
+    dead = [pid for pid in pids if not psutil.pid_exists(pid)]
+    for pid in dead:
+        process_exited(pid)
+    return len(dead)
+
+def install_celery_hooks():
+    """Clean up each Celery pool process's live gauges when it exits."""
+    if not multiprocess_enabled():
+        return
+    from celery.signals import worker_process_shutdown, worker_ready
+
+    @worker_process_shutdown.connect(weak=False)
+    def mark_pool_process_dead(pid=None, **kwargs):
+        process_exited(pid)
+
+    @worker_ready.connect(weak=False)
+    def sweep_on_start(**kwargs):
+        sweep_dead_processes()
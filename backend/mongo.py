@@ -0,0 +1,43 @@
+from pymongo import MongoClient
+from dotenv import load_dotenv
+from typing import Any, Dict
+import os
+
+from mongo_monitoring import command_listener
+
+load_dotenv()
+
+MONGO_URI = os.getenv("MONGO_URI")
+DATABASE_NAME = os.getenv("MONGO_DATABASE", "legal_doc_db")
+
+def client_options() -> Dict[str, Any]:
+    """Connection pool, timeout, read preference and monitoring settings shared by both clients."""
+    return {
+        "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", "100")),
+        "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", "0")),
+        "maxIdleTimeMS": int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000")),
+        "connectTimeoutMS": int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "10000")),
+        "serverSelectionTimeoutMS": int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "10000")),
+        "socketTimeoutMS": int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "30000")),
+        "readPreference": os.getenv("MONGO_READ_PREFERENCE", "primary"),
+        "event_listeners": [command_listener] if command_listener is not None else [],
+    }
+
+# One synchronous client per process, for Celery workers, threadpool code
+# and background threads
+client = MongoClient(MONGO_URI, **client_options())
+db = client[DATABASE_NAME]
+
+_async_client = None
+
+def get_async_db():
+    """Return the process-wide asyncio database handle, creating it on first use.
+
+    Created lazily so it binds to the running event loop rather than to
+    whatever loop exists at import time.
+    """
+    global _async_client
+    if _async_client is None:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        _async_client = AsyncIOMotorClient(MONGO_URI, **client_options())
+    return _async_client[DATABASE_NAME]
@@ -0,0 +1,138 @@
+"""MongoDB command monitoring.
+
+``command_listener`` is registered on both Mongo clients (see
+``mongo.client_options``). It times every command by collection and
+command name, measures reply sizes and counts failures. Commands slower
+than ``MONGO_SLOW_COMMAND_MS`` are logged with the shape of their filter,
+with every value replaced by ``"?"``. Commands run inside a traced stage
+also become child spans of it.
+"""
+from pymongo import monitoring
+from prometheus_client import Counter, Histogram
+from typing import Any, Dict, Tuple
+import bson
+import json
+import os
+import time
+import logging
+
+from tracing import record_span
+
+logger = logging.getLogger(__name__)
+
+MONGO_COMMAND_MONITORING = os.getenv("MONGO_COMMAND_MONITORING", "true").lower() == "true"
+MONGO_SLOW_COMMAND_MS = float(os.getenv("MONGO_SLOW_COMMAND_MS", "100"))
+# Re-encodes each reply to measure it; turn off if that shows up in profiles
+MONGO_MEASURE_REPLY_BYTES = os.getenv("MONGO_MEASURE_REPLY_BYTES", "true").lower() == "true"
+
+MONGO_COMMAND_SECONDS = Histogram(
+    'mongo_command_duration_seconds', 'MongoDB command latency', ['collection', 'command'],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+MONGO_REPLY_BYTES = Histogram(
+    'mongo_reply_bytes', 'Size of MongoDB command replies', ['collection', 'command'],
+    buckets=(100, 1000, 10000, 100000, 1000000, 4000000, 16000000)
+)
+MONGO_COMMAND_ERRORS = Counter('mongo_command_errors_total', 'Failed MongoDB commands', ['collection', 'command'])
+MONGO_SLOW_COMMANDS = Counter('mongo_slow_commands_total', 'MongoDB commands slower than MONGO_SLOW_COMMAND_MS', ['collection', 'command'])
+
+# Where each command keeps the filter that decides which documents it reads
+FILTER_FIELDS = {
+    "find": "filter",
+    "count": "query",
+    "distinct": "query",
+    "findAndModify": "query",
+    "aggregate": "pipeline",
+}
+# Bulk write commands: the list of statements and the filter in each
+STATEMENT_FILTERS = {"update": ("updates", "q"), "delete": ("deletes", "q")}
+
+def redact(value: Any) -> Any:
+    """Keep keys, operators and clause structure; replace every value with ``"?"``."""
+    if isinstance(value, dict):
+        return {key: redact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        # Clause lists ($and, $or, pipelines) keep their shape; value lists collapse
+        if value and all(isinstance(item, dict) for item in value):
+            return [redact(item) for item in value]
+        return ["?"] if value else []
+    return "?"
+
+def command_shape(name: str, command: Dict[str, Any]) -> Dict[str, Any]:
+    shape: Dict[str, Any] = {}
+    if name in FILTER_FIELDS:
+        shape["filter"] = redact(command.get(FILTER_FIELDS[name]) or {})
+    elif name in STATEMENT_FILTERS:
+        field, key = STATEMENT_FILTERS[name]
+        statements = command.get(field) or []
+        # A bulk write's statements usually share one shape; the first stands for all
+        shape["filter"] = redact(statements[0].get(key) or {}) if statements else {}
+        shape["statements"] = len(statements)
+    if command.get("sort"):
+        shape["sort"] = dict(command["sort"])
+    if name == "find" and command.get("limit"):
+        shape["limit"] = command["limit"]
+    return shape
+
+def _collection(name: str, command: Dict[str, Any]) -> str:
+    if name == "getMore":
+        return command.get("collection", "")
+    target = command.get(name)
+    return target if isinstance(target, str) else ""
+
+class CommandMetricsListener(monitoring.CommandListener):
+    """Record latency, reply size and failures of every command, and log slow ones."""
+
+    def __init__(self):
+        # (connection, request id) -> (collection, command, started at ns, command document)
+        self._pending: Dict[Tuple[Any, int], Tuple[str, str, int, Dict[str, Any]]] = {}
+
+    def started(self, event):
+        self._pending[(event.connection_id, event.request_id)] = (
+            _collection(event.command_name, event.command), event.command_name, time.time_ns(), event.command
+        )
+
+    def _finish(self, event, error=None):
+        pending = self._pending.pop((event.connection_id, event.request_id), None)
+        if pending is None:
+            return None
+        collection, name, start_ns, command = pending
+        duration = event.duration_micros / 1e6
+        MONGO_COMMAND_SECONDS.labels(collection=collection, command=name).observe(duration)
+        record_span(
+            f"mongo.{name}", start_ns, start_ns + event.duration_micros * 1000, error,
+            **{"db.collection": collection, "db.operation": name}
+        )
+        return collection, name, duration, command
+
+    def succeeded(self, event):
+        finished = self._finish(event)
+        if finished is None:
+            return
+        collection, name, duration, command = finished
+
+        reply_bytes = None
+        if MONGO_MEASURE_REPLY_BYTES:
+            try:
+                reply_bytes = len(bson.encode(event.reply))
+                MONGO_REPLY_BYTES.labels(collection=collection, command=name).observe(reply_bytes)
+            except Exception:
+                pass
+
+        if duration * 1000 >= MONGO_SLOW_COMMAND_MS:
+            MONGO_SLOW_COMMANDS.labels(collection=collection, command=name).inc()
+            logger.warning(
+                f"Slow MongoDB {name} on {event.database_name}.{collection}: {duration * 1000:.0f} ms, "
+                f"{reply_bytes if reply_bytes is not None else '?'} bytes returned, "
+                f"shape {json.dumps(command_shape(name, command), default=str)}"
+            )
+
+    def failed(self, event):
+        failure = event.failure if isinstance(event.failure, dict) else {}
+        finished = self._finish(event, error=f"{failure.get('codeName', 'error')}: {failure.get('errmsg', event.failure)}")
+        if finished is None:
+            return
+        collection, name, _, _ = finished
+        MONGO_COMMAND_ERRORS.labels(collection=collection, command=name).inc()
+
+command_listener = CommandMetricsListener() if MONGO_COMMAND_MONITORING else None
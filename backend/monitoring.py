@@ -1,13 +1,29 @@
-from prometheus_client import Counter, Histogram, Gauge
+from prometheus_client import Counter, Histogram, Gauge, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from typing import List
+import os
 import psutil
 import time
-from typing import Callable
-from fastapi import Request, Response
 import logging
 
+from metrics_registry import multiprocess_enabled, scrape_registry
+
 logger = logging.getLogger(__name__)
 
-# Request metrics
+def _buckets(name: str, default: str) -> List[float]:
+    return [float(bound) for bound in os.getenv(name, default).split(",") if bound.strip()]
+
+HTTP_LATENCY_BUCKETS = _buckets("HTTP_LATENCY_BUCKETS", "0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60")
+HTTP_SIZE_BUCKETS = _buckets("HTTP_SIZE_BUCKETS", "100,1000,10000,100000,1000000,10000000,100000000")
+
+# Label for requests that match no route, so unknown paths cannot add series
+UNMATCHED_ROUTE = "<unmatched>"
+
+# Request metrics, labelled by route template (e.g. /chat/{filename}/{documentId})
 REQUEST_COUNT = Counter(
     'http_requests_total',
     'Total HTTP requests',
@@ -17,23 +33,22 @@ REQUEST_COUNT = Counter(
 REQUEST_LATENCY = Histogram(
     'http_request_duration_seconds',
     'HTTP request duration in seconds',
-    ['method', 'endpoint']
+    ['method', 'endpoint'],
+    buckets=HTTP_LATENCY_BUCKETS
 )
 
-# System metrics
-CPU_USAGE = Gauge(
-    'system_cpu_usage_percent',
-    'System CPU usage percentage'
+REQUESTS_IN_PROGRESS = Gauge(
+    'http_requests_in_progress',
+    'HTTP requests being handled',
+    ['method', 'endpoint'],
+    multiprocess_mode='livesum'
 )
 
-MEMORY_USAGE = Gauge(
-    'system_memory_usage_bytes',
-    'System memory usage in bytes'
-)
-
-DISK_USAGE = Gauge(
-    'system_disk_usage_bytes',
-    'System disk usage in bytes'
+RESPONSE_SIZE = Histogram(
+    'http_response_size_bytes',
+    'HTTP response body size in bytes',
+    ['method', 'endpoint'],
+    buckets=HTTP_SIZE_BUCKETS
 )
 
 # API specific metrics
@@ -55,40 +70,78 @@ SUMMARY_REQUESTS = Counter(
     ['status']
 )
 
-def update_system_metrics():
-    """Update system metrics periodically"""
-    while True:
+class SystemMetricsCollector:
+    """Host CPU, memory and disk usage, read when /metrics is scraped."""
+
+    def collect(self):
         try:
-            # CPU usage
-            CPU_USAGE.set(psutil.cpu_percent())
-            
-            # Memory usage
+            cpu = psutil.cpu_percent()
             memory = psutil.virtual_memory()
-            MEMORY_USAGE.set(memory.used)
-            
-            # Disk usage
             disk = psutil.disk_usage('/')
-            DISK_USAGE.set(disk.used)
-            
-            time.sleep(5) 
         except Exception as e:
-            logger.error(f"Error updating system metrics: {str(e)}")
-            time.sleep(5)
-
-async def monitor_request(request: Request, call_next: Callable) -> Response:
-    """Middleware to monitor requests"""
-    start_time = time.time()
-    method = request.method
-    endpoint = request.url.path
-    
-    try:
-        response = await call_next(request)
-        status = response.status_code
-        
-        REQUEST_COUNT.labels(method=method, endpoint=endpoint, status=status).inc()
-        REQUEST_LATENCY.labels(method=method, endpoint=endpoint).observe(time.time() - start_time)
-        
-        return response
-    except Exception as e:
-        logger.error(f"Error in request monitoring: {str(e)}")
-        raise 
\ No newline at end of file
+            logger.error(f"Error reading system metrics: {str(e)}")
+            return
+        yield GaugeMetricFamily('system_cpu_usage_percent', 'System CPU usage percentage', value=cpu)
+        yield GaugeMetricFamily('system_memory_usage_bytes', 'System memory usage in bytes', value=memory.used)
+        yield GaugeMetricFamily('system_disk_usage_bytes', 'System disk usage in bytes', value=disk.used)
+
+system_metrics = SystemMetricsCollector()
+# CPU usage is measured between calls; start the first interval now
+psutil.cpu_percent()
+if not multiprocess_enabled():
+    REGISTRY.register(system_metrics)
+
+def metrics(request: Request) -> Response:
+    """Serve metrics from every worker process (multiprocess mode) or this one."""
+    return Response(generate_latest(scrape_registry(system_metrics)), media_type=CONTENT_TYPE_LATEST)
+
+def route_template(scope: Scope) -> str:
+    """Return the path template of the route that handles this request."""
+    app = scope.get("app")
+    partial = None
+    for route in getattr(app, "routes", []):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path  # Path matches but not the method (405)
+    return partial or UNMATCHED_ROUTE
+
+class RequestMetricsMiddleware:
+    """Count, time and size HTTP requests, labelled by route template.
+
+    A plain ASGI middleware, so streamed responses are timed until their
+    last byte and counted by the bytes actually sent.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        endpoint = route_template(scope)
+        status = 500
+        size = 0
+
+        async def send_with_metrics(message: Message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        in_progress = REQUESTS_IN_PROGRESS.labels(method=method, endpoint=endpoint)
+        in_progress.inc()
+        start_time = time.time()
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            in_progress.dec()
+            REQUEST_COUNT.labels(method=method, endpoint=endpoint, status=status).inc()
+            REQUEST_LATENCY.labels(method=method, endpoint=endpoint).observe(time.time() - start_time)
+            RESPONSE_SIZE.labels(method=method, endpoint=endpoint).observe(size)
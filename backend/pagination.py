@@ -0,0 +1,79 @@
+from bson import ObjectId
+from bson.errors import InvalidId
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+import base64
+import json
+
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(sort_value: datetime, object_id: ObjectId) -> str:
+    """Encode the sort key of the last item on a page as an opaque cursor."""
+    raw = json.dumps([sort_value.isoformat(), str(object_id)])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, ObjectId]:
+    """Decode a cursor from ``encode_cursor``; raises ValueError if malformed."""
+    try:
+        sort_value, object_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(sort_value), ObjectId(object_id)
+    except (ValueError, TypeError, InvalidId) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+def _page_query(query: Dict[str, Any], sort_field: str, cursor: Optional[str]) -> Dict[str, Any]:
+    if not cursor:
+        return query
+    sort_value, object_id = decode_cursor(cursor)
+    return {
+        **query,
+        "$or": [
+            {sort_field: {"$lt": sort_value}},
+            {sort_field: sort_value, "_id": {"$lt": object_id}}
+        ]
+    }
+
+def _page_result(documents: List[Dict[str, Any]], sort_field: str, limit: int) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    if len(documents) <= limit:
+        return documents, None
+    documents = documents[:limit]
+    last = documents[-1]
+    return documents, encode_cursor(last[sort_field], last["_id"])
+
+def keyset_page(
+    collection,
+    query: Dict[str, Any],
+    sort_field: str,
+    limit: int,
+    cursor: Optional[str] = None,
+    projection: Optional[Dict[str, int]] = None
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Fetch one page ordered newest first by ``(sort_field, _id)``.
+
+    Returns the page and the cursor for the next one (``None`` on the last
+    page). The query should be backed by an index on
+    ``(<query fields>, sort_field desc, _id desc)``.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    documents = list(
+        collection.find(_page_query(query, sort_field, cursor), projection)
+        .sort([(sort_field, -1), ("_id", -1)])
+        .limit(limit + 1)
+    )
+    return _page_result(documents, sort_field, limit)
+
+async def keyset_page_async(
+    collection,
+    query: Dict[str, Any],
+    sort_field: str,
+    limit: int,
+    cursor: Optional[str] = None,
+    projection: Optional[Dict[str, int]] = None
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """``keyset_page`` for an asyncio (Motor) collection."""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    documents = await (
+        collection.find(_page_query(query, sort_field, cursor), projection)
+        .sort([(sort_field, -1), ("_id", -1)])
+        .to_list(length=limit + 1)
+    )
+    return _page_result(documents, sort_field, limit)
@@ -0,0 +1,59 @@
+from concurrent.futures import ThreadPoolExecutor
+from prometheus_client import Counter, Gauge, Histogram
+import asyncio
+import os
+import threading
+import time
+import logging
+
+from database import pwd_context
+
+logger = logging.getLogger(__name__)
+
+# bcrypt is CPU-bound; run it on a small dedicated pool instead of the event loop
+BCRYPT_MAX_WORKERS = int(os.getenv("BCRYPT_MAX_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Operations allowed to wait for a worker before new ones are rejected
+BCRYPT_MAX_PENDING = int(os.getenv("BCRYPT_MAX_PENDING", "64"))
+
+BCRYPT_POOL_SIZE = Gauge('bcrypt_pool_size', 'Threads available for password hashing', multiprocess_mode='livesum')
+BCRYPT_IN_FLIGHT = Gauge('bcrypt_in_flight', 'Password hash operations queued or running', multiprocess_mode='livesum')
+BCRYPT_REJECTED = Counter('bcrypt_rejected_total', 'Password hash operations rejected because the pool was saturated')
+BCRYPT_QUEUE_WAIT = Histogram('bcrypt_queue_wait_seconds', 'Time password hash operations waited for a worker')
+BCRYPT_DURATION = Histogram('bcrypt_duration_seconds', 'Time spent hashing or verifying passwords', ['operation'])
+
+BCRYPT_POOL_SIZE.set(BCRYPT_MAX_WORKERS)
+
+class PasswordHashingBusy(Exception):
+    """Raised when too many password hash operations are already waiting."""
+
+_executor = ThreadPoolExecutor(max_workers=BCRYPT_MAX_WORKERS, thread_name_prefix="bcrypt")
+_pending = 0
+_pending_lock = threading.Lock()
+
+def _timed(operation: str, submitted: float, fn, *args):
+    BCRYPT_QUEUE_WAIT.observe(time.time() - submitted)
+    with BCRYPT_DURATION.labels(operation=operation).time():
+        return fn(*args)
+
+async def _run(operation: str, fn, *args):
+    global _pending
+    with _pending_lock:
+        if _pending >= BCRYPT_MAX_WORKERS + BCRYPT_MAX_PENDING:
+            BCRYPT_REJECTED.inc()
+            raise PasswordHashingBusy("Too many concurrent logins, please retry shortly")
+        _pending += 1
+    BCRYPT_IN_FLIGHT.inc()
+
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, _timed, operation, time.time(), fn, *args)
+    finally:
+        with _pending_lock:
+            _pending -= 1
+        BCRYPT_IN_FLIGHT.dec()
+
+async def hash_password(password: str) -> str:
+    return await _run("hash", pwd_context.hash, password)
+
+async def verify_password(password: str, hashed_password: str) -> bool:
+    return await _run("verify", pwd_context.verify, password, hashed_password)
@@ -0,0 +1,187 @@
+from typing import Optional
+from prometheus_client import Counter, Gauge
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import logging
+
+try:
+    import fcntl
+except ImportError:  # Windows: evictions from several workers may overlap, which is harmless
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+PDF_CACHE_DIR = os.getenv("PDF_CACHE_DIR", "pdf_cache")
+PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+# The running size only counts this process's writes; re-measure the shared directory this often
+PDF_CACHE_RESCAN_SECONDS = float(os.getenv("PDF_CACHE_RESCAN_SECONDS", "300"))
+
+PDF_CACHE_LOOKUPS = Counter('pdf_cache_lookups_total', 'Local PDF cache lookups', ['result'])
+PDF_CACHE_EVICTIONS = Counter('pdf_cache_evictions_total', 'PDFs evicted from the local cache')
+# The cache directory is shared by every worker, so the latest pass from any of them is current
+PDF_CACHE_BYTES = Gauge(
+    'pdf_cache_bytes', 'Bytes held in the local PDF cache after the last eviction pass', multiprocess_mode='mostrecent'
+)
+
+class PdfCacheWriter:
+    """Write a PDF into the cache incrementally; nothing is visible until ``commit``."""
+
+    def __init__(self, cache: "PdfCache", key: str):
+        self.cache = cache
+        self.key = key
+        self._digest = hashlib.sha256()
+        self._file = tempfile.NamedTemporaryFile(dir=cache.tmp_dir, delete=False)
+
+    def write(self, data: bytes):
+        self._digest.update(data)
+        self._file.write(data)
+
+    def commit(self) -> str:
+        self._file.close()
+        return self.cache._adopt(self.key, self._file.name, self._digest.hexdigest())
+
+    def discard(self):
+        self._file.close()
+        try:
+            os.remove(self._file.name)
+        except FileNotFoundError:
+            pass
+
+class PdfCache:
+    """Size-bounded, content-addressed PDF cache on local disk.
+
+    PDF bytes live under ``objects/`` named by their SHA-256, and ``keys/``
+    maps a storage key (the Cloudinary public id) to that digest. Every
+    write goes to a temporary file and is renamed into place, so several
+    worker processes can share one directory. A hit refreshes the object's
+    mtime, and eviction removes the least recently used objects once the
+    total size passes ``max_bytes``. A running byte total avoids walking
+    the directory on every write; it is re-measured when it passes the
+    budget or is older than ``PDF_CACHE_RESCAN_SECONDS``.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(root, "objects")
+        self.keys_dir = os.path.join(root, "keys")
+        self.tmp_dir = os.path.join(root, "tmp")
+        for directory in (self.objects_dir, self.keys_dir, self.tmp_dir):
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._total_bytes: Optional[int] = None  # Unknown until the first scan
+        self._scanned_at = 0.0
+
+    def _key_path(self, key: str) -> str:
+        return os.path.join(self.keys_dir, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.objects_dir, digest[:2], f"{digest}.pdf")
+
+    def _atomic_write_text(self, path: str, text: str):
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    def lookup(self, key: str) -> Optional[tuple[str, str]]:
+        """Return ``(path, sha256)`` of the cached PDF for ``key``, or None."""
+        try:
+            with open(self._key_path(key)) as f:
+                digest = f.read().strip()
+            path = self._object_path(digest)
+            os.utime(path)  # Mark as recently used
+            PDF_CACHE_LOOKUPS.labels(result="hit").inc()
+            return path, digest
+        except (FileNotFoundError, ValueError):
+            PDF_CACHE_LOOKUPS.labels(result="miss").inc()
+            return None
+
+    def writer(self, key: str) -> PdfCacheWriter:
+        return PdfCacheWriter(self, key)
+
+    def put_file(self, key: str, src_path: str) -> str:
+        """Copy a local file into the cache under ``key`` and return its digest."""
+        writer = self.writer(key)
+        try:
+            with open(src_path, "rb") as src:
+                for block in iter(lambda: src.read(1024 * 1024), b""):
+                    writer.write(block)
+        except Exception:
+            writer.discard()
+            raise
+        return writer.commit()
+
+    def _adopt(self, key: str, tmp_path: str, digest: str) -> str:
+        path = self._object_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        added = 0
+        if os.path.exists(path):
+            os.remove(tmp_path)  # Same content is already cached
+            os.utime(path)
+        else:
+            added = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        self._atomic_write_text(self._key_path(key), digest)
+        if self._needs_scan(added):
+            self.evict()
+        return digest
+
+    def _needs_scan(self, added: int) -> bool:
+        with self._lock:
+            if self._total_bytes is None or time.monotonic() - self._scanned_at > PDF_CACHE_RESCAN_SECONDS:
+                return True
+            self._total_bytes += added
+            return self._total_bytes > self.max_bytes
+
+    def delete(self, key: str):
+        """Forget ``key``; its bytes stay until evicted, as other keys may share them."""
+        try:
+            os.remove(self._key_path(key))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        """Remove least recently used objects until the cache fits its byte budget."""
+        lock = open(os.path.join(self.root, ".evict.lock"), "w")
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return  # Another worker is already evicting
+
+            entries = []
+            total = 0
+            for dirpath, _, filenames in os.walk(self.objects_dir):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                    total += stat.st_size
+
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    # Open file handles keep working on POSIX after removal
+                    os.remove(path)
+                    total -= size
+                    PDF_CACHE_EVICTIONS.inc()
+                except FileNotFoundError:
+                    pass
+            PDF_CACHE_BYTES.set(total)
+            with self._lock:
+                self._total_bytes = total
+                self._scanned_at = time.monotonic()
+        finally:
+            lock.close()
+
+pdf_cache = PdfCache(PDF_CACHE_DIR, PDF_CACHE_MAX_BYTES)
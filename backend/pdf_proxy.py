@@ -0,0 +1,170 @@
+from fastapi import HTTPException, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from typing import AsyncIterator, Dict, Optional
+import asyncio
+import httpx
+from starlette.concurrency import run_in_threadpool
+from pdf_cache import pdf_cache, PdfCacheWriter
+from storage import get_storage
+from storage_uploads import staged_path
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+PDF_PROXY_MAX_CONNECTIONS = int(os.getenv("PDF_PROXY_MAX_CONNECTIONS", "100"))
+PDF_PROXY_MAX_KEEPALIVE = int(os.getenv("PDF_PROXY_MAX_KEEPALIVE", "20"))
+PDF_PROXY_TIMEOUT = float(os.getenv("PDF_PROXY_TIMEOUT", "30.0"))
+
+# Client headers passed upstream so the CDN can answer ranges and revalidations
+FORWARDED_REQUEST_HEADERS = ("range", "if-range", "if-none-match", "if-modified-since")
+# Upstream headers passed back to the client
+PASSTHROUGH_RESPONSE_HEADERS = (
+    "content-length", "content-range", "accept-ranges", "etag", "last-modified", "cache-control"
+)
+PASSTHROUGH_STATUSES = (200, 206, 304, 416)
+
+_client: Optional[httpx.AsyncClient] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """Return the process-wide pooled HTTP client, creating it on first use."""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=PDF_PROXY_MAX_CONNECTIONS,
+                max_keepalive_connections=PDF_PROXY_MAX_KEEPALIVE
+            ),
+            timeout=PDF_PROXY_TIMEOUT
+        )
+    return _client
+
+async def close_http_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+async def _relay(upstream: httpx.Response, cache_writer: Optional[PdfCacheWriter] = None) -> AsyncIterator[bytes]:
+    complete = False
+    try:
+        async for chunk in upstream.aiter_raw():
+            if cache_writer is not None:
+                cache_writer.write(chunk)
+            yield chunk
+        complete = True
+    finally:
+        # Also runs when the client disconnects mid-download
+        await upstream.aclose()
+        if cache_writer is not None:
+            if complete:
+                # Commit may run an eviction pass; keep it off the event loop
+                await asyncio.get_running_loop().run_in_executor(None, cache_writer.commit)
+            else:
+                cache_writer.discard()
+
+async def proxy_pdf(url: str, request: Request, filename: str, cache_key: Optional[str] = None) -> Response:
+    """Stream a PDF from ``url`` without buffering it.
+
+    Range and conditional request headers are forwarded, and partial
+    content, ETag/Last-Modified validators and 304 responses are passed
+    back unchanged, so viewers can fetch pages incrementally and reuse
+    cached copies. A complete (200) download is also written to the local
+    PDF cache under ``cache_key``.
+    """
+    headers: Dict[str, str] = {
+        name: request.headers[name] for name in FORWARDED_REQUEST_HEADERS if name in request.headers
+    }
+    # Byte ranges must refer to the stored bytes, not a compressed encoding
+    headers["accept-encoding"] = "identity"
+
+    client = get_http_client()
+    upstream = await client.send(client.build_request("GET", url, headers=headers), stream=True)
+
+    if upstream.status_code not in PASSTHROUGH_STATUSES:
+        await upstream.aclose()
+        logger.debug(f"Upstream returned {upstream.status_code} for {url}")
+        status_code = 404 if upstream.status_code == 404 else 502
+        raise HTTPException(status_code=status_code, detail="File not found" if status_code == 404 else "Storage unavailable")
+
+    response_headers = {
+        name: upstream.headers[name] for name in PASSTHROUGH_RESPONSE_HEADERS if name in upstream.headers
+    }
+    response_headers["Content-Disposition"] = f"inline; filename={filename}"
+    response_headers.setdefault("accept-ranges", "bytes")
+
+    if upstream.status_code in (304, 416):
+        await upstream.aclose()
+        return Response(status_code=upstream.status_code, headers=response_headers)
+
+    cache_writer = None
+    if cache_key is not None and upstream.status_code == 200 and "content-encoding" not in upstream.headers:
+        cache_writer = pdf_cache.writer(cache_key)
+
+    return StreamingResponse(
+        _relay(upstream, cache_writer),
+        status_code=upstream.status_code,
+        media_type="application/pdf",
+        headers=response_headers
+    )
+
+def serve_cached_pdf(path: str, digest: str, request: Request, filename: str) -> Response:
+    """Serve a cached PDF straight from disk, with Range support and a content ETag."""
+    etag = f'"{digest}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"etag": etag})
+    return FileResponse(
+        path,
+        media_type="application/pdf",
+        headers={
+            "etag": etag,
+            "cache-control": "private, max-age=0, must-revalidate",
+            "Content-Disposition": f"inline; filename={filename}"
+        }
+    )
+
+def _fill_cache_from_storage(key: str) -> Optional[tuple[str, str]]:
+    storage = get_storage()
+    writer = pdf_cache.writer(key)
+    try:
+        for chunk in storage.stream(key):
+            writer.write(chunk)
+    except Exception:
+        writer.discard()
+        raise
+    writer.commit()
+    return pdf_cache.lookup(key)
+
+async def serve_pdf(key: str, request: Request, filename: str) -> Response:
+    """Serve a document PDF by storage key.
+
+    The local cache is tried first, then a file still waiting in the upload
+    staging area, then the backend: proxied from its URL when it has one,
+    sent from disk when it is local, and otherwise streamed into the cache
+    and served from there.
+    """
+    cached = pdf_cache.lookup(key)
+    if cached is not None:
+        return serve_cached_pdf(cached[0], cached[1], request, filename)
+
+    staged = staged_path(key)
+    if os.path.exists(staged):
+        return FileResponse(staged, media_type="application/pdf", headers={"Content-Disposition": f"inline; filename={filename}"})
+
+    storage = get_storage()
+    url = storage.url(key)
+    if url is not None:
+        return await proxy_pdf(url, request, filename, cache_key=key)
+
+    path = storage.local_path(key)
+    if path is not None:
+        return FileResponse(path, media_type="application/pdf", headers={"Content-Disposition": f"inline; filename={filename}"})
+
+    try:
+        cached = await run_in_threadpool(_fill_cache_from_storage, key)
+    except Exception as e:
+        logger.debug(f"Reading {key} from {storage.name} failed: {e}")
+        raise HTTPException(status_code=404, detail="File not found")
+    if cached is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return serve_cached_pdf(cached[0], cached[1], request, filename)
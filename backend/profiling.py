@@ -0,0 +1,189 @@
+"""On-demand request profiling.
+
+A request is profiled with pyinstrument's sampling profiler when it sends
+an ``X-Profile`` header equal to ``PROFILER_TOKEN``, or when its route is
+picked by the sampling rate in ``PROFILE_SAMPLE_RATES`` (e.g.
+``/upload=0.05,/chat/{filename}/{documentId}=0.01``). Requested profiles
+are always kept; sampled ones only when the request took at least
+``PROFILE_SLOW_SECONDS``. Profiles are written to ``PROFILE_DIR`` in
+speedscope or collapsed-stack format, with a JSON sidecar describing the
+request, and only the newest ``PROFILE_MAX_FILES`` are kept.
+
+Profiling follows the request's own task, so time the request spends
+waiting on a worker thread shows up as the await that waits for it.
+"""
+from datetime import datetime
+from starlette.concurrency import run_in_threadpool
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from typing import Any, Dict, List, Optional
+import hmac
+import json
+import os
+import random
+import re
+import time
+import uuid
+import logging
+
+from monitoring import route_template
+
+logger = logging.getLogger(__name__)
+
+# Unset disables the header trigger
+PROFILER_TOKEN = os.getenv("PROFILER_TOKEN", "")
+PROFILE_SAMPLE_RATES = os.getenv("PROFILE_SAMPLE_RATES", "")
+PROFILE_SLOW_SECONDS = float(os.getenv("PROFILE_SLOW_SECONDS", "2"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.001"))
+# speedscope (open at https://www.speedscope.app) or collapsed (flamegraph.pl, speedscope)
+PROFILE_FORMAT = os.getenv("PROFILE_FORMAT", "speedscope")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "200"))
+
+PROFILE_HEADER = b"x-profile"
+PROFILE_ID_PATTERN = re.compile(r"^\d{13}-[0-9a-f]{8}$")
+EXTENSIONS = {"speedscope": ".speedscope.json", "collapsed": ".collapsed.txt"}
+
+def _parse_rates(spec: str) -> Dict[str, float]:
+    rates = {}
+    for entry in spec.split(","):
+        route, _, rate = entry.strip().rpartition("=")
+        if route:
+            rates[route] = float(rate)
+    return rates
+
+SAMPLE_RATES = _parse_rates(PROFILE_SAMPLE_RATES)
+
+def _profiler_class():
+    try:
+        from pyinstrument import Profiler
+        return Profiler
+    except ImportError:
+        return None
+
+def _collapsed(root) -> str:
+    """Render a pyinstrument frame tree as collapsed stacks, one ``a;b;c microseconds`` line per path."""
+    lines: List[str] = []
+
+    def walk(frame, path: List[str]):
+        path = path + [f"{frame.function} ({frame.file_path_short}:{frame.line_no})"]
+        # Await time and the like are synthetic leaf children, so they get lines of their own
+        self_time = frame.time - sum(child.time for child in frame.children)
+        if self_time > 0:
+            lines.append(f"{';'.join(path)} {round(self_time * 1e6)}")
+        for child in frame.children:
+            walk(child, path)
+
+    if root is not None:
+        walk(root, [])
+    return "\n".join(lines) + "\n"
+
+def _render(profiler) -> str:
+    if PROFILE_FORMAT == "collapsed":
+        return _collapsed(profiler.last_session.root_frame())
+    from pyinstrument.renderers import SpeedscopeRenderer
+    return profiler.output(SpeedscopeRenderer())
+
+def _prune():
+    metadata = sorted(name for name in os.listdir(PROFILE_DIR) if name.endswith(".meta.json"))
+    for name in metadata[:max(0, len(metadata) - PROFILE_MAX_FILES)]:
+        profile_id = name[:-len(".meta.json")]
+        for path in [name] + [profile_id + extension for extension in EXTENSIONS.values()]:
+            try:
+                os.remove(os.path.join(PROFILE_DIR, path))
+            except FileNotFoundError:
+                pass
+
+def save_profile(profile_id: str, profiler, metadata: Dict[str, Any]):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    extension = EXTENSIONS.get(PROFILE_FORMAT, EXTENSIONS["speedscope"])
+    with open(os.path.join(PROFILE_DIR, profile_id + extension), "w") as f:
+        f.write(_render(profiler))
+    # The sidecar is written last, so a listed profile is always complete
+    metadata = dict(metadata, id=profile_id, format=PROFILE_FORMAT, file=profile_id + extension)
+    with open(os.path.join(PROFILE_DIR, profile_id + ".meta.json"), "w") as f:
+        json.dump(metadata, f)
+    _prune()
+
+def list_profiles(limit: int = 100) -> List[Dict[str, Any]]:
+    """Newest profiles first."""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    names = sorted((name for name in os.listdir(PROFILE_DIR) if name.endswith(".meta.json")), reverse=True)
+    profiles = []
+    for name in names[:limit]:
+        try:
+            with open(os.path.join(PROFILE_DIR, name)) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return profiles
+
+def get_profile_path(profile_id: str) -> Optional[str]:
+    if not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    for extension in EXTENSIONS.values():
+        path = os.path.join(PROFILE_DIR, profile_id + extension)
+        if os.path.exists(path):
+            return path
+    return None
+
+class ProfilingMiddleware:
+    """Profile requests that ask for it with ``X-Profile`` or are sampled for their route."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.profiler_class = _profiler_class() if (PROFILER_TOKEN or SAMPLE_RATES) else None
+        if (PROFILER_TOKEN or SAMPLE_RATES) and self.profiler_class is None:
+            logger.warning("Request profiling is configured but pyinstrument is not installed")
+
+    def _requested(self, scope: Scope) -> bool:
+        if not PROFILER_TOKEN:
+            return False
+        header = dict(scope.get("headers") or []).get(PROFILE_HEADER)
+        return header is not None and hmac.compare_digest(header, PROFILER_TOKEN.encode())
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or self.profiler_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        route = route_template(scope)
+        requested = self._requested(scope)
+        if not requested and random.random() >= SAMPLE_RATES.get(route, 0.0):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = f"{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}"
+        status = 500
+
+        async def send_with_profile_id(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if requested:
+                    message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", profile_id.encode())]
+            await send(message)
+
+        profiler = self.profiler_class(interval=PROFILE_INTERVAL, async_mode="enabled")
+        start_time = time.time()
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            profiler.stop()
+            duration = time.time() - start_time
+            if requested or duration >= PROFILE_SLOW_SECONDS:
+                metadata = {
+                    "method": scope["method"],
+                    "route": route,
+                    "path": scope["path"],
+                    "status": status,
+                    "duration_seconds": round(duration, 3),
+                    "trigger": "header" if requested else "sampled",
+                    "created_at": datetime.utcnow().isoformat(),
+                }
+                try:
+                    # Rendering a profile is CPU work; keep it off the event loop
+                    await run_in_threadpool(save_profile, profile_id, profiler, metadata)
+                except Exception as e:
+                    logger.error(f"Saving profile {profile_id} failed: {e}")
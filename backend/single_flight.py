@@ -0,0 +1,92 @@
+import asyncio
+import hashlib
+import re
+import threading
+from typing import Any, Callable, Dict
+from prometheus_client import Counter
+import logging
+
+logger = logging.getLogger(__name__)
+
+SINGLE_FLIGHT_CALLS = Counter(
+    'single_flight_calls_total',
+    'Calls routed through a single-flight group',
+    ['group', 'result']  # result: leader | coalesced
+)
+
+def normalize_prompt(text: str) -> str:
+    """Normalize a prompt so trivially different spellings share one key."""
+    if not text:
+        return ""
+    return re.sub(r'\s+', ' ', text).strip().casefold()
+
+def make_key(*parts: Any) -> str:
+    """Build a compact, stable key from the given parts."""
+    raw = "\x1f".join("" if part is None else str(part) for part in parts)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """Coalesce concurrent identical calls into a single execution.
+
+    While a call for a key is in flight, later callers with the same key wait
+    for it and receive its result (or its exception) instead of running the
+    work again. Nothing is cached once the call finishes.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._futures: Dict[str, asyncio.Future] = {}
+
+    def do(self, key: str, fn: Callable, *args, **kwargs):
+        """Run ``fn`` for ``key`` from a thread, sharing any in-flight call."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            SINGLE_FLIGHT_CALLS.labels(group=self.name, result="coalesced").inc()
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        SINGLE_FLIGHT_CALLS.labels(group=self.name, result="leader").inc()
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    def _forget(self, key: str, future: asyncio.Future):
+        if self._futures.get(key) is future:
+            del self._futures[key]
+
+    async def do_async(self, key: str, fn: Callable, *args, **kwargs):
+        """Await ``fn(*args, **kwargs)`` for ``key``, sharing any in-flight call."""
+        future = self._futures.get(key)
+        if future is not None:
+            SINGLE_FLIGHT_CALLS.labels(group=self.name, result="coalesced").inc()
+            # Shield so one waiter disconnecting does not cancel the others
+            return await asyncio.shield(future)
+
+        SINGLE_FLIGHT_CALLS.labels(group=self.name, result="leader").inc()
+        future = asyncio.ensure_future(fn(*args, **kwargs))
+        self._futures[key] = future
+        future.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(future)
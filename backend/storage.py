@@ -0,0 +1,167 @@
+from typing import BinaryIO, Iterator, Optional
+from dotenv import load_dotenv
+import os
+import shutil
+import tempfile
+import logging
+
+logger = logging.getLogger(__name__)
+load_dotenv()
+
+# Where document PDFs are kept: cloudinary | gridfs | local
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "cloudinary")
+LOCAL_STORAGE_DIR = os.getenv("LOCAL_STORAGE_DIR", "storage")
+STREAM_CHUNK_SIZE = 256 * 1024
+
+class StorageBackend:
+    """Where document PDFs live, addressed by a string key.
+
+    ``url`` and ``local_path`` are optional shortcuts for serving: a backend
+    returns ``None`` when it cannot provide them and callers fall back to
+    ``stream``.
+    """
+
+    name = "base"
+
+    def put(self, key: str, fileobj: BinaryIO):
+        raise NotImplementedError
+
+    def get(self, key: str) -> bytes:
+        return b"".join(self.stream(key))
+
+    def stream(self, key: str, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def url(self, key: str) -> Optional[str]:
+        return None
+
+    def local_path(self, key: str) -> Optional[str]:
+        return None
+
+class CloudinaryStorage(StorageBackend):
+    name = "cloudinary"
+
+    def __init__(self):
+        # Imported here so local and GridFS setups do not need Cloudinary configured
+        import cloud_storage
+        import httpx
+        self.cloud = cloud_storage
+        self._http = httpx.Client(timeout=30.0)
+
+    def put(self, key: str, fileobj: BinaryIO):
+        # Raises on failure so callers can retry
+        self.cloud.cloudinary.uploader.upload(fileobj, resource_type="raw", public_id=key)
+
+    def stream(self, key: str, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+        with self._http.stream("GET", self.url(key)) as response:
+            response.raise_for_status()
+            for chunk in response.iter_bytes():
+                yield chunk
+
+    def delete(self, key: str) -> bool:
+        success, message = self.cloud.delete_file(key)
+        if not success:
+            logger.debug(f"Cloudinary delete of {key} failed: {message}")
+        return success
+
+    def exists(self, key: str) -> bool:
+        from cloudinary.exceptions import NotFound
+        try:
+            self.cloud.cloudinary.api.resource(key, resource_type="raw")
+            return True
+        except NotFound:
+            return False
+
+    def url(self, key: str) -> Optional[str]:
+        return self.cloud.get_pdf_url(key)
+
+class GridFSStorage(StorageBackend):
+    name = "gridfs"
+
+    def __init__(self):
+        from database import fs
+        self.fs = fs
+
+    def put(self, key: str, fileobj: BinaryIO):
+        new_id = self.fs.put(fileobj, filename=key)
+        # Keep only the newest version of the key
+        for old in self.fs.find({"filename": key, "_id": {"$ne": new_id}}):
+            self.fs.delete(old._id)
+
+    def stream(self, key: str, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+        grid_out = self.fs.get_last_version(filename=key)
+        for block in iter(lambda: grid_out.read(chunk_size), b""):
+            yield block
+
+    def delete(self, key: str) -> bool:
+        deleted = False
+        for grid_out in self.fs.find({"filename": key}):
+            self.fs.delete(grid_out._id)
+            deleted = True
+        return deleted
+
+    def exists(self, key: str) -> bool:
+        return self.fs.exists(filename=key)
+
+class LocalStorage(StorageBackend):
+    name = "local"
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        safe_key = key.replace("/", "_").replace("\\", "_")
+        return os.path.join(self.root, f"{safe_key}.pdf")
+
+    def put(self, key: str, fileobj: BinaryIO):
+        fd, tmp_path = tempfile.mkstemp(dir=self.root)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(fileobj, f)
+            os.replace(tmp_path, self._path(key))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def stream(self, key: str, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+        with open(self._path(key), "rb") as f:
+            for block in iter(lambda: f.read(chunk_size), b""):
+                yield block
+
+    def delete(self, key: str) -> bool:
+        try:
+            os.remove(self._path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def local_path(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        return path if os.path.exists(path) else None
+
+_storage: Optional[StorageBackend] = None
+
+def get_storage() -> StorageBackend:
+    """Return the configured storage backend (``STORAGE_BACKEND``)."""
+    global _storage
+    if _storage is None:
+        if STORAGE_BACKEND == "cloudinary":
+            _storage = CloudinaryStorage()
+        elif STORAGE_BACKEND == "gridfs":
+            _storage = GridFSStorage()
+        elif STORAGE_BACKEND == "local":
+            _storage = LocalStorage(LOCAL_STORAGE_DIR)
+        else:
+            raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+    return _storage
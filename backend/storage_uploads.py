@@ -0,0 +1,164 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Dict
+from pymongo import ReturnDocument
+from prometheus_client import Counter, Histogram
+import contextvars
+import hashlib
+import os
+import socket
+import time
+import uuid
+import logging
+
+from database import documents_collection
+from storage import get_storage
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Uploaded PDFs wait here until the storage backend has them
+STAGING_DIR = os.getenv("STORAGE_STAGING_DIR", "staging")
+STORAGE_UPLOAD_WORKERS = int(os.getenv("STORAGE_UPLOAD_WORKERS", "2"))
+STORAGE_UPLOAD_MAX_ATTEMPTS = int(os.getenv("STORAGE_UPLOAD_MAX_ATTEMPTS", "5"))
+# An upload whose owner has not renewed its lease for this long may be taken over
+STORAGE_UPLOAD_LEASE_SECONDS = int(os.getenv("STORAGE_UPLOAD_LEASE_SECONDS", "600"))
+
+# Identifies this process as the owner of the uploads it claims
+UPLOAD_OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+STORAGE_UPLOADS = Counter('storage_uploads_total', 'Background document uploads to storage', ['backend', 'status'])
+STORAGE_UPLOAD_SECONDS = Histogram('storage_upload_seconds', 'Time to store a document PDF, including retries', ['backend'])
+
+os.makedirs(STAGING_DIR, exist_ok=True)
+_executor = ThreadPoolExecutor(max_workers=STORAGE_UPLOAD_WORKERS, thread_name_prefix="storage-upload")
+
+def new_storage_record(key: str) -> Dict[str, Any]:
+    """Initial ``storage`` field of a document whose PDF is still staged."""
+    return {
+        "backend": get_storage().name,
+        "key": key,
+        "status": "pending",
+        "attempts": 0,
+        "error": None,
+        "owner": None,
+        "lease_expires_at": None,
+        "updated_at": datetime.utcnow()
+    }
+
+def staged_path(key: str) -> str:
+    return os.path.join(STAGING_DIR, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".pdf")
+
+def stage_file(src_path: str, key: str) -> str:
+    """Move an uploaded file into the staging area and return its new path."""
+    path = staged_path(key)
+    os.replace(src_path, path)
+    return path
+
+def discard_staged(key: str):
+    try:
+        os.remove(staged_path(key))
+    except FileNotFoundError:
+        pass
+
+def _set_status(key: str, **fields) -> bool:
+    """Update the storage status of ``key``; False once no document refers to it."""
+    update = {f"storage.{name}": value for name, value in fields.items()}
+    update["storage.updated_at"] = datetime.utcnow()
+    return documents_collection.update_many({"storage.key": key}, {"$set": update}).matched_count > 0
+
+def _lease_expiry() -> datetime:
+    return datetime.utcnow() + timedelta(seconds=STORAGE_UPLOAD_LEASE_SECONDS)
+
+def _claim(key: str) -> bool:
+    """Take ownership of the upload for ``key`` unless another live process holds it."""
+    now = datetime.utcnow()
+    claimed = documents_collection.find_one_and_update(
+        {
+            "storage.key": key,
+            "$or": [
+                {"storage.status": {"$in": ["pending", "failed"]}},
+                {"storage.status": "uploading", "storage.owner": UPLOAD_OWNER},
+                {"storage.status": "uploading", "storage.lease_expires_at": {"$not": {"$gt": now}}},
+            ]
+        },
+        {"$set": {
+            "storage.status": "uploading",
+            "storage.owner": UPLOAD_OWNER,
+            "storage.lease_expires_at": _lease_expiry(),
+            "storage.updated_at": now,
+        }},
+        projection={"_id": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    return claimed is not None
+
+def _upload(key: str, claimed: bool = False):
+    if not claimed and not _claim(key):
+        logger.info(f"Upload of {key} is owned by another process or its document was deleted")
+        return
+    storage = get_storage()
+    path = staged_path(key)
+    start_time = time.time()
+
+    for attempt in range(1, STORAGE_UPLOAD_MAX_ATTEMPTS + 1):
+        # Each attempt renews the lease, so retries are never taken over
+        if not _set_status(key, status="uploading", attempts=attempt, owner=UPLOAD_OWNER, lease_expires_at=_lease_expiry()):
+            logger.info(f"Document for {key} was deleted; skipping its upload")
+            discard_staged(key)
+            return
+        try:
+            with span("storage.put", backend=storage.name, attempt=attempt), open(path, "rb") as f:
+                storage.put(key, f)
+        except FileNotFoundError:
+            logger.error(f"Staged file for {key} is missing")
+            _set_status(key, status="failed", error="Staged file missing", owner=None, lease_expires_at=None)
+            STORAGE_UPLOADS.labels(backend=storage.name, status="failed").inc()
+            return
+        except Exception as e:
+            logger.warning(f"Upload of {key} to {storage.name} failed (attempt {attempt}): {e}")
+            if attempt == STORAGE_UPLOAD_MAX_ATTEMPTS:
+                # The staged file is kept so resume_pending_uploads can try again
+                _set_status(key, status="failed", error=str(e), owner=None, lease_expires_at=None)
+                STORAGE_UPLOADS.labels(backend=storage.name, status="failed").inc()
+                return
+            time.sleep(min(60, 2 ** attempt))
+            continue
+
+        stored = _set_status(key, status="stored", error=None, owner=None, lease_expires_at=None)
+        discard_staged(key)
+        if not stored:
+            # The document was deleted while its PDF was uploading; don't leave the object behind
+            logger.info(f"Document for {key} was deleted during its upload; removing the stored copy")
+            storage.delete(key)
+            return
+        STORAGE_UPLOADS.labels(backend=storage.name, status="stored").inc()
+        STORAGE_UPLOAD_SECONDS.labels(backend=storage.name).observe(time.time() - start_time)
+        return
+
+def schedule_upload(key: str):
+    """Upload the staged PDF for ``key`` in the background, with retries."""
+    # The upload joins the trace of the request that staged the file
+    _executor.submit(contextvars.copy_context().run, _upload, key)
+
+def resume_pending_uploads() -> int:
+    """Reschedule uploads left unfinished by a previous process.
+
+    Every worker runs this at startup; each upload is claimed atomically
+    first, so only one process takes it, and an ``uploading`` entry is only
+    taken over once its owner's lease has expired.
+    """
+    resumed = 0
+    now = datetime.utcnow()
+    for document in documents_collection.find(
+        {"$or": [
+            {"storage.status": {"$in": ["pending", "failed"]}},
+            {"storage.status": "uploading", "storage.lease_expires_at": {"$not": {"$gt": now}}},
+        ]},
+        {"storage.key": 1}
+    ):
+        key = document["storage"]["key"]
+        if os.path.exists(staged_path(key)) and _claim(key):
+            _executor.submit(_upload, key, True)
+            resumed += 1
+    return resumed
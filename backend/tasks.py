@@ -1,13 +1,36 @@
 from celery import Celery
 from datetime import datetime, timedelta
 from database import documents_collection
+from gemini_metrics import GeminiMetrics
+from gemini_monitoring import GeminiMonitor
+from clause_extraction import ensure_clauses
+from tracing import install_celery_tracing
+from metrics_registry import install_celery_hooks
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
 # Initialize Celery with proper configuration
 app = Celery('tasks')
 app.config_from_object('celeryconfig')
+# Tasks continue the trace of whoever queued them
+install_celery_tracing()
+# Pool processes share PROMETHEUS_MULTIPROC_DIR with the API, whose /metrics includes them
+install_celery_hooks()
+
+# Background quality evaluation of sampled Gemini responses
+EVAL_BATCH_SIZE = int(os.getenv("GEMINI_EVAL_BATCH_SIZE", "5"))
+EVAL_MAX_PER_RUN = int(os.getenv("GEMINI_EVAL_MAX_PER_RUN", "50"))
+EVAL_INTERVAL_SECONDS = int(os.getenv("GEMINI_EVAL_INTERVAL_SECONDS", "60"))
+
+_monitor = None
+
+def get_monitor() -> GeminiMonitor:
+    global _monitor
+    if _monitor is None:
+        _monitor = GeminiMonitor(api_key=os.getenv('GEMINI_API_KEY'))
+    return _monitor
 
 @app.task(bind=True)
 def cleanup_old_documents(self):
@@ -29,9 +52,42 @@ def cleanup_old_documents(self):
         logger.error(f"Error during document cleanup: {str(e)}")
         return f"Error during cleanup: {str(e)}"
 
+@app.task(bind=True)
+def evaluate_pending_responses(self):
+    """Score sampled Gemini responses in batches and write the scores back."""
+    records = GeminiMetrics.claim_pending_evaluations(EVAL_MAX_PER_RUN)
+    if not records:
+        return "No pending evaluations"
+
+    monitor = get_monitor()
+    default_scores = monitor._get_default_scores()
+    evaluated = 0
+    for i in range(0, len(records), EVAL_BATCH_SIZE):
+        batch = records[i:i + EVAL_BATCH_SIZE]
+        scores = monitor.evaluate_batch([record.get("evaluation_input") or record["response"] for record in batch])
+        for record, record_scores in zip(batch, scores):
+            if record_scores == default_scores:
+                GeminiMetrics.save_evaluation(record["_id"], None)
+            else:
+                GeminiMetrics.save_evaluation(record["_id"], record_scores, record.get("timestamp"))
+                evaluated += 1
+
+    logger.info(f"Evaluated {evaluated} of {len(records)} sampled Gemini responses")
+    return f"Evaluated {evaluated} of {len(records)} responses"
+
+@app.task(bind=True)
+def extract_document_clauses(self, document_id: str):
+    """Extract and save a document's clauses ahead of its first /clauses request."""
+    status, _ = ensure_clauses(document_id, trigger="background")
+    return f"Clause extraction for {document_id}: {status}"
+
 app.conf.beat_schedule = {
     'cleanup-documents': {
         'task': 'tasks.cleanup_old_documents',
         'schedule': timedelta(days=1),
     },
+    'evaluate-gemini-responses': {
+        'task': 'tasks.evaluate_pending_responses',
+        'schedule': timedelta(seconds=EVAL_INTERVAL_SECONDS),
+    },
 } 
\ No newline at end of file
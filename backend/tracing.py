@@ -0,0 +1,298 @@
+"""Lightweight tracing of pipeline stages.
+
+``span(name)`` times a block, records it in the ``pipeline_stage_seconds``
+histogram and, when ``TRACING_OTLP_ENDPOINT`` is set, exports it to an
+OTLP/HTTP collector (JSON encoding, ``/v1/traces``). Spans nest through a
+context variable, so a stage run from a request becomes a child of the
+request's span. Trace context crosses into Celery tasks through a W3C
+``traceparent`` message header.
+"""
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+from prometheus_client import Counter, Histogram
+import atexit
+import functools
+import inspect
+import os
+import random
+import re
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+TRACING_SERVICE_NAME = os.getenv("TRACING_SERVICE_NAME", "legal-doc-backend")
+# e.g. http://localhost:4318 for a local OpenTelemetry collector; unset disables export
+TRACING_OTLP_ENDPOINT = os.getenv("TRACING_OTLP_ENDPOINT", "")
+# Fraction of new traces exported; stage histograms always see every span
+TRACING_SAMPLE_RATE = float(os.getenv("TRACING_SAMPLE_RATE", "1.0"))
+TRACING_BATCH_SIZE = int(os.getenv("TRACING_BATCH_SIZE", "256"))
+TRACING_FLUSH_INTERVAL = float(os.getenv("TRACING_FLUSH_INTERVAL", "5"))
+TRACING_MAX_QUEUE = int(os.getenv("TRACING_MAX_QUEUE", "10000"))
+
+STAGE_SECONDS = Histogram(
+    'pipeline_stage_seconds', 'Time spent in each traced pipeline stage', ['stage', 'status'],
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+)
+SPANS_DROPPED = Counter('tracing_spans_dropped_total', 'Spans not exported', ['reason'])
+
+TRACEPARENT_PATTERN = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+class Span:
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], sampled: bool, attributes: Dict[str, Any]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+def parse_traceparent(header: Optional[str]):
+    """Return ``(trace_id, parent_span_id, sampled)`` from a traceparent header, or None."""
+    match = TRACEPARENT_PATTERN.match((header or "").strip().lower())
+    if not match:
+        return None
+    return match.group(1), match.group(2), match.group(3) == "01"
+
+def _start(name: str, attributes: Dict[str, Any], traceparent: Optional[str] = None) -> Span:
+    parent = _current_span.get()
+    remote = parse_traceparent(traceparent) if traceparent else None
+    if remote is not None:
+        return Span(name, remote[0], remote[1], remote[2], attributes)
+    if parent is not None:
+        return Span(name, parent.trace_id, parent.span_id, parent.sampled, attributes)
+    return Span(name, "%032x" % random.getrandbits(128), None, random.random() < TRACING_SAMPLE_RATE, attributes)
+
+def _finish(span: Span, end_ns: Optional[int] = None):
+    span.end_ns = end_ns or time.time_ns()
+    STAGE_SECONDS.labels(stage=span.name, status="error" if span.error else "ok").observe(
+        (span.end_ns - span.start_ns) / 1e9
+    )
+    if span.sampled and exporter is not None:
+        exporter.add(span)
+
+@contextmanager
+def span(name: str, traceparent: Optional[str] = None, **attributes) -> Iterator[Span]:
+    """Time a pipeline stage as a span; a child of the current span unless ``traceparent`` is given."""
+    current = _start(name, attributes, traceparent)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        _finish(current)
+
+def traced(name: str) -> Callable:
+    """Decorator form of ``span`` for sync and async functions."""
+    def decorator(fn: Callable) -> Callable:
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def span_iter(name: str, make_iterator: Callable[[], Iterable], **attributes) -> Iterator:
+    """Yield from ``make_iterator()`` inside a span that ends when the iteration does.
+
+    The span stays open until the iterator is exhausted, fails or is closed.
+    It is not made current, so the generator may be resumed from different
+    threads (e.g. ``iterate_in_threadpool``).
+    """
+    current = _start(name, attributes)
+    try:
+        yield from make_iterator()
+    except GeneratorExit:
+        raise
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _finish(current)
+
+def record_span(name: str, start_ns: int, end_ns: int, error: Optional[str] = None, **attributes):
+    """Record an operation that already finished as a child of the current span, if any."""
+    parent = _current_span.get()
+    if parent is None:
+        return
+    finished = Span(name, parent.trace_id, parent.span_id, parent.sampled, attributes)
+    finished.start_ns = start_ns
+    finished.error = error
+    _finish(finished, end_ns)
+
+def _attribute_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def _otlp_span(span: Span) -> Dict[str, Any]:
+    encoded = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": 1,  # SPAN_KIND_INTERNAL
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.end_ns),
+        "attributes": [{"key": key, "value": _attribute_value(value)} for key, value in span.attributes.items()],
+        "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+    }
+    if span.parent_id:
+        encoded["parentSpanId"] = span.parent_id
+    return encoded
+
+class OtlpExporter:
+    """Send finished spans to an OTLP/HTTP collector in batches from a background thread.
+
+    Spans beyond ``max_queue`` are dropped and counted rather than slowing
+    down the traced code.
+    """
+
+    def __init__(self, endpoint: str, batch_size: int, flush_interval: float, max_queue: int):
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+        self._client = None
+
+    def add(self, span: Span):
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                SPANS_DROPPED.labels(reason="overflow").inc()
+                return
+            self._queue.append(span)
+            self._ensure_thread()
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify()
+
+    def _ensure_thread(self):
+        # Started lazily, and again in forked worker processes
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="otlp-exporter", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self._queue) < self.batch_size:
+                    self._cond.wait(timeout=self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        with self._cond:
+            batch: List[Span] = list(self._queue)
+            self._queue.clear()
+        for i in range(0, len(batch), self.batch_size):
+            self._send(batch[i:i + self.batch_size])
+
+    def _send(self, spans: List[Span]):
+        import httpx
+        if self._client is None:
+            self._client = httpx.Client(timeout=5.0)
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [
+                    {"key": "service.name", "value": {"stringValue": TRACING_SERVICE_NAME}},
+                    {"key": "process.pid", "value": {"intValue": str(os.getpid())}},
+                ]},
+                "scopeSpans": [{"scope": {"name": "tracing"}, "spans": [_otlp_span(s) for s in spans]}],
+            }]
+        }
+        try:
+            response = self._client.post(self.url, json=payload)
+            response.raise_for_status()
+        except Exception as e:
+            logger.debug(f"Exporting {len(spans)} spans failed: {e}")
+            SPANS_DROPPED.labels(reason="export_error").inc(len(spans))
+
+exporter: Optional[OtlpExporter] = None
+if TRACING_OTLP_ENDPOINT:
+    exporter = OtlpExporter(TRACING_OTLP_ENDPOINT, TRACING_BATCH_SIZE, TRACING_FLUSH_INTERVAL, TRACING_MAX_QUEUE)
+    atexit.register(exporter.flush)
+
+class TracingMiddleware:
+    """Open a root span per HTTP request, continuing an incoming ``traceparent``."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        from monitoring import route_template
+        headers = dict(scope.get("headers") or [])
+        incoming = headers.get(b"traceparent", b"").decode("latin-1") or None
+        name = f"{scope['method']} {route_template(scope)}"
+        with span(name, traceparent=incoming, **{"http.method": scope["method"]}) as request_span:
+            async def send_with_trace(message):
+                if message["type"] == "http.response.start":
+                    request_span.set_attribute("http.status_code", message["status"])
+                    message.setdefault("headers", [])
+                    message["headers"] = list(message["headers"]) + [(b"x-trace-id", request_span.trace_id.encode())]
+                await send(message)
+            await self.app(scope, receive, send_with_trace)
+
+def install_celery_tracing():
+    """Propagate trace context to Celery tasks and trace each task run."""
+    from celery.signals import before_task_publish, task_prerun, task_postrun
+
+    @before_task_publish.connect(weak=False)
+    def inject_traceparent(headers=None, **kwargs):
+        current = _current_span.get()
+        if current is not None and headers is not None:
+            headers["traceparent"] = current.traceparent
+
+    @task_prerun.connect(weak=False)
+    def start_task_span(task_id=None, task=None, **kwargs):
+        traceparent = task.request.get("traceparent") if task is not None else None
+        task_span = _start(f"celery {task.name}", {"celery.task_id": task_id}, traceparent)
+        task.request._tracing = (task_span, _current_span.set(task_span))
+
+    @task_postrun.connect(weak=False)
+    def finish_task_span(task=None, state=None, **kwargs):
+        started = getattr(task.request, "_tracing", None) if task is not None else None
+        if started is None:
+            return
+        task_span, token = started
+        if state and state != "SUCCESS":
+            task_span.error = state
+        _current_span.reset(token)
+        _finish(task_span)
@@ -0,0 +1,263 @@
+"""Resumable, chunked PDF uploads.
+
+A client initiates a session with the file name and total size, sends the
+bytes as parts (each a raw request body, appended at the session's current
+offset) and then completes the session. The session record in Mongo holds
+the committed offset, so after a dropped connection the client asks for
+the offset and resends from there. Parts are written straight to one file
+per session and hashed while they stream; the finished file is handed to
+ingestion without another copy.
+"""
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+from pymongo import ReturnDocument
+from starlette.concurrency import run_in_threadpool
+from prometheus_client import Counter
+import hashlib
+import os
+import uuid
+import logging
+
+from mongo import get_async_db
+from database import db
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_SESSION_DIR = os.getenv("UPLOAD_SESSION_DIR", "upload_sessions")
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(500 * 1024 ** 2)))
+UPLOAD_PART_SIZE = int(os.getenv("UPLOAD_PART_SIZE", str(8 * 1024 ** 2)))
+UPLOAD_SESSION_TTL_HOURS = int(os.getenv("UPLOAD_SESSION_TTL_HOURS", "24"))
+# How long a part upload holds the session before another request may take over
+UPLOAD_PART_LEASE_SECONDS = int(os.getenv("UPLOAD_PART_LEASE_SECONDS", "300"))
+
+UPLOAD_PARTS = Counter('upload_parts_total', 'Resumable upload parts received', ['status'])
+UPLOAD_PART_BYTES = Counter('upload_part_bytes_total', 'Bytes committed through resumable upload parts')
+
+os.makedirs(UPLOAD_SESSION_DIR, exist_ok=True)
+
+# Running whole-file hashes of sessions written by this process, by session id.
+# Sessions resumed on another worker are rehashed from disk on completion.
+_running_hashes: Dict[str, Tuple[int, Any]] = {}
+
+class UploadError(Exception):
+    """A request that does not fit the session's state; ``status_code`` says how."""
+
+    def __init__(self, status_code: int, detail: str, offset: Optional[int] = None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.offset = offset
+
+def _sessions():
+    return get_async_db()["upload_sessions"]
+
+def session_path(upload_id: str) -> str:
+    return os.path.join(UPLOAD_SESSION_DIR, f"{upload_id}.part")
+
+def session_status(session: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "upload_id": session["_id"],
+        "filename": session["filename"],
+        "size": session["size"],
+        "offset": session["offset"],
+        "part_size": UPLOAD_PART_SIZE,
+        "status": session["status"],
+        "expires_at": session["expires_at"].isoformat()
+    }
+
+async def create_session(user_id: str, filename: str, size: int) -> Dict[str, Any]:
+    if not filename.endswith(".pdf"):
+        raise UploadError(400, "Only PDF files are allowed")
+    if size <= 0 or size > UPLOAD_MAX_BYTES:
+        raise UploadError(413 if size > 0 else 400, f"Size must be between 1 and {UPLOAD_MAX_BYTES} bytes")
+
+    now = datetime.utcnow()
+    session = {
+        "_id": uuid.uuid4().hex,
+        "user_id": user_id,
+        "filename": filename,
+        "size": size,
+        "offset": 0,
+        "status": "open",
+        "lease_until": None,
+        "sha256": None,
+        "created_at": now,
+        "expires_at": now + timedelta(hours=UPLOAD_SESSION_TTL_HOURS)
+    }
+    await _sessions().insert_one(session)
+    open(session_path(session["_id"]), "wb").close()
+    return session
+
+async def get_session(upload_id: str, user_id: str) -> Dict[str, Any]:
+    session = await _sessions().find_one({"_id": upload_id, "user_id": user_id})
+    if not session:
+        raise UploadError(404, "Upload not found")
+    return session
+
+def _open_at(path: str, offset: int):
+    f = open(path, "r+b")
+    f.seek(offset)
+    return f
+
+async def write_part(upload_id: str, user_id: str, offset: int, body: AsyncIterator[bytes],
+                     expected_sha256: Optional[str] = None) -> Dict[str, Any]:
+    """Append one part at ``offset`` and commit the new offset.
+
+    ``offset`` must equal the session's committed offset; otherwise a 409
+    carrying the committed offset tells the client where to resume. Bytes
+    of a part that fails or is interrupted are overwritten by the retry.
+    """
+    now = datetime.utcnow()
+    session = await _sessions().find_one_and_update(
+        {
+            "_id": upload_id, "user_id": user_id, "status": "open", "offset": offset,
+            "$or": [{"lease_until": None}, {"lease_until": {"$lt": now}}]
+        },
+        {"$set": {"lease_until": now + timedelta(seconds=UPLOAD_PART_LEASE_SECONDS)}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not session:
+        current = await get_session(upload_id, user_id)
+        if current["status"] != "open":
+            raise UploadError(409, f"Upload is {current['status']}", current["offset"])
+        raise UploadError(409, "Offset does not match the upload or another part is in progress", current["offset"])
+
+    path = session_path(upload_id)
+    part_hash = hashlib.sha256()
+    running = _running_hashes.get(upload_id)
+    file_hash = running[1].copy() if running and running[0] == offset else None
+    if file_hash is None and offset == 0:
+        file_hash = hashlib.sha256()
+
+    position = offset
+    f = None
+    try:
+        f = await run_in_threadpool(_open_at, path, offset)
+        async for chunk in body:
+            if not chunk:
+                continue
+            if position + len(chunk) > session["size"]:
+                raise UploadError(413, "Part runs past the declared upload size", offset)
+            part_hash.update(chunk)
+            if file_hash is not None:
+                file_hash.update(chunk)
+            await run_in_threadpool(f.write, chunk)
+            position += len(chunk)
+        await run_in_threadpool(f.close)
+
+        if expected_sha256 and part_hash.hexdigest() != expected_sha256.lower():
+            raise UploadError(400, "Part checksum mismatch", offset)
+    except UploadError:
+        UPLOAD_PARTS.labels(status="rejected").inc()
+        await _sessions().update_one({"_id": upload_id}, {"$set": {"lease_until": None}})
+        raise
+    except BaseException:
+        # Dropped connection: release the lease, the offset stays where it was
+        UPLOAD_PARTS.labels(status="interrupted").inc()
+        await _sessions().update_one({"_id": upload_id}, {"$set": {"lease_until": None}})
+        raise
+    finally:
+        if f is not None and not f.closed:
+            f.close()
+
+    if file_hash is not None:
+        _running_hashes[upload_id] = (position, file_hash)
+    session = await _sessions().find_one_and_update(
+        {"_id": upload_id},
+        {"$set": {"offset": position, "lease_until": None}},
+        return_document=ReturnDocument.AFTER
+    )
+    UPLOAD_PARTS.labels(status="committed").inc()
+    UPLOAD_PART_BYTES.inc(position - offset)
+    return session
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _looks_like_pdf(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(5) == b"%PDF-"
+
+async def complete_session(upload_id: str, user_id: str, expected_sha256: Optional[str] = None) -> Tuple[Dict[str, Any], str]:
+    """Close a fully uploaded session; returns the session and the file's path.
+
+    The caller owns the file from here on and removes the session with
+    ``finish_session`` once ingestion is done.
+    """
+    session = await _sessions().find_one_and_update(
+        {
+            "_id": upload_id, "user_id": user_id, "status": "open",
+            "$or": [{"lease_until": None}, {"lease_until": {"$lt": datetime.utcnow()}}]
+        },
+        {"$set": {"status": "completing", "lease_until": None}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not session:
+        current = await get_session(upload_id, user_id)
+        raise UploadError(409, f"Upload cannot be completed while {current['status']}", current["offset"])
+
+    try:
+        if session["offset"] != session["size"]:
+            raise UploadError(409, f"Upload is incomplete: {session['offset']} of {session['size']} bytes", session["offset"])
+
+        path = session_path(upload_id)
+        # Drop bytes a dropped final part may have left past the committed offset
+        await run_in_threadpool(os.truncate, path, session["size"])
+
+        running = _running_hashes.pop(upload_id, None)
+        if running and running[0] == session["size"]:
+            sha256 = running[1].hexdigest()
+        else:
+            sha256 = await run_in_threadpool(_file_sha256, path)
+        if expected_sha256 and sha256 != expected_sha256.lower():
+            raise UploadError(400, "File checksum mismatch", session["offset"])
+        if not await run_in_threadpool(_looks_like_pdf, path):
+            raise UploadError(400, "Uploaded file is not a PDF", session["offset"])
+    except UploadError:
+        await reopen_session(upload_id)
+        raise
+
+    session = await _sessions().find_one_and_update(
+        {"_id": upload_id}, {"$set": {"sha256": sha256}}, return_document=ReturnDocument.AFTER
+    )
+    return session, path
+
+async def reopen_session(upload_id: str):
+    """Return a completing session to ``open`` so completion can be retried."""
+    await _sessions().update_one({"_id": upload_id, "status": "completing"}, {"$set": {"status": "open"}})
+
+async def finish_session(upload_id: str):
+    """Forget a session and its file, whether completed or aborted."""
+    _running_hashes.pop(upload_id, None)
+    await _sessions().delete_one({"_id": upload_id})
+    try:
+        os.remove(session_path(upload_id))
+    except FileNotFoundError:
+        pass
+
+async def abort_session(upload_id: str, user_id: str):
+    session = await get_session(upload_id, user_id)
+    if session["status"] != "open" or session.get("lease_until") and session["lease_until"] > datetime.utcnow():
+        raise UploadError(409, "Upload is in use", session["offset"])
+    await finish_session(upload_id)
+
+def purge_expired_sessions() -> int:
+    """Remove session files whose record has expired (the TTL index drops records)."""
+    names = [name for name in os.listdir(UPLOAD_SESSION_DIR) if name.endswith(".part")]
+    if not names:
+        return 0
+    ids = [name[:-len(".part")] for name in names]
+    live = {doc["_id"] for doc in db.upload_sessions.find({"_id": {"$in": ids}}, {"_id": 1})}
+    removed = 0
+    for upload_id in ids:
+        if upload_id not in live:
+            try:
+                os.remove(session_path(upload_id))
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
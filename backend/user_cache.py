@@ -0,0 +1,51 @@
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+from prometheus_client import Counter
+import os
+import threading
+import time
+
+# Also the longest a change made directly in MongoDB (e.g. a removed user) stays unseen
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", "10000"))
+
+USER_CACHE_LOOKUPS = Counter('user_cache_lookups_total', 'Authenticated-user cache lookups', ['result'])
+
+class UserCache:
+    """Short-lived, size-bounded cache of user records keyed by token subject.
+
+    The app never updates or deletes users, so entries are not invalidated:
+    a user changed or removed directly in MongoDB is seen once its entry
+    expires, up to ``USER_CACHE_TTL_SECONDS`` later. Password hashes are
+    never cached.
+    """
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, username: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[username]
+                USER_CACHE_LOOKUPS.labels(result="miss").inc()
+                return None
+            self._entries.move_to_end(username)
+            USER_CACHE_LOOKUPS.labels(result="hit").inc()
+            return entry[1]
+
+    def set(self, username: str, user: Dict[str, Any]):
+        if self.ttl <= 0:
+            return
+        cached = {key: value for key, value in user.items() if key != "hashed_password"}
+        with self._lock:
+            self._entries[username] = (time.monotonic() + self.ttl, cached)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+user_cache = UserCache(USER_CACHE_TTL_SECONDS, USER_CACHE_MAX_SIZE)
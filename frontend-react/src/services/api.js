@@ -1,6 +1,8 @@
 import axios from 'axios';
 
 const API_URL = 'http://localhost:8000';
+// Stop waiting for another request's clause extraction after this long
+const CLAUSE_POLL_TIMEOUT_MS = 3 * 60 * 1000;
 
 const api = axios.create({
   baseURL: API_URL,
@@ -57,8 +59,15 @@ export const documents = {
   },
 
   list: async () => {
-    const response = await api.get('/documents');
-    return response.data;
+    // /documents is paginated; follow X-Next-Cursor until the whole list is loaded
+    const all = [];
+    let cursor = null;
+    do {
+      const response = await api.get('/documents', { params: cursor ? { cursor } : {} });
+      all.push(...response.data);
+      cursor = response.headers['x-next-cursor'] || null;
+    } while (cursor);
+    return all;
   },
 
   get: async (filename, documentId) => {
@@ -77,8 +86,19 @@ export const documents = {
   },
 
   extractClauses: async (filename, documentId) => {
-    const response = await api.get(`/clauses/${filename}/${documentId}`);
-    return response.data;
+    // 202 means another request is extracting the clauses; wait and ask again, up to a limit
+    const deadline = Date.now() + CLAUSE_POLL_TIMEOUT_MS;
+    for (;;) {
+      const response = await api.get(`/clauses/${filename}/${documentId}`);
+      if (response.status !== 202) {
+        return response.data;
+      }
+      const retryAfter = Number(response.headers['retry-after']) || 5;
+      if (Date.now() + retryAfter * 1000 > deadline) {
+        throw new Error('Clause extraction is taking too long. Please try again later.');
+      }
+      await new Promise((resolve) => setTimeout(resolve, retryAfter * 1000));
+    }
   },
 
   chat: async (filename, documentId, query) => {
@@ -68,9 +68,23 @@ if exist %RABBITMQ_PATH% (
 :: Wait for RabbitMQ to start
 timeout /t 5 /nobreak >nul
 
+:: Shared Prometheus metrics for the API, Celery and inference processes; start empty
+set "PROMETHEUS_MULTIPROC_DIR=%SCRIPT_DIR%backend\prometheus_multiproc"
+if exist "%PROMETHEUS_MULTIPROC_DIR%" rmdir /s /q "%PROMETHEUS_MULTIPROC_DIR%"
+mkdir "%PROMETHEUS_MULTIPROC_DIR%"
+
+:: Secret shared by the inference server and its clients; a fresh one per run unless already set
+if not defined INFERENCE_AUTHKEY (
+    for /f %%k in ('python -c "import secrets; print(secrets.token_hex(32))"') do set "INFERENCE_AUTHKEY=%%k"
+)
+
+:: Start inference server (embedding and OCR models shared by all workers)
+echo Starting inference server...
+start cmd /k "cd backend && python inference_server.py"
+
 :: Start Celery worker
 echo Starting Celery worker...
-start cmd /k "cd backend && celery -A tasks worker --loglevel=info -Q cleanup"
+start cmd /k "cd backend && celery -A tasks worker --loglevel=info -Q cleanup,evaluation,clauses"
 
 :: Start Celery beat for scheduled tasks
 echo Starting Celery beat...